@@ -1,21 +1,302 @@
-from flask import Flask, render_template, redirect, url_for, request, flash
+from flask import Flask, render_template, redirect, url_for, request, flash, g, Response, send_file, send_from_directory, stream_with_context
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from markupsafe import Markup, escape
+from datetime import datetime, timedelta
+from email.message import EmailMessage
 import sqlite3
 import os
+import base64
+import bisect
+import calendar
+import functools
+import hashlib
 import secrets
+import smtplib
 import ast
+import threading
+import time
+import click
+import csv
+import gzip
+import io
+import json
+import mimetypes
+import re
+import shutil
+import tempfile
+from urllib.request import pathname2url
+
+try:
+    from openpyxl import Workbook
+except ImportError:  # optional, only needed for .xlsx exports
+    Workbook = None
 
 app = Flask(__name__)
 app.config['SESSION_COOKIE_DOMAIN'] = '.ninacaseira.com'
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['SESSION_COOKIE_SECURE'] = True  # if using HTTPS
+app.config['DATABASE'] = 'database.db'
+app.config['DB_POOL_SIZE'] = 2  # idle connections kept per thread
+app.config['USER_CACHE_TTL'] = 300  # seconds a loaded user is kept while users is unchanged
+
+# Connection handling. The database is switched to WAL once by init_db (the mode
+# is stored in the file), so worker processes can read while one of them writes.
+DB_PRAGMAS = (
+    'PRAGMA busy_timeout = 5000',  # first, so the ones below wait for locks too
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -20000',  # ~20MB page cache
+    'PRAGMA mmap_size = 268435456',  # 256MB
+)
+
+_db_pool = threading.local()
+_db_pool_stats = {'hits': 0, 'misses': 0, 'returned': 0, 'discarded': 0}
+_db_pool_lock = threading.Lock()
+
+# SQL instrumentation. Every statement run through connect_db's connections is
+# counted and timed into the current thread's totals, which the request hooks
+# below reset and record per request. Statements slower than SLOW_QUERY_MS are
+# logged once with their EXPLAIN QUERY PLAN.
+app.config['SLOW_QUERY_MS'] = 200
+
+class _RequestSQL(threading.local):
+    queries = 0
+    seconds = 0.0
+
+_request_sql = _RequestSQL()
+_slow_queries = {'count': 0}
+
+class TimedCursor(sqlite3.Cursor):
+    _sql = None
+    _parameters = None
+    _elapsed = 0.0
+    _logged = False
+
+    def _start(self, sql, parameters=None):
+        self._sql, self._parameters = sql, parameters
+        self._elapsed, self._logged = 0.0, False
+        _request_sql.queries += 1
+
+    def _timed(self, method, *args):
+        started = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            _request_sql.seconds += elapsed
+            self._elapsed += elapsed
+            if not self._logged and self._elapsed * 1000 >= app.config['SLOW_QUERY_MS']:
+                self._logged = True
+                log_slow_query(self.connection, self._sql, self._parameters, self._elapsed)
+
+    def execute(self, sql, parameters=()):
+        self._start(sql, parameters)
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._start(sql)
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def executescript(self, script):
+        self._start(script)
+        return self._timed(super().executescript, script)
+
+    # Most rows are read with these, so a statement's time includes its fetch
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # The built-in shortcuts don't go through cursor()
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
+
+def log_slow_query(conn, sql, parameters, elapsed):
+    plan = []
+    if parameters is not None and sql.split(None, 1)[0].upper() in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE'):
+        try:
+            # A plain cursor, so explaining isn't itself counted or timed
+            plan = sqlite3.Cursor(conn).execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+        except sqlite3.Error:
+            pass
+    with _db_pool_lock:
+        _slow_queries['count'] += 1
+    app.logger.warning('Slow query (%.1f ms): %s%s', elapsed * 1000, ' '.join(sql.split()),
+                       ''.join(f'\n    {row[3]}' for row in plan))
+
+def connect_db(path=None):
+    """Open a new connection with the app PRAGMAs applied."""
+    # uri=True lets attach_archives open the archive read-only
+    conn = sqlite3.connect(path or app.config['DATABASE'], factory=TimedConnection, uri=True)
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def _count_pool(key):
+    with _db_pool_lock:
+        _db_pool_stats[key] += 1
+
+def get_db():
+    """Return the connection for the current request, reusing one from the pool."""
+    if 'db' not in g:
+        path = app.config['DATABASE']
+        idle = getattr(_db_pool, 'connections', None)
+        if idle is None:
+            idle = _db_pool.connections = []
+        conn = None
+        while idle and conn is None:
+            candidate_path, candidate = idle.pop()
+            if candidate_path == path:
+                conn = candidate
+            else:
+                candidate.close()
+        if conn is not None:
+            _count_pool('hits')
+        else:
+            _count_pool('misses')
+            conn = connect_db(path)
+        g.db = conn
+        g.db_path = path
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop('db', None)
+    path = g.pop('db_path', None)
+    if conn is None:
+        return
+    try:
+        # Never hand a half-finished transaction to the next request
+        if conn.in_transaction:
+            conn.rollback()
+    except sqlite3.Error:
+        conn.close()
+        _count_pool('discarded')
+        return
+    idle = getattr(_db_pool, 'connections', None)
+    if idle is None:
+        idle = _db_pool.connections = []
+    if len(idle) < app.config['DB_POOL_SIZE']:
+        idle.append((path, conn))
+        _count_pool('returned')
+    else:
+        conn.close()
+        _count_pool('discarded')
+
+def db_pool_stats():
+    with _db_pool_lock:
+        stats = dict(_db_pool_stats)
+    requests_served = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / requests_served if requests_served else 0
+    return stats
+
+# Per-route request metrics: latency, statements and SQL time as histograms,
+# plus a count per status code. Each worker process keeps its own figures.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+ROUTE_HISTOGRAMS = (
+    ('http_request_duration_seconds', LATENCY_BUCKETS, 'Request latency by route.'),
+    ('http_request_sql_queries', QUERY_BUCKETS, 'SQL statements per request by route.'),
+    ('http_request_sql_seconds', LATENCY_BUCKETS, 'Time spent in SQLite per request by route.'),
+)
 
-# Database setup
+_route_metrics = {}
+_route_metrics_lock = threading.Lock()
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    _request_sql.queries = 0
+    _request_sql.seconds = 0.0
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    values = (time.perf_counter() - started, _request_sql.queries, _request_sql.seconds)
+    key = (request.endpoint or 'none', request.method)
+    with _route_metrics_lock:
+        route = _route_metrics.get(key)
+        if route is None:
+            route = _route_metrics[key] = {
+                'status': {},
+                'histograms': [([0] * (len(buckets) + 1), [0.0]) for _, buckets, _ in ROUTE_HISTOGRAMS],
+            }
+        route['status'][response.status_code] = route['status'].get(response.status_code, 0) + 1
+        for (_, buckets, _), (counts, total), value in zip(ROUTE_HISTOGRAMS, route['histograms'], values):
+            counts[bisect.bisect_left(buckets, value)] += 1
+            total[0] += value
+    return response
+
+def _prometheus_labels(**labels):
+    def escape_value(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape_value(value)}"' for name, value in labels.items()) + '}'
+
+def prometheus_metrics():
+    """Render the request, SQL and cache metrics in the Prometheus text format."""
+    with _route_metrics_lock:
+        routes = {key: {'status': dict(route['status']),
+                        'histograms': [(list(counts), total[0]) for counts, total in route['histograms']]}
+                  for key, route in sorted(_route_metrics.items())}
+    lines = ['# HELP nina_http_requests_total Requests by route and status.',
+             '# TYPE nina_http_requests_total counter']
+    for (endpoint, method), route in routes.items():
+        for status, count in sorted(route['status'].items()):
+            lines.append(f'nina_http_requests_total{_prometheus_labels(endpoint=endpoint, method=method, status=status)} {count}')
+
+    for index, (name, buckets, help_text) in enumerate(ROUTE_HISTOGRAMS):
+        lines += [f'# HELP nina_{name} {help_text}', f'# TYPE nina_{name} histogram']
+        for (endpoint, method), route in routes.items():
+            counts, total = route['histograms'][index]
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = _prometheus_labels(endpoint=endpoint, method=method, le=bound)
+                lines.append(f'nina_{name}_bucket{labels} {cumulative}')
+            labels = _prometheus_labels(endpoint=endpoint, method=method)
+            lines.append(f'nina_{name}_sum{labels} {total:.6f}')
+            lines.append(f'nina_{name}_count{labels} {cumulative}')
+
+    with _db_pool_lock:
+        slow = _slow_queries['count']
+    lines += ['# HELP nina_sql_slow_queries_total Statements slower than SLOW_QUERY_MS.',
+              '# TYPE nina_sql_slow_queries_total counter',
+              f'nina_sql_slow_queries_total {slow}']
+
+    caches = (('db_pool', db_pool_stats()), ('user_cache', user_cache_stats()),
+              ('fragment_cache', fragment_cache_stats()))
+    lines += ['# HELP nina_cache_lookups_total Connection pool and cache lookups by result.',
+              '# TYPE nina_cache_lookups_total counter']
+    for cache, stats in caches:
+        for result in ('hits', 'misses'):
+            lines.append(f'nina_cache_lookups_total{_prometheus_labels(cache=cache, result=result)} {stats[result]}')
+    return '\n'.join(lines) + '\n'
+
+# Database setup. Run once per deployment with 'flask --app app init-db' (or
+# 'python app.py' in development), not when workers import the app.
 def init_db():
-    conn = sqlite3.connect('database.db')
+    """Create the schema and the first admin, apply migrations; return the schema version."""
+    conn = connect_db()
     c = conn.cursor()
+    c.execute('PRAGMA journal_mode = WAL')
+    # Serialize concurrent runs so the admin is only created once
+    c.execute('BEGIN IMMEDIATE')
     
     # Users table
     c.execute('''CREATE TABLE IF NOT EXISTS users
@@ -79,9 +360,547 @@ def init_db():
                  ('admin', hashed_pw, True))
     
     conn.commit()
+    version = migrate_db(conn)
+    conn.close()
+    return version
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create the database or bring its schema up to date."""
+    version = init_db()
+    click.echo(f'{app.config["DATABASE"]} is at schema version {version}.')
+
+def check_db():
+    """Raise if the database hasn't been initialized with the current migrations."""
+    conn = connect_db()
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        conn.close()
+    if version < len(MIGRATIONS):
+        raise RuntimeError(f'{app.config["DATABASE"]} is at schema version {version}, '
+                           f'expected {len(MIGRATIONS)}; run "flask --app app init-db" first')
+
+# Daily totals rollup read by /results; kept current by every sale and expense write
+def bump_daily_totals(c, day, sales_total=0, delivery_total=0, sales_count=0,
+                      items_sold=0, expenses_total=0, expenses_count=0):
+    if not day:
+        return
+    c.execute("""INSERT INTO daily_totals
+                 (day, sales_total, delivery_total, sales_count, items_sold,
+                  expenses_total, expenses_count)
+                 VALUES (date(?), ?, ?, ?, ?, ?, ?)
+                 ON CONFLICT(day) DO UPDATE SET
+                     sales_total = sales_total + excluded.sales_total,
+                     delivery_total = delivery_total + excluded.delivery_total,
+                     sales_count = sales_count + excluded.sales_count,
+                     items_sold = items_sold + excluded.items_sold,
+                     expenses_total = expenses_total + excluded.expenses_total,
+                     expenses_count = expenses_count + excluded.expenses_count""",
+              (day, sales_total, delivery_total, sales_count, items_sold,
+               expenses_total, expenses_count))
+    if sales_count < 0 or expenses_count < 0:
+        c.execute("""DELETE FROM daily_totals
+                     WHERE day = date(?) AND sales_count = 0 AND expenses_count = 0""", (day,))
+
+def bump_sale_totals(c, sale_id, sign=1):
+    """Add (sign=1) or remove (sign=-1) a stored sale's contribution to
+    daily_totals and margin_totals."""
+    c.execute("""SELECT s.date, s.total_amount, s.delivery_cost, s.customer_name,
+                 s.customer_id, s.is_paid
+                 FROM sales s WHERE s.id = ?""", (sale_id,))
+    row = c.fetchone()
+    if not row:
+        return
+    day, total_amount, delivery_cost, customer_name, customer_id, is_paid = row
+    if not is_paid:
+        bump_receivables(c, customer_id, day, sign * (total_amount or 0), sign)
+    c.execute("""SELECT recipe_id, quantity, unit_price, box_price, unit_cost
+                 FROM sales_items WHERE sale_id = ?""", (sale_id,))
+    items = c.fetchall()
+    bump_daily_totals(c, day,
+                      sales_total=sign * (total_amount or 0),
+                      delivery_total=sign * (delivery_cost or 0),
+                      sales_count=sign,
+                      items_sold=sign * sum(item[1] for item in items))
+    bump_margin_totals(c, sale_margin_rows(customer_name, day, items, sign))
+
+# Customers and what they owe. customers.balance and unpaid_count are the running
+# total of the customer's unpaid sales; receivables holds the same amounts per
+# customer and sale day, so the aging report only reads those rows.
+def customer_id_for(c, name):
+    """Return the id of the customer with this name, creating it if needed.
+
+    Names are matched case-insensitively after trimming; a blank name maps to
+    a single 'no name' customer.
+    """
+    c.execute("""INSERT INTO customers (name, name_key) VALUES (TRIM(?1), LOWER(TRIM(?1)))
+                 ON CONFLICT(name_key) DO UPDATE SET name = name
+                 RETURNING id""", (name or '',))
+    return c.fetchone()[0]
+
+def bump_receivables(c, customer_id, day, amount, count):
+    if customer_id is None or not day:
+        return
+    c.execute("""INSERT INTO receivables (customer_id, day, amount, sales_count)
+                 VALUES (?, date(?), ?, ?)
+                 ON CONFLICT(customer_id, day) DO UPDATE SET
+                     amount = amount + excluded.amount,
+                     sales_count = sales_count + excluded.sales_count""",
+              (customer_id, day, amount, count))
+    if count < 0:
+        c.execute("DELETE FROM receivables WHERE customer_id = ? AND day = date(?) AND sales_count <= 0",
+                  (customer_id, day))
+    c.execute("UPDATE customers SET balance = balance + ?, unpaid_count = unpaid_count + ? WHERE id = ?",
+              (amount, count, customer_id))
+
+def bump_sale_receivable(c, sale_id, sign=1):
+    """Add or remove an unpaid sale's amount from its customer's receivables."""
+    c.execute("SELECT customer_id, date, total_amount, is_paid FROM sales WHERE id = ?", (sale_id,))
+    row = c.fetchone()
+    if row and not row[3]:
+        bump_receivables(c, row[0], row[1], sign * (row[2] or 0), sign)
+
+def rebuild_receivables(c):
+    c.execute("DELETE FROM receivables")
+    c.execute("""INSERT INTO receivables (customer_id, day, amount, sales_count)
+                 SELECT customer_id, date(date), SUM(total_amount), COUNT(*)
+                 FROM sales
+                 WHERE is_paid = 0 AND customer_id IS NOT NULL AND date IS NOT NULL
+                 GROUP BY customer_id, date(date)""")
+    c.execute("""UPDATE customers SET
+                     balance = COALESCE((SELECT SUM(amount) FROM receivables
+                                         WHERE customer_id = customers.id), 0),
+                     unpaid_count = COALESCE((SELECT SUM(sales_count) FROM receivables
+                                              WHERE customer_id = customers.id), 0)""")
+
+def backfill_customers(c):
+    c.execute("""INSERT INTO customers (name, name_key)
+                 SELECT MIN(TRIM(COALESCE(customer_name, ''))), LOWER(TRIM(COALESCE(customer_name, '')))
+                 FROM sales
+                 GROUP BY 2
+                 ON CONFLICT(name_key) DO NOTHING""")
+    c.execute("""UPDATE sales SET customer_id =
+                     (SELECT id FROM customers
+                      WHERE name_key = LOWER(TRIM(COALESCE(sales.customer_name, ''))))""")
+    rebuild_receivables(c)
+
+# Margin aggregates read by /margins: item revenue, ingredient cost and quantity
+# per month, keyed by recipe id and by customer name
+def sale_margin_rows(customer_name, day, items, sign=1):
+    """Turn a sale's (recipe_id, quantity, unit_price, box_price, unit_cost) lines
+    into margin_totals deltas."""
+    if not day:
+        return []
+    month = day[:7]
+    customer = (customer_name or '').strip()
+    totals = {}
+    for recipe_id, quantity, unit_price, box_price, unit_cost in items:
+        revenue = sale_item_subtotal(quantity, unit_price, box_price)
+        cost = quantity * (unit_cost or 0)
+        for key in (('recipe', str(recipe_id)), ('customer', customer)):
+            total = totals.setdefault(key, [0, 0, 0])
+            total[0] += revenue
+            total[1] += cost
+            total[2] += quantity
+    return [(dimension, key, month, sign * revenue, sign * cost, sign * quantity)
+            for (dimension, key), (revenue, cost, quantity) in totals.items()]
+
+def bump_margin_totals(c, rows):
+    rows = list(rows)
+    if not rows:
+        return
+    c.executemany("""INSERT INTO margin_totals (dimension, key, month, revenue, cost, quantity)
+                     VALUES (?, ?, ?, ?, ?, ?)
+                     ON CONFLICT(dimension, key, month) DO UPDATE SET
+                         revenue = revenue + excluded.revenue,
+                         cost = cost + excluded.cost,
+                         quantity = quantity + excluded.quantity""", rows)
+    if any(row[5] < 0 for row in rows):
+        c.execute("DELETE FROM margin_totals WHERE quantity = 0")
+
+def rebuild_margin_totals(c, sales='sales', sales_items='sales_items'):
+    c.execute("DELETE FROM margin_totals")
+    revenue = f"SUM((si.quantity / {BOX_SIZE}) * si.box_price + (si.quantity % {BOX_SIZE}) * si.unit_price)"
+    for dimension, key in (('recipe', 'CAST(si.recipe_id AS TEXT)'),
+                           ('customer', "TRIM(COALESCE(s.customer_name, ''))")):
+        c.execute(f"""INSERT INTO margin_totals (dimension, key, month, revenue, cost, quantity)
+                      SELECT '{dimension}', {key}, substr(s.date, 1, 7), {revenue},
+                             SUM(si.quantity * si.unit_cost), SUM(si.quantity)
+                      FROM {sales_items} si
+                      JOIN {sales} s ON s.id = si.sale_id
+                      WHERE s.date IS NOT NULL
+                      GROUP BY 2, 3""")
+
+def backfill_sale_item_costs(c):
+    # Lines sold before costs were tracked get the recipe's current unit cost
+    recipe_unit_costs(c)
+    c.execute("""UPDATE sales_items SET unit_cost = COALESCE(
+                     (SELECT unit_cost FROM recipes WHERE recipes.id = sales_items.recipe_id), 0)""")
+
+def bump_expense_totals(c, expense_id, sign=1):
+    """Add (sign=1) or remove (sign=-1) a stored expense's contribution to
+    daily_totals and expense_totals."""
+    c.execute("SELECT date, amount, category_id FROM expenses WHERE id = ?", (expense_id,))
+    row = c.fetchone()
+    if row:
+        bump_daily_totals(c, row[0], expenses_total=sign * row[1], expenses_count=sign)
+        bump_category_totals(c, row[2], row[0], sign * row[1], sign)
+
+# Expenses by category and month, read by /expenses and /budgets; category_id
+# is 0 for expenses without a category so it can be part of the key
+def bump_category_totals(c, category_id, day, amount, count):
+    if not day:
+        return
+    c.execute("""INSERT INTO expense_totals (category_id, month, amount, expenses_count)
+                 VALUES (?, substr(date(?), 1, 7), ?, ?)
+                 ON CONFLICT(category_id, month) DO UPDATE SET
+                     amount = amount + excluded.amount,
+                     expenses_count = expenses_count + excluded.expenses_count""",
+              (category_id or 0, day, amount, count))
+    if count < 0:
+        c.execute("""DELETE FROM expense_totals
+                     WHERE category_id = ? AND month = substr(date(?), 1, 7) AND expenses_count = 0""",
+                  (category_id or 0, day))
+
+def rebuild_expense_totals(c):
+    c.execute("DELETE FROM expense_totals")
+    c.execute("""INSERT INTO expense_totals (category_id, month, amount, expenses_count)
+                 SELECT COALESCE(category_id, 0), substr(date(date), 1, 7), SUM(amount), COUNT(*)
+                 FROM expenses
+                 WHERE date IS NOT NULL
+                 GROUP BY 1, 2""")
+
+def rebuild_daily_totals(c, sales='sales', sales_items='sales_items'):
+    # sales and sales_items can be the all_* views, see sales_tables()
+    c.execute("DELETE FROM daily_totals")
+    c.execute(f"""INSERT INTO daily_totals
+                 (day, sales_total, delivery_total, sales_count, items_sold)
+                 SELECT date(s.date), SUM(s.total_amount), SUM(COALESCE(s.delivery_cost, 0)),
+                        COUNT(*), SUM(COALESCE(i.items_sold, 0))
+                 FROM {sales} s
+                 LEFT JOIN (SELECT sale_id, SUM(quantity) AS items_sold
+                            FROM {sales_items} GROUP BY sale_id) i ON i.sale_id = s.id
+                 WHERE s.date IS NOT NULL
+                 GROUP BY date(s.date)""")
+    c.execute("""INSERT INTO daily_totals (day, expenses_total, expenses_count)
+                 SELECT date(date), SUM(amount), COUNT(*)
+                 FROM expenses
+                 WHERE date IS NOT NULL
+                 GROUP BY date(date)
+                 ON CONFLICT(day) DO UPDATE SET
+                     expenses_total = excluded.expenses_total,
+                     expenses_count = excluded.expenses_count""")
+
+def rebuild_totals(conn):
+    """Recompute the rollups from the ledger, archived sales included; return
+    the number of days in daily_totals."""
+    c = conn.cursor()
+    # Before the transaction, since attaching the archive can't happen inside one
+    sales, sales_items = sales_tables(c)
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        rebuild_daily_totals(c, sales, sales_items)
+        rebuild_margin_totals(c, sales, sales_items)
+        rebuild_receivables(c)
+        rebuild_expense_totals(c)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return c.execute("SELECT COUNT(*) FROM daily_totals").fetchone()[0]
+
+@app.cli.command('rebuild-totals')
+def rebuild_totals_command():
+    """Recompute the daily_totals, margin_totals, receivables and expense_totals rollups from the ledger."""
+    conn = connect_db()
+    days = rebuild_totals(conn)
     conn.close()
+    click.echo(f'Rebuilt daily totals for {days} days')
+
+def version_triggers(table, columns=None):
+    bump = f"""INSERT INTO table_versions (name, version) VALUES ('{table}', 1)
+               ON CONFLICT(name) DO UPDATE SET version = version + 1"""
+    update_of = f"UPDATE OF {', '.join(columns)}" if columns else 'UPDATE'
+    return [f"""CREATE TRIGGER IF NOT EXISTS {table}_version_{event.split()[0].lower()}
+                AFTER {event} ON {table}
+                BEGIN {bump}; END"""
+            for event in ('INSERT', update_of, 'DELETE')]
+
+def table_versions(c, tables):
+    """Return the change counters of the given tables, in order."""
+    placeholders = ','.join('?' * len(tables))
+    c.execute(f"SELECT name, version FROM table_versions WHERE name IN ({placeholders})", tables)
+    versions = dict(c.fetchall())
+    return [versions.get(table, 0) for table in tables]
+
+# Full-text search, read by /search. sales_search has one row per sale (rowid =
+# sale id) with the customer and the names of the recipes sold; expenses_search
+# has one row per expense. Triggers keep both in step with every write. Archived
+# sales keep their row (see archive_sales_batch), but as their items are gone
+# from sales_items it keeps the recipe names they had when they were archived.
+SALE_RECIPE_NAMES = """COALESCE((SELECT group_concat(r.name, ' ')
+                                   FROM sales_items si JOIN recipes r ON r.id = si.recipe_id
+                                   WHERE si.sale_id = {sale_id}), '')"""
+SEARCH_SCHEMA = [
+    # Prefix indexes make 'bol*' style queries cheap
+    """CREATE VIRTUAL TABLE IF NOT EXISTS sales_search USING fts5
+       (customer_name, recipes, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS expenses_search USING fts5
+       (description, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS sales_search_insert AFTER INSERT ON sales BEGIN
+           INSERT INTO sales_search (rowid, customer_name, recipes)
+           VALUES (new.id, COALESCE(new.customer_name, ''), '');
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS sales_search_update AFTER UPDATE OF customer_name ON sales BEGIN
+           UPDATE sales_search SET customer_name = COALESCE(new.customer_name, '') WHERE rowid = new.id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS sales_search_delete AFTER DELETE ON sales BEGIN
+           DELETE FROM sales_search WHERE rowid = old.id;
+       END""",
+    f"""CREATE TRIGGER IF NOT EXISTS sales_items_search_insert AFTER INSERT ON sales_items BEGIN
+           UPDATE sales_search SET recipes = {SALE_RECIPE_NAMES.format(sale_id='new.sale_id')}
+           WHERE rowid = new.sale_id;
+       END""",
+    f"""CREATE TRIGGER IF NOT EXISTS sales_items_search_delete AFTER DELETE ON sales_items BEGIN
+           UPDATE sales_search SET recipes = {SALE_RECIPE_NAMES.format(sale_id='old.sale_id')}
+           WHERE rowid = old.sale_id;
+       END""",
+    f"""CREATE TRIGGER IF NOT EXISTS recipes_search_update AFTER UPDATE OF name ON recipes BEGIN
+           UPDATE sales_search SET recipes = {SALE_RECIPE_NAMES.format(sale_id='sales_search.rowid')}
+           WHERE rowid IN (SELECT sale_id FROM sales_items WHERE recipe_id = new.id);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS expenses_search_insert AFTER INSERT ON expenses BEGIN
+           INSERT INTO expenses_search (rowid, description) VALUES (new.id, COALESCE(new.description, ''));
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS expenses_search_update AFTER UPDATE OF description ON expenses BEGIN
+           UPDATE expenses_search SET description = COALESCE(new.description, '') WHERE rowid = new.id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS expenses_search_delete AFTER DELETE ON expenses BEGIN
+           DELETE FROM expenses_search WHERE rowid = old.id;
+       END""",
+    "DELETE FROM sales_search",
+    f"""INSERT INTO sales_search (rowid, customer_name, recipes)
+        SELECT s.id, COALESCE(s.customer_name, ''), {SALE_RECIPE_NAMES.format(sale_id='s.id')}
+        FROM sales s""",
+    "DELETE FROM expenses_search",
+    """INSERT INTO expenses_search (rowid, description)
+       SELECT id, COALESCE(description, '') FROM expenses""",
+    "INSERT INTO sales_search (sales_search) VALUES ('optimize')",
+    "INSERT INTO expenses_search (expenses_search) VALUES ('optimize')",
+]
+
+def add_column(table, column, definition):
+    """Migration step adding a column only if it's missing (ALTER TABLE can't re-run)."""
+    def step(c):
+        columns = [row[1] for row in c.execute(f'PRAGMA table_info({table})')]
+        if column not in columns:
+            c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    return step
+
+# Schema migrations, applied in order at startup and tracked in PRAGMA user_version.
+# Each entry is a list of SQL statements (or callables taking a cursor) that must be
+# safe to re-run; never edit a released migration, append a new one instead.
+MIGRATIONS = [
+    # 1: indexes for the sales listing, item joins and date range reports
+    [
+        'CREATE INDEX IF NOT EXISTS idx_sales_date ON sales (date)',
+        'CREATE INDEX IF NOT EXISTS idx_sales_status_date ON sales (is_delivered, is_paid, date)',
+        'CREATE INDEX IF NOT EXISTS idx_sales_delivered_date ON sales (is_delivered, date)',
+        'CREATE INDEX IF NOT EXISTS idx_sales_items_sale_id ON sales_items (sale_id)',
+        'CREATE INDEX IF NOT EXISTS idx_sales_items_recipe_id ON sales_items (recipe_id)',
+        'CREATE INDEX IF NOT EXISTS idx_expenses_date ON expenses (date)',
+    ],
+    # 2: per-day rollup for the results dashboard
+    [
+        '''CREATE TABLE IF NOT EXISTS daily_totals
+           (day TEXT PRIMARY KEY,
+            sales_total REAL NOT NULL DEFAULT 0,
+            delivery_total REAL NOT NULL DEFAULT 0,
+            sales_count INTEGER NOT NULL DEFAULT 0,
+            items_sold INTEGER NOT NULL DEFAULT 0,
+            expenses_total REAL NOT NULL DEFAULT 0,
+            expenses_count INTEGER NOT NULL DEFAULT 0)''',
+        rebuild_daily_totals,
+    ],
+    # 3: ingredients, recipe-to-ingredient links and the cached recipe unit cost
+    [
+        '''CREATE TABLE IF NOT EXISTS ingredients
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            unit TEXT NOT NULL,
+            quantity REAL NOT NULL,
+            cost REAL NOT NULL,
+            created_by INTEGER,
+            FOREIGN KEY(created_by) REFERENCES users(id))''',
+        '''CREATE TABLE IF NOT EXISTS recipe_ingredients
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipe_id INTEGER NOT NULL,
+            ingredient_id INTEGER NOT NULL,
+            quantity REAL NOT NULL,
+            UNIQUE(recipe_id, ingredient_id),
+            FOREIGN KEY(recipe_id) REFERENCES recipes(id),
+            FOREIGN KEY(ingredient_id) REFERENCES ingredients(id))''',
+        'CREATE INDEX IF NOT EXISTS idx_recipe_ingredients_ingredient_id ON recipe_ingredients (ingredient_id)',
+        add_column('recipes', 'yield', 'INTEGER NOT NULL DEFAULT 1'),
+        add_column('recipes', 'unit_cost', 'REAL'),  # NULL means it must be recomputed
+    ],
+    # 4: unit cost snapshot on each sale line and the margin aggregates
+    [
+        add_column('sales_items', 'unit_cost', 'REAL NOT NULL DEFAULT 0'),
+        backfill_sale_item_costs,
+        '''CREATE TABLE IF NOT EXISTS margin_totals
+           (dimension TEXT NOT NULL,
+            key TEXT NOT NULL,
+            month TEXT NOT NULL,
+            revenue REAL NOT NULL DEFAULT 0,
+            cost REAL NOT NULL DEFAULT 0,
+            quantity INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimension, key, month))''',
+        'CREATE INDEX IF NOT EXISTS idx_margin_totals_month ON margin_totals (dimension, month)',
+        rebuild_margin_totals,
+    ],
+    # 5: per-table change counters, bumped by triggers on every write (of the
+    # listed columns only for recipes: unit_cost is a cache)
+    [
+        '''CREATE TABLE IF NOT EXISTS table_versions
+           (name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0)''',
+        *version_triggers('sales'),
+        *version_triggers('sales_items'),
+        *version_triggers('expenses'),
+        *version_triggers('recipes', ('name', 'unit_price', 'box_price', 'description', 'yield')),
+    ],
+    # 6: idempotency keys of offline-queued and retried submissions
+    [
+        '''CREATE TABLE IF NOT EXISTS idempotency_keys
+           (key TEXT PRIMARY KEY,
+            user_id INTEGER,
+            record_id INTEGER,
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP)''',
+        'CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys (created_at)',
+    ],
+    # 7: full-text search over customers, sold recipes and expense descriptions
+    SEARCH_SCHEMA,
+    # 8: customers, their running balance and receivables per sale day
+    [
+        '''CREATE TABLE IF NOT EXISTS customers
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            name_key TEXT NOT NULL UNIQUE,
+            balance REAL NOT NULL DEFAULT 0,
+            unpaid_count INTEGER NOT NULL DEFAULT 0)''',
+        '''CREATE TABLE IF NOT EXISTS receivables
+           (customer_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            amount REAL NOT NULL DEFAULT 0,
+            sales_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (customer_id, day))''',
+        'CREATE INDEX IF NOT EXISTS idx_receivables_day ON receivables (day)',
+        add_column('sales', 'customer_id', 'INTEGER REFERENCES customers(id)'),
+        'CREATE INDEX IF NOT EXISTS idx_sales_customer_date ON sales (customer_id, date)',
+        backfill_customers,
+    ],
+    # 9: background jobs, and pending deliveries by day for the deliveries digest
+    [
+        '''CREATE TABLE IF NOT EXISTS jobs
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            payload TEXT NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'queued',
+            unique_key TEXT UNIQUE,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            run_at TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT,
+            result TEXT,
+            error TEXT,
+            created_by INTEGER,
+            FOREIGN KEY(created_by) REFERENCES users(id))''',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_status_run_at ON jobs (status, run_at)',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_name_id ON jobs (name, id)',
+        'CREATE INDEX IF NOT EXISTS idx_sales_delivered_delivery_date ON sales (is_delivered, delivery_date)',
+    ],
+    # 10: change counters for the ingredient links read by the production plan
+    [
+        *version_triggers('ingredients', ('name', 'unit')),
+        *version_triggers('recipe_ingredients'),
+    ],
+    # 11: what was moved to the sales archive, per year, see archive_sales()
+    [
+        '''CREATE TABLE IF NOT EXISTS sale_archives
+           (year TEXT PRIMARY KEY,
+            sales_count INTEGER NOT NULL DEFAULT 0,
+            first_date TEXT,
+            last_date TEXT,
+            archived_at TEXT)''',
+    ],
+    # 12: expense categories with a monthly budget, recurring expenses, and
+    # expenses by category and month
+    [
+        '''CREATE TABLE IF NOT EXISTS expense_categories
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            monthly_budget REAL)''',
+        '''CREATE TABLE IF NOT EXISTS recurring_expenses
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            description TEXT NOT NULL,
+            amount REAL NOT NULL,
+            category_id INTEGER REFERENCES expense_categories(id),
+            period TEXT NOT NULL DEFAULT 'monthly',
+            start_date TEXT NOT NULL,
+            end_date TEXT,
+            next_date TEXT NOT NULL,
+            created_by INTEGER,
+            FOREIGN KEY(created_by) REFERENCES users(id))''',
+        'CREATE INDEX IF NOT EXISTS idx_recurring_expenses_next_date ON recurring_expenses (next_date)',
+        add_column('expenses', 'category_id', 'INTEGER REFERENCES expense_categories(id)'),
+        add_column('expenses', 'recurring_id', 'INTEGER REFERENCES recurring_expenses(id)'),
+        'CREATE INDEX IF NOT EXISTS idx_expenses_category_date ON expenses (category_id, date)',
+        # At most one expense per template and date, whichever process creates it
+        '''CREATE UNIQUE INDEX IF NOT EXISTS idx_expenses_recurring_date ON expenses (recurring_id, date)
+           WHERE recurring_id IS NOT NULL''',
+        '''CREATE TABLE IF NOT EXISTS expense_totals
+           (category_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            amount REAL NOT NULL DEFAULT 0,
+            expenses_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (category_id, month))''',
+        'CREATE INDEX IF NOT EXISTS idx_expense_totals_month ON expense_totals (month)',
+        rebuild_expense_totals,
+    ],
+    # 13: change counter for users, so every worker's load_user cache sees admin changes
+    [
+        *version_triggers('users', ('username', 'is_admin')),
+    ],
+]
 
-init_db()
+def migrate_db(conn):
+    """Apply any pending MIGRATIONS and return the resulting schema version."""
+    c = conn.cursor()
+    version = c.execute('PRAGMA user_version').fetchone()[0]
+    for number, steps in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        # Take the write lock first so concurrent workers can't apply a step twice
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            if c.execute('PRAGMA user_version').fetchone()[0] >= number:
+                conn.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(c)
+                else:
+                    c.execute(step)
+            c.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = number
+    return version
 
 # Flask-Login setup
 login_manager = LoginManager()
@@ -91,21 +910,115 @@ login_manager.init_app(app)
 class User(UserMixin):
     pass
 
+# In-process cache of (id, username, is_admin) rows for load_user. Each worker
+# has its own copy, so entries are tagged with the users table_versions counter
+# and a change made in any worker (add_user, toggle_admin) drops them everywhere
+# on the next request; reading the counter is one primary key lookup.
+_user_cache = {}
+_user_cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+_user_cache_lock = threading.Lock()
+
+def invalidate_user_cache(user_id=None):
+    """Drop one cached user, or every cached user when no id is given."""
+    with _user_cache_lock:
+        if user_id is None:
+            _user_cache.clear()
+        else:
+            _user_cache.pop(int(user_id), None)
+        _user_cache_stats['invalidations'] += 1
+
+def user_cache_stats():
+    with _user_cache_lock:
+        stats = dict(_user_cache_stats)
+        stats['size'] = len(_user_cache)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0
+    return stats
+
 @login_manager.user_loader
 def load_user(user_id):
-    conn = sqlite3.connect('database.db')
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    user_data = c.fetchone()
-    conn.close()
-    
-    if user_data:
-        user = User()
-        user.id = user_data[0]
-        user.username = user_data[1]
-        user.is_admin = user_data[3]
-        return user
-    return None
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+
+    now = time.monotonic()
+    version = request_table_versions(['users'])[0]
+    with _user_cache_lock:
+        cached = _user_cache.get(user_id)
+        if cached and cached[0] > now and cached[1] == version:
+            _user_cache_stats['hits'] += 1
+            user_data = cached[2]
+        else:
+            _user_cache_stats['misses'] += 1
+            user_data = None
+
+    if user_data is None:
+        conn = get_db()
+        c = conn.cursor()
+        c.execute("SELECT id, username, is_admin FROM users WHERE id = ?", (user_id,))
+        user_data = c.fetchone()
+        if not user_data:
+            return None
+        with _user_cache_lock:
+            _user_cache[user_id] = (now + app.config['USER_CACHE_TTL'], version, user_data)
+
+    user = User()
+    user.id = user_data[0]
+    user.username = user_data[1]
+    user.is_admin = user_data[2]
+    return user
+
+# Cache of rendered template fragments that only change with some tables, such
+# as the recipe picker. Entries are keyed by the tables' table_versions counters,
+# so any write to those tables (add/edit/delete_recipe, the API, imports) makes
+# the next render miss, in every worker.
+_fragment_cache = {}
+_fragment_cache_stats = {'hits': 0, 'misses': 0}
+_fragment_cache_lock = threading.Lock()
+
+def request_table_versions(tables):
+    # Read each counter once per request, however many fragments use it
+    versions = g.setdefault('table_versions', {})
+    missing = [table for table in tables if table not in versions]
+    if missing:
+        versions.update(zip(missing, table_versions(get_db().cursor(), missing)))
+    return tuple(versions[table] for table in tables)
+
+@app.template_global()
+def cache_fragment(name, *tables, caller):
+    """{% call cache_fragment('name', 'table', ...) %}...{% endcall %}"""
+    versions = request_table_versions(tables)
+    with _fragment_cache_lock:
+        cached = _fragment_cache.get(name)
+        if cached and cached[0] == versions:
+            _fragment_cache_stats['hits'] += 1
+            return cached[1]
+        _fragment_cache_stats['misses'] += 1
+    html = Markup(caller())
+    with _fragment_cache_lock:
+        _fragment_cache[name] = (versions, html)
+    return html
+
+def fragment_cache_stats():
+    with _fragment_cache_lock:
+        stats = dict(_fragment_cache_stats)
+        stats['size'] = len(_fragment_cache)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0
+    return stats
+
+@app.template_global()
+def picker_recipes():
+    # Only called when the recipe picker fragment has to be rendered again
+    c = get_db().cursor()
+    c.execute("SELECT id, name, unit_price, box_price FROM recipes")
+    return c.fetchall()
+
+@app.template_filter('select_option')
+def select_option(options, value):
+    """Mark the <option> with the given value as selected in cached options HTML."""
+    return Markup(str(options).replace(f'value="{value}"', f'value="{value}" selected', 1))
 
 # Auth routes
 @app.route('/login', methods=['GET', 'POST'])
@@ -114,11 +1027,10 @@ def login():
         username = request.form['username']
         password = request.form['password']
         
-        conn = sqlite3.connect('database.db')
+        conn = get_db()
         c = conn.cursor()
         c.execute("SELECT * FROM users WHERE username = ?", (username,))
         user_data = c.fetchone()
-        conn.close()
         
         if user_data and check_password_hash(user_data[2], password):
             user = User()
@@ -132,6 +1044,90 @@ def login():
     
     return render_template('login.html')
 
+# Service worker and the page it falls back to when offline. The worker is
+# served from the root so its scope covers the whole app.
+@app.route('/service-worker.js')
+def service_worker():
+    # Precache the current build; a new build changes these lines, which makes
+    # browsers install the new worker
+    with open(os.path.join(app.static_folder, 'service-worker.js'), encoding='utf-8') as f:
+        script = f.read()
+    manifest = asset_manifest()
+    assets = [url_for('built_asset', filename=hashed) for hashed in sorted(manifest.values())]
+    version = hashlib.sha256(''.join(assets).encode()).hexdigest()[:10] if assets else 'dev'
+    script = script.replace('const ASSETS = [];', f'const ASSETS = {json.dumps(assets)};', 1)
+    script = script.replace("const ASSETS_VERSION = 'dev';", f"const ASSETS_VERSION = '{version}';", 1)
+    response = Response(script, mimetype='text/javascript')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# Static assets built into static/dist by 'flask --app app build-assets' (see
+# assets.py). Their names carry a content hash, so they are cached for good.
+# Until a build exists, pages fall back to the pinned CDN copies.
+ASSET_FALLBACKS = {
+    'app.css': ['https://cdn.jsdelivr.net/npm/tailwindcss@2.2.19/dist/tailwind.min.css',
+                'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css',
+                'https://fonts.googleapis.com/css2?family=Pacifico&family=Montserrat&display=swap'],
+    'chart.js': ['https://cdn.jsdelivr.net/npm/chart.js@4.4.0/dist/chart.umd.js'],
+}
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+_asset_manifest = {'mtime': None, 'files': {}}
+_asset_manifest_lock = threading.Lock()
+
+def asset_manifest():
+    """Logical name -> hashed file name, reloaded when a new build lands."""
+    path = os.path.join(app.static_folder, 'dist', 'manifest.json')
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return {}
+    with _asset_manifest_lock:
+        if _asset_manifest['mtime'] != mtime:
+            with open(path) as f:
+                _asset_manifest['files'] = json.load(f)
+            _asset_manifest['mtime'] = mtime
+        return _asset_manifest['files']
+
+@app.template_global()
+def asset_urls(name):
+    """URLs to load for an asset: the built file, or its fallbacks."""
+    hashed = asset_manifest().get(name)
+    if hashed:
+        return [url_for('built_asset', filename=hashed)]
+    return ASSET_FALLBACKS.get(name) or [url_for('static', filename=name)]
+
+@app.template_global()
+def asset_url(name):
+    return asset_urls(name)[0]
+
+@app.route('/static/dist/<path:filename>')
+def built_asset(filename):
+    directory = os.path.join(app.static_folder, 'dist')
+    mimetype = mimetypes.guess_type(filename)[0]
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in request.accept_encodings and os.path.isfile(os.path.join(directory, filename + suffix)):
+            response = send_from_directory(directory, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(directory, filename)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+    return response
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Purge, subset, fingerprint and precompress the static assets into static/dist."""
+    from assets import build_assets
+    manifest = build_assets()
+    for name, hashed in sorted(manifest.items()):
+        click.echo(f'{name} -> {hashed}')
+
+@app.route('/offline')
+def offline():
+    return render_template('offline.html')
+
 @app.route('/logout')
 @login_required
 def logout():
@@ -145,13 +1141,27 @@ def admin():
         flash('Você não tem permissão para acessar essa página', 'danger')
         return redirect(url_for('recipes'))
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT id, username, is_admin FROM users")
     users = c.fetchall()
-    conn.close()
     
-    return render_template('admin.html', users=users)
+    return render_template('admin.html', users=users,
+                           db_stats=db_pool_stats(),
+                           user_cache=user_cache_stats(),
+                           fragment_cache=fragment_cache_stats())
+
+# Prometheus scrape target. Admins can open it in the browser; a scraper sends
+# 'Authorization: Bearer <METRICS_TOKEN>' when that setting is configured.
+app.config['METRICS_TOKEN'] = None
+
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    scraper = token and secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not scraper and not (current_user.is_authenticated and current_user.is_admin):
+        return Response('Forbidden\n', 403, mimetype='text/plain')
+    return Response(prometheus_metrics(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/add_user', methods=['POST'])
 @login_required
@@ -164,7 +1174,7 @@ def add_user():
     password = request.form['password']
     is_admin = 'is_admin' in request.form
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     c = conn.cursor()
     
     try:
@@ -172,11 +1182,10 @@ def add_user():
         c.execute("INSERT INTO users (username, password, is_admin) VALUES (?, ?, ?)",
                  (username, hashed_pw, is_admin))
         conn.commit()
+        invalidate_user_cache(c.lastrowid)
         flash('Usuário adicionado com sucesso', 'success')
     except sqlite3.IntegrityError:
         flash('Usuário já existe', 'danger')
-    finally:
-        conn.close()
     
     return redirect(url_for('admin'))
 
@@ -187,60 +1196,148 @@ def toggle_admin(user_id):
         flash('Permissão negada', 'danger')
         return redirect(url_for('admin'))
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute("UPDATE users SET is_admin = NOT is_admin WHERE id = ?", (user_id,))
     conn.commit()
-    conn.close()
+    invalidate_user_cache(user_id)
     
     flash('Status de admin atualizado', 'success')
     return redirect(url_for('admin'))
     
+# Recipe costing: recipes.unit_cost caches ingredient cost per unit produced.
+# Changing an ingredient, a recipe's links or its yield sets it back to NULL,
+# and recipe_unit_costs() recomputes only the recipes that were invalidated.
+def invalidate_recipe_costs(c, recipe_id=None, ingredient_id=None):
+    if ingredient_id is not None:
+        c.execute("""UPDATE recipes SET unit_cost = NULL
+                     WHERE id IN (SELECT recipe_id FROM recipe_ingredients WHERE ingredient_id = ?)""",
+                  (ingredient_id,))
+    if recipe_id is not None:
+        c.execute("UPDATE recipes SET unit_cost = NULL WHERE id = ?", (recipe_id,))
+
+def recipe_unit_costs(c, recipe_ids=None):
+    """Return {recipe_id: unit_cost}, filling in any invalidated entries.
+
+    Recomputed costs are written back on the caller's connection; the caller commits.
+    """
+    if recipe_ids is None:
+        c.execute("SELECT id, unit_cost FROM recipes")
+    else:
+        recipe_ids = list(recipe_ids)
+        if not recipe_ids:
+            return {}
+        placeholders = ','.join('?' * len(recipe_ids))
+        c.execute(f"SELECT id, unit_cost FROM recipes WHERE id IN ({placeholders})", recipe_ids)
+    costs = dict(c.fetchall())
+
+    stale = [recipe_id for recipe_id, cost in costs.items() if cost is None]
+    if stale:
+        placeholders = ','.join('?' * len(stale))
+        c.execute(f"""SELECT r.id, r.yield,
+                      COALESCE(SUM(i.cost / i.quantity * ri.quantity), 0)
+                      FROM recipes r
+                      LEFT JOIN recipe_ingredients ri ON ri.recipe_id = r.id
+                      LEFT JOIN ingredients i ON i.id = ri.ingredient_id AND i.quantity > 0
+                      WHERE r.id IN ({placeholders})
+                      GROUP BY r.id""", stale)
+        refreshed = []
+        for recipe_id, recipe_yield, total_cost in c.fetchall():
+            costs[recipe_id] = total_cost / recipe_yield if recipe_yield and recipe_yield > 0 else 0
+            refreshed.append((costs[recipe_id], recipe_id))
+        c.executemany("UPDATE recipes SET unit_cost = ? WHERE id = ?", refreshed)
+    return costs
+
 @app.route('/recipes')
 @login_required
 def recipes():
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM recipes")
     recipes = c.fetchall()
-    conn.close()
+    unit_costs = recipe_unit_costs(c, [recipe[0] for recipe in recipes])
+    conn.commit()
     
-    return render_template('recipes.html', recipes=recipes)
+    return render_template('recipes.html', recipes=recipes, unit_costs=unit_costs)
 
 @app.route('/recipe_cost/<int:recipe_id>')
 @login_required
 def recipe_cost(recipe_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     c = conn.cursor()
     
     # Get recipe yield
-    c.execute("SELECT yield FROM recipes WHERE id = ?", (recipe_id,))
-    recipe_yield = c.fetchone()[0]
+    c.execute("SELECT name, yield FROM recipes WHERE id = ?", (recipe_id,))
+    recipe = c.fetchone()
+    if not recipe:
+        flash('Receita não encontrada', 'danger')
+        return redirect(url_for('recipes'))
+    recipe_name, recipe_yield = recipe
     
-    # Calculate total cost
-    c.execute('''SELECT i.name, ri.quantity, i.unit, 
+    # Cost of each ingredient line
+    c.execute('''SELECT i.name, ri.quantity, i.unit, i.id,
                 (i.cost / i.quantity * ri.quantity) AS cost
                 FROM recipe_ingredients ri
                 JOIN ingredients i ON ri.ingredient_id = i.id
-                WHERE ri.recipe_id = ?''', (recipe_id,))
+                WHERE ri.recipe_id = ? AND i.quantity > 0
+                ORDER BY i.name''', (recipe_id,))
     ingredients = c.fetchall()
     
-    total_cost = sum(row[3] for row in ingredients)
-    unit_cost = total_cost / recipe_yield if recipe_yield > 0 else 0
+    total_cost = sum(row[4] for row in ingredients)
+    unit_cost = recipe_unit_costs(c, [recipe_id])[recipe_id]
+    conn.commit()
     
-    conn.close()
+    c.execute("SELECT id, name, unit FROM ingredients ORDER BY name")
+    all_ingredients = c.fetchall()
     
     return render_template('recipe_cost.html',
                          recipe_id=recipe_id,
+                         recipe_name=recipe_name,
                          ingredients=ingredients,
+                         all_ingredients=all_ingredients,
                          total_cost=total_cost,
                          unit_cost=unit_cost,
                          recipe_yield=recipe_yield)
 
+@app.route('/add_recipe_ingredient/<int:recipe_id>', methods=['POST'])
+@login_required
+def add_recipe_ingredient(recipe_id):
+    try:
+        ingredient_id = int(request.form['ingredient_id'])
+        quantity = float(request.form['quantity'].replace(',', '.'))
+    except (KeyError, ValueError):
+        flash('Informe o ingrediente e a quantidade', 'danger')
+        return redirect(url_for('recipe_cost', recipe_id=recipe_id))
+    
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("""INSERT INTO recipe_ingredients (recipe_id, ingredient_id, quantity)
+                 VALUES (?, ?, ?)
+                 ON CONFLICT(recipe_id, ingredient_id) DO UPDATE SET quantity = excluded.quantity""",
+              (recipe_id, ingredient_id, quantity))
+    invalidate_recipe_costs(c, recipe_id=recipe_id)
+    conn.commit()
+    
+    flash('Ingrediente atualizado na receita', 'success')
+    return redirect(url_for('recipe_cost', recipe_id=recipe_id))
+
+@app.route('/remove_recipe_ingredient/<int:recipe_id>/<int:ingredient_id>')
+@login_required
+def remove_recipe_ingredient(recipe_id, ingredient_id):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("DELETE FROM recipe_ingredients WHERE recipe_id = ? AND ingredient_id = ?",
+              (recipe_id, ingredient_id))
+    invalidate_recipe_costs(c, recipe_id=recipe_id)
+    conn.commit()
+    
+    flash('Ingrediente removido da receita', 'success')
+    return redirect(url_for('recipe_cost', recipe_id=recipe_id))
+
 @app.route('/edit_recipe/<int:recipe_id>', methods=['GET', 'POST'])
 @login_required
 def edit_recipe(recipe_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     c = conn.cursor()
     
     if request.method == 'POST':
@@ -248,18 +1345,22 @@ def edit_recipe(recipe_id):
         unit_price = float(request.form['unit_price'].replace(',', '.'))  # Fix here
         box_price = float(request.form['box_price'].replace(',', '.'))    # And here
         description = request.form.get('description', '')
+        try:
+            recipe_yield = max(1, int(request.form.get('yield') or 1))
+        except ValueError:
+            flash('Rendimento inválido. Informe um número inteiro de unidades', 'danger')
+            return redirect(url_for('edit_recipe', recipe_id=recipe_id))
         
-        c.execute("UPDATE recipes SET name = ?, unit_price = ?, box_price = ?, description = ? WHERE id = ?",
-                 (name, unit_price, box_price, description, recipe_id))
+        c.execute("UPDATE recipes SET name = ?, unit_price = ?, box_price = ?, description = ?, yield = ? WHERE id = ?",
+                 (name, unit_price, box_price, description, recipe_yield, recipe_id))
+        invalidate_recipe_costs(c, recipe_id=recipe_id)
         
         conn.commit()
-        conn.close()
         flash('Receita atualizada com sucesso', 'success')
         return redirect(url_for('recipes'))
     
     c.execute("SELECT * FROM recipes WHERE id = ?", (recipe_id,))
     recipe = c.fetchone()
-    conn.close()
     
     if not recipe:
         flash('Receita não encontrada', 'danger')
@@ -270,25 +1371,224 @@ def edit_recipe(recipe_id):
 @app.route('/delete_recipe/<int:recipe_id>')
 @login_required
 def delete_recipe(recipe_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     c = conn.cursor()
+    c.execute("DELETE FROM recipe_ingredients WHERE recipe_id = ?", (recipe_id,))
     c.execute("DELETE FROM recipes WHERE id = ?", (recipe_id,))
     conn.commit()
-    conn.close()
     
     flash('Receita removida', 'success')
     return redirect(url_for('recipes'))
+
+@app.route('/ingredients')
+@login_required
+def ingredients():
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT * FROM ingredients ORDER BY name")
+    ingredients = c.fetchall()
+    
+    return render_template('ingredients.html', ingredients=ingredients)
+
+@app.route('/add_ingredient', methods=['POST'])
+@login_required
+def add_ingredient():
+    name = request.form['name']
+    unit = request.form['unit']
+    quantity = float(request.form['quantity'].replace(',', '.'))
+    cost = float(request.form['cost'].replace(',', '.'))
+    
+    if quantity <= 0:
+        flash('A quantidade deve ser maior que zero', 'danger')
+        return redirect(url_for('ingredients'))
+    
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("INSERT INTO ingredients (name, unit, quantity, cost, created_by) VALUES (?, ?, ?, ?, ?)",
+             (name, unit, quantity, cost, current_user.id))
+    conn.commit()
+    
+    flash('Ingrediente adicionado com sucesso', 'success')
+    return redirect(url_for('ingredients'))
+
+@app.route('/edit_ingredient/<int:ingredient_id>', methods=['GET', 'POST'])
+@login_required
+def edit_ingredient(ingredient_id):
+    conn = get_db()
+    c = conn.cursor()
+    
+    if request.method == 'POST':
+        name = request.form['name']
+        unit = request.form['unit']
+        quantity = float(request.form['quantity'].replace(',', '.'))
+        cost = float(request.form['cost'].replace(',', '.'))
+        
+        if quantity <= 0:
+            flash('A quantidade deve ser maior que zero', 'danger')
+            return redirect(url_for('edit_ingredient', ingredient_id=ingredient_id))
+        
+        c.execute("UPDATE ingredients SET name = ?, unit = ?, quantity = ?, cost = ? WHERE id = ?",
+                 (name, unit, quantity, cost, ingredient_id))
+        # Price or pack size changed: every recipe using it needs a new unit cost
+        invalidate_recipe_costs(c, ingredient_id=ingredient_id)
+        conn.commit()
+        flash('Ingrediente atualizado com sucesso', 'success')
+        return redirect(url_for('ingredients'))
+    
+    c.execute("SELECT * FROM ingredients WHERE id = ?", (ingredient_id,))
+    ingredient = c.fetchone()
+    
+    if not ingredient:
+        flash('Ingrediente não encontrado', 'danger')
+        return redirect(url_for('ingredients'))
+    
+    return render_template('edit_ingredient.html', ingredient=ingredient)
+
+@app.route('/delete_ingredient/<int:ingredient_id>')
+@login_required
+def delete_ingredient(ingredient_id):
+    conn = get_db()
+    c = conn.cursor()
+    invalidate_recipe_costs(c, ingredient_id=ingredient_id)
+    c.execute("DELETE FROM recipe_ingredients WHERE ingredient_id = ?", (ingredient_id,))
+    c.execute("DELETE FROM ingredients WHERE id = ?", (ingredient_id,))
+    conn.commit()
     
+    flash('Ingrediente removido', 'success')
+    return redirect(url_for('ingredients'))
+    
+# Expenses are paged and filtered in SQL: by category and month range on
+# idx_expenses_category_date, or on idx_expenses_date for all categories, with
+# a keyset cursor on (date, id) like /sales. The totals shown for the filter
+# come from expense_totals.
+EXPENSES_PER_PAGE = 10
+RECURRING_PERIODS = {'monthly': 'Mensal', 'weekly': 'Semanal', 'yearly': 'Anual'}
+
+def parse_month(value):
+    # Months look like "YYYY-MM", as sent by <input type="month">
+    return value if value and re.fullmatch(r'\d{4}-(0[1-9]|1[0-2])', value) else ''
+
+def next_month(month):
+    year, month = map(int, month.split('-'))
+    return f'{year + month // 12:04d}-{month % 12 + 1:02d}'
+
+def expense_categories(c):
+    c.execute("SELECT id, name, monthly_budget FROM expense_categories ORDER BY name")
+    return c.fetchall()
+
+def parse_category_id(c, value):
+    """Return the category id for a form or API value (None for no category);
+    raise ValueError for an unknown category."""
+    if value in (None, ''):
+        return None
+    category_id = int(value)
+    c.execute("SELECT 1 FROM expense_categories WHERE id = ?", (category_id,))
+    if not c.fetchone():
+        raise ValueError('categoria não encontrada')
+    return category_id
+
+def expense_filter(category, start, end):
+    """SQL conditions on expenses e and on expense_totals t for a filter."""
+    conditions, params, total_conditions, total_params = [], [], [], []
+    if category == 'none':
+        conditions.append('e.category_id IS NULL')
+        total_conditions.append('t.category_id = 0')
+    elif category:
+        conditions.append('e.category_id = ?')
+        params.append(int(category))
+        total_conditions.append('t.category_id = ?')
+        total_params.append(int(category))
+    if start:
+        conditions.append('e.date >= ?')
+        params.append(f'{start}-01')
+        total_conditions.append('t.month >= ?')
+        total_params.append(start)
+    if end:
+        conditions.append('e.date < ?')
+        params.append(f'{next_month(end)}-01')
+        total_conditions.append('t.month <= ?')
+        total_params.append(end)
+    return (' AND '.join(conditions) or '1', params,
+            ' AND '.join(total_conditions) or '1', total_params)
+
+def fetch_expenses_page(c, where, params, after=None, before=None, per_page=EXPENSES_PER_PAGE):
+    """Fetch one page of expenses using a keyset cursor on (date, id).
+
+    Returns (rows, prev_cursor, next_cursor); cursors are None at the edges.
+    """
+    query = f'''SELECT e.id, e.amount, e.description, e.date, ec.name
+                FROM expenses e
+                LEFT JOIN expense_categories ec ON ec.id = e.category_id
+                WHERE {where}'''
+    if before:
+        query += ' AND (e.date, e.id) > (?, ?) ORDER BY e.date ASC, e.id ASC LIMIT ?'
+        params = [*params, before[0], before[1], per_page + 1]
+    elif after:
+        query += ' AND (e.date, e.id) < (?, ?) ORDER BY e.date DESC, e.id DESC LIMIT ?'
+        params = [*params, after[0], after[1], per_page + 1]
+    else:
+        query += ' ORDER BY e.date DESC, e.id DESC LIMIT ?'
+        params = [*params, per_page + 1]
+
+    c.execute(query, params)
+    rows = c.fetchall()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    if before:
+        if not has_more:
+            return fetch_expenses_page(c, where, params[:-3], per_page=per_page)
+        rows.reverse()
+        has_prev, has_next = True, True
+    else:
+        has_prev, has_next = after is not None, has_more
+
+    prev_cursor = f'{rows[0][3]}_{rows[0][0]}' if rows and has_prev else None
+    next_cursor = f'{rows[-1][3]}_{rows[-1][0]}' if rows and has_next else None
+    return rows, prev_cursor, next_cursor
+
+def expenses_page_url(direction, cursor):
+    args = request.args.to_dict()
+    args.pop('after', None)
+    args.pop('before', None)
+    args[direction] = cursor
+    return url_for('expenses', **args)
+
 @app.route('/expenses')
 @login_required
 def expenses():
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     c = conn.cursor()
-    c.execute("SELECT * FROM expenses ORDER BY date DESC")
-    expenses = c.fetchall()
-    conn.close()
-    
-    return render_template('expenses.html', expenses=expenses, datetime=datetime)
+    category = request.args.get('category', '')
+    if category != 'none' and not category.isdigit():
+        category = ''
+    start = parse_month(request.args.get('start'))
+    end = parse_month(request.args.get('end'))
+    where, params, total_where, total_params = expense_filter(category, start, end)
+
+    expenses, prev_cursor, next_cursor = fetch_expenses_page(
+        c, where, params,
+        after=parse_sales_cursor(request.args.get('after')),
+        before=parse_sales_cursor(request.args.get('before')))
+
+    # Totals per category for the filter, from the monthly rollup
+    c.execute(f"""SELECT t.category_id, ec.name, SUM(t.amount), SUM(t.expenses_count)
+                  FROM expense_totals t
+                  LEFT JOIN expense_categories ec ON ec.id = t.category_id
+                  WHERE {total_where}
+                  GROUP BY t.category_id
+                  ORDER BY SUM(t.amount) DESC""", total_params)
+    category_totals = c.fetchall()
+
+    return render_template('expenses.html', expenses=expenses,
+                           categories=expense_categories(c),
+                           category_totals=category_totals,
+                           total_amount=sum(row[2] for row in category_totals),
+                           total_count=sum(row[3] for row in category_totals),
+                           category=category, start=start, end=end,
+                           prev_url=expenses_page_url('before', prev_cursor) if prev_cursor else None,
+                           next_url=expenses_page_url('after', next_cursor) if next_cursor else None,
+                           datetime=datetime)
 
 @app.route('/add_expense', methods=['POST'])
 @login_required
@@ -297,12 +1597,17 @@ def add_expense():
     description = request.form['description']
     date = datetime.strptime(request.form.get('date', datetime.now().strftime('%d/%m/%Y')), '%d/%m/%Y').strftime('%Y-%m-%d')
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     c = conn.cursor()
-    c.execute("INSERT INTO expenses (amount, description, date, created_by) VALUES (?, ?, ?, ?)",
-             (amount, description, date, current_user.id))
+    try:
+        category_id = parse_category_id(c, request.form.get('category_id'))
+    except ValueError as e:
+        flash(f'Erro ao incluir gasto: {str(e)}', 'danger')
+        return redirect(url_for('expenses'))
+    c.execute("INSERT INTO expenses (amount, description, date, category_id, created_by) VALUES (?, ?, ?, ?, ?)",
+             (amount, description, date, category_id, current_user.id))
+    bump_expense_totals(c, c.lastrowid)
     conn.commit()
-    conn.close()
     
     flash('Gasto incluido com sucesso', 'success')
     return redirect(url_for('expenses'))
@@ -311,153 +1616,521 @@ def add_expense():
 @app.route('/edit_expense/<int:expense_id>', methods=['GET', 'POST'])
 @login_required
 def edit_expense(expense_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     c = conn.cursor()
     
     if request.method == 'POST':
         amount = float(request.form['amount'])
         description = request.form['description']
         date = datetime.strptime(request.form['date'], '%d/%m/%Y').strftime('%Y-%m-%d')
+        try:
+            category_id = parse_category_id(c, request.form.get('category_id'))
+        except ValueError as e:
+            flash(f'Erro ao atualizar gasto: {str(e)}', 'danger')
+            return redirect(url_for('edit_expense', expense_id=expense_id))
         
-        c.execute("UPDATE expenses SET amount = ?, description = ?, date = ? WHERE id = ?",
-                 (amount, description, date, expense_id))
+        bump_expense_totals(c, expense_id, -1)
+        c.execute("UPDATE expenses SET amount = ?, description = ?, date = ?, category_id = ? WHERE id = ?",
+                 (amount, description, date, category_id, expense_id))
+        bump_expense_totals(c, expense_id)
         conn.commit()
-        conn.close()
         flash('Gasto atualizado com sucesso', 'success')
         return redirect(url_for('expenses'))
     
-    c.execute("SELECT * FROM expenses WHERE id = ?", (expense_id,))
+    c.execute("SELECT id, amount, description, date, category_id FROM expenses WHERE id = ?", (expense_id,))
     expense = c.fetchone()
-    conn.close()
     
     if not expense:
         flash('Gasto não localizado', 'danger')
         return redirect(url_for('expenses'))
     
     # Convert date to DD/MM/YYYY format
-    expense_date = datetime.strptime(expense[3], '%Y-%m-%d').strftime('%d/%m/%Y') if expense[3] else ''
+    expense_date = datetime.strptime(expense[3][:10], '%Y-%m-%d').strftime('%d/%m/%Y') if expense[3] else ''
     expense = list(expense)
     expense[3] = expense_date
     
-    return render_template('edit_expense.html', expense=expense)
+    return render_template('edit_expense.html', expense=expense, categories=expense_categories(c))
 
 @app.route('/delete_expense/<int:expense_id>')
 @login_required
 def delete_expense(expense_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     c = conn.cursor()
+    bump_expense_totals(c, expense_id, -1)
     c.execute("DELETE FROM expenses WHERE id = ?", (expense_id,))
     conn.commit()
-    conn.close()
     
     flash('Gasto apagado', 'success')
     return redirect(url_for('expenses'))    
 
-@app.route('/sales')
+# Recurring expenses are templates materialized into expenses when due, by the
+# daily recurring_expenses job and right after a template is added. The n-th
+# date is computed from start_date (a monthly bill on the 31st falls on the
+# last day of shorter months and is back on the 31st after), and the unique
+# index on (recurring_id, date) keeps a date from being created twice.
+def recurring_date(start, period, n):
+    if period == 'weekly':
+        return start + timedelta(weeks=n)
+    months = start.month - 1 + n * (12 if period == 'yearly' else 1)
+    year, month = start.year + months // 12, months % 12 + 1
+    return start.replace(year=year, month=month, day=min(start.day, calendar.monthrange(year, month)[1]))
+
+def recurring_index(start, period, day):
+    # Which occurrence day is, for a day produced by recurring_date()
+    if period == 'weekly':
+        return (day - start).days // 7
+    months = (day.year - start.year) * 12 + day.month - start.month
+    return months // 12 if period == 'yearly' else months
+
+def materialize_recurring_expenses(c, today=None):
+    """Create the expenses due up to today (YYYY-MM-DD) from the recurring
+    templates, on the caller's transaction; return how many were created."""
+    today = today or datetime.now().strftime('%Y-%m-%d')
+    c.execute("""SELECT id, description, amount, category_id, period, start_date, end_date,
+                        next_date, created_by
+                 FROM recurring_expenses
+                 WHERE next_date <= ? AND (end_date IS NULL OR next_date <= end_date)""", (today,))
+    created = 0
+    for (recurring_id, description, amount, category_id, period, start_date, end_date,
+         next_date, created_by) in c.fetchall():
+        start = datetime.strptime(start_date, '%Y-%m-%d')
+        n = recurring_index(start, period, datetime.strptime(next_date, '%Y-%m-%d'))
+        while next_date <= today and (not end_date or next_date <= end_date):
+            c.execute("""INSERT OR IGNORE INTO expenses
+                         (amount, description, date, category_id, recurring_id, created_by)
+                         VALUES (?, ?, ?, ?, ?, ?)""",
+                      (amount, description, next_date, category_id, recurring_id, created_by))
+            if c.rowcount == 1:
+                bump_expense_totals(c, c.lastrowid)
+                created += 1
+            n += 1
+            next_date = recurring_date(start, period, n).strftime('%Y-%m-%d')
+        c.execute("UPDATE recurring_expenses SET next_date = ? WHERE id = ?", (next_date, recurring_id))
+    return created
+
+# Budgets: spending per category in a month against its monthly_budget
+@app.route('/budgets')
 @login_required
-def sales():
-    conn = sqlite3.connect('database.db')
-    c = conn.cursor()
-    
-    # Get sales with item counts
-    c.execute('''SELECT s.id, s.customer_name, s.total_amount, 
-                s.is_delivered, s.is_paid, s.date, s.delivery_cost, s.delivery_date
-                FROM sales s
-                ORDER BY s.date DESC''')
-    sales_data = c.fetchall()
-    
-    # Get all sale items
-    c.execute('''SELECT si.sale_id, si.quantity, r.name 
-                FROM sales_items si
-                JOIN recipes r ON si.recipe_id = r.id''')
-    sale_items = c.fetchall()
-    
-    # Get recipes for the form
-    c.execute("SELECT id, name, unit_price, box_price FROM recipes")
-    recipes = c.fetchall()
-    
-    conn.close()
-    
-    return render_template('sales.html', 
-                     sales=sales_data, 
-                     sale_items=sale_items,
-                     recipes=recipes,
-                     datetime=datetime)
+def budgets():
+    month = parse_month(request.args.get('month')) or datetime.now().strftime('%Y-%m')
+    c = get_db().cursor()
+    c.execute("""SELECT ec.id, ec.name, ec.monthly_budget,
+                        COALESCE(t.amount, 0), COALESCE(t.expenses_count, 0)
+                 FROM expense_categories ec
+                 LEFT JOIN expense_totals t ON t.category_id = ec.id AND t.month = ?
+                 ORDER BY ec.name""", (month,))
+    rows = [(*row, row[3] / row[2] * 100 if row[2] else None) for row in c.fetchall()]
+    c.execute("SELECT amount, expenses_count FROM expense_totals WHERE category_id = 0 AND month = ?",
+              (month,))
+    uncategorized = c.fetchone() or (0, 0)
 
-@app.route('/add_sale', methods=['POST'])
+    c.execute("""SELECT r.id, r.description, r.amount, ec.name, r.period, r.start_date,
+                        r.end_date, r.next_date
+                 FROM recurring_expenses r
+                 LEFT JOIN expense_categories ec ON ec.id = r.category_id
+                 ORDER BY r.next_date, r.id""")
+    recurring = c.fetchall()
+
+    return render_template('budgets.html', month=month, rows=rows, uncategorized=uncategorized,
+                           total_budget=sum(row[2] or 0 for row in rows),
+                           total_spent=sum(row[3] for row in rows) + uncategorized[0],
+                           categories=expense_categories(c), recurring=recurring,
+                           periods=RECURRING_PERIODS, datetime=datetime)
+
+def parse_budget(value):
+    value = (value or '').strip().replace(',', '.')
+    return float(value) if value else None
+
+@app.route('/add_expense_category', methods=['POST'])
 @login_required
-def add_sale():
+def add_expense_category():
+    conn = get_db()
+    c = conn.cursor()
     try:
-        customer_name = request.form.get('customer_name', '')
-        recipe_ids = request.form.getlist('recipe_id[]')
-        quantities = request.form.getlist('quantity[]')
-        delivery_cost = float(request.form.get('delivery_cost', '0').replace(',', '.'))
-        date_str = request.form.get('date', datetime.now().strftime('%d/%m/%Y'))
-        date = datetime.strptime(date_str, '%d/%m/%Y').strftime('%Y-%m-%d')
-        delivery_date_str = request.form.get('delivery_date', datetime.now().strftime('%d/%m/%Y'))
-        delivery_date = datetime.strptime(delivery_date_str, '%d/%m/%Y').strftime('%Y-%m-%d')
-
-        if not recipe_ids or not all(recipe_ids):
-            flash('Por favor selecione ao menos 1 receita', 'danger')
-            return redirect(url_for('sales'))
-        
-        conn = sqlite3.connect('database.db')
-        c = conn.cursor()
-        
-        # Insert the sale - Updated to include delivery_date
-        c.execute("""INSERT INTO sales 
-                    (customer_name, total_amount, delivery_cost,
-                     is_delivered, is_paid, date, delivery_date, created_by)
-                    VALUES (?, 0, ?, ?, ?, ?, ?, ?)""",
-                 (customer_name, delivery_cost,
-                  'is_delivered' in request.form, 
-                  'is_paid' in request.form,
-                  date, 
-                  delivery_date,
-                  current_user.id))  # Added delivery_date here
-        
-        sale_id = c.lastrowid
-        total_amount = 0
-        
-        # Insert each recipe item
-        for recipe_id, quantity in zip(recipe_ids, quantities):
-            recipe_id = int(recipe_id)
-            quantity = int(quantity)
-            
-            # Get prices
-            c.execute("SELECT unit_price, box_price FROM recipes WHERE id = ?", (recipe_id,))
-            unit_price, box_price = c.fetchone()
-            
-            # Calculate subtotal for this item
-            boxes = quantity // 6
-            units = quantity % 6
-            item_subtotal = (boxes * box_price) + (units * unit_price)
-            total_amount += item_subtotal
-            
-            c.execute("""INSERT INTO sales_items
-                        (sale_id, recipe_id, quantity, unit_price, box_price)
-                        VALUES (?, ?, ?, ?, ?)""",
-                     (sale_id, recipe_id, quantity, unit_price, box_price))
-        
-        # Update total amount with delivery
-        total_amount += delivery_cost
-        c.execute("UPDATE sales SET total_amount = ? WHERE id = ?", (total_amount, sale_id))
-        
+        c.execute("INSERT INTO expense_categories (name, monthly_budget) VALUES (?, ?)",
+                  (request.form['name'].strip(), parse_budget(request.form.get('monthly_budget'))))
         conn.commit()
-        conn.close()
-        flash('Venda adicionada com sucesso', 'success')
-    except Exception as e:
-        flash(f'Erro ao adicionar venda: {str(e)}', 'danger')
-    
-    return redirect(url_for('sales'))
+        flash('Categoria incluída com sucesso', 'success')
+    except (ValueError, sqlite3.IntegrityError) as e:
+        conn.rollback()
+        flash(f'Erro ao incluir categoria: {str(e)}', 'danger')
+    return redirect(url_for('budgets'))
 
-@app.route('/edit_sale/<int:sale_id>', methods=['GET', 'POST'])
+@app.route('/edit_expense_category/<int:category_id>', methods=['POST'])
 @login_required
-def edit_sale(sale_id):
-    conn = sqlite3.connect('database.db')
+def edit_expense_category(category_id):
+    conn = get_db()
     c = conn.cursor()
-    
-    if request.method == 'POST':
+    try:
+        c.execute("UPDATE expense_categories SET name = ?, monthly_budget = ? WHERE id = ?",
+                  (request.form['name'].strip(), parse_budget(request.form.get('monthly_budget')),
+                   category_id))
+        conn.commit()
+        flash('Categoria atualizada com sucesso', 'success')
+    except (ValueError, sqlite3.IntegrityError) as e:
+        conn.rollback()
+        flash(f'Erro ao atualizar categoria: {str(e)}', 'danger')
+    return redirect(url_for('budgets', month=request.form.get('month')))
+
+@app.route('/delete_expense_category/<int:category_id>')
+@login_required
+def delete_expense_category(category_id):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    # Its expenses stay, without a category, and so do their totals
+    c.execute("UPDATE expenses SET category_id = NULL WHERE category_id = ?", (category_id,))
+    c.execute("UPDATE recurring_expenses SET category_id = NULL WHERE category_id = ?", (category_id,))
+    c.execute("""INSERT INTO expense_totals (category_id, month, amount, expenses_count)
+                 SELECT 0, month, amount, expenses_count FROM expense_totals WHERE category_id = ?
+                 ON CONFLICT(category_id, month) DO UPDATE SET
+                     amount = amount + excluded.amount,
+                     expenses_count = expenses_count + excluded.expenses_count""", (category_id,))
+    c.execute("DELETE FROM expense_totals WHERE category_id = ?", (category_id,))
+    c.execute("DELETE FROM expense_categories WHERE id = ?", (category_id,))
+    conn.commit()
+
+    flash('Categoria removida', 'success')
+    return redirect(url_for('budgets'))
+
+@app.route('/add_recurring_expense', methods=['POST'])
+@login_required
+def add_recurring_expense():
+    conn = get_db()
+    c = conn.cursor()
+    try:
+        amount = float(request.form['amount'].replace(',', '.'))
+        period = request.form.get('period', 'monthly')
+        if period not in RECURRING_PERIODS:
+            raise ValueError(f'período inválido: {period}')
+        start_date = datetime.strptime(request.form['start_date'], '%d/%m/%Y').strftime('%Y-%m-%d')
+        end_date = request.form.get('end_date')
+        end_date = datetime.strptime(end_date, '%d/%m/%Y').strftime('%Y-%m-%d') if end_date else None
+        category_id = parse_category_id(c, request.form.get('category_id'))
+    except ValueError as e:
+        flash(f'Erro ao incluir despesa recorrente: {str(e)}', 'danger')
+        return redirect(url_for('budgets'))
+
+    c.execute('BEGIN IMMEDIATE')
+    c.execute("""INSERT INTO recurring_expenses
+                 (description, amount, category_id, period, start_date, end_date, next_date, created_by)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+              (request.form['description'], amount, category_id, period, start_date, end_date,
+               start_date, current_user.id))
+    # Dates already due (a start in the past) are created right away
+    created = materialize_recurring_expenses(c)
+    conn.commit()
+
+    flash(f'Despesa recorrente incluída ({created} lançamentos criados)', 'success')
+    return redirect(url_for('budgets'))
+
+@app.route('/delete_recurring_expense/<int:recurring_id>')
+@login_required
+def delete_recurring_expense(recurring_id):
+    conn = get_db()
+    c = conn.cursor()
+    # The expenses it already created are kept
+    c.execute("UPDATE expenses SET recurring_id = NULL WHERE recurring_id = ?", (recurring_id,))
+    c.execute("DELETE FROM recurring_expenses WHERE id = ?", (recurring_id,))
+    conn.commit()
+
+    flash('Despesa recorrente removida', 'success')
+    return redirect(url_for('budgets'))
+
+# Sale pricing: full boxes at box_price, the rest at unit_price
+BOX_SIZE = 6
+
+def sale_item_subtotal(quantity, unit_price, box_price):
+    boxes = quantity // BOX_SIZE
+    units = quantity % BOX_SIZE
+    return (boxes * box_price) + (units * unit_price)
+
+def price_sale_items(c, recipe_ids, quantities):
+    """Price the submitted sale lines with a single recipe lookup.
+
+    Returns ([(recipe_id, quantity, unit_price, box_price, unit_cost), ...], subtotal),
+    with the recipe's current unit cost snapshotted on each line.
+    Raises ValueError if a line references a recipe that doesn't exist.
+    """
+    lines = [(int(recipe_id), int(quantity))
+             for recipe_id, quantity in zip(recipe_ids, quantities)
+             if recipe_id and quantity]
+    if not lines:
+        return [], 0
+
+    recipe_ids = sorted({recipe_id for recipe_id, _ in lines})
+    placeholders = ','.join('?' * len(recipe_ids))
+    c.execute(f"SELECT id, unit_price, box_price, unit_cost FROM recipes WHERE id IN ({placeholders})",
+              recipe_ids)
+    prices = {row[0]: row[1:] for row in c.fetchall()}
+
+    missing = [str(recipe_id) for recipe_id in recipe_ids if recipe_id not in prices]
+    if missing:
+        raise ValueError(f'Receita não encontrada: {", ".join(missing)}')
+
+    stale = [recipe_id for recipe_id, price in prices.items() if price[2] is None]
+    if stale:
+        for recipe_id, unit_cost in recipe_unit_costs(c, stale).items():
+            prices[recipe_id] = prices[recipe_id][:2] + (unit_cost,)
+
+    items = []
+    subtotal = 0
+    for recipe_id, quantity in lines:
+        unit_price, box_price, unit_cost = prices[recipe_id]
+        subtotal += sale_item_subtotal(quantity, unit_price, box_price)
+        items.append((recipe_id, quantity, unit_price, box_price, unit_cost))
+    return items, subtotal
+
+def insert_sale_items(c, sale_id, items):
+    c.executemany("""INSERT INTO sales_items
+                     (sale_id, recipe_id, quantity, unit_price, box_price, unit_cost)
+                     VALUES (?, ?, ?, ?, ?, ?)""",
+                  [(sale_id,) + item for item in items])
+
+def save_sale(c, sale, items, subtotal, sale_id=None, created_by=None):
+    """Insert a new sale, or update sale_id, keeping the rollups in step.
+
+    sale holds customer_name, delivery_cost, is_delivered, is_paid, date and
+    delivery_date. items come from price_sale_items(); when updating, items=None
+    keeps the current lines and subtotal must be their current total.
+    Runs on the caller's transaction and returns the sale id.
+    """
+    total_amount = subtotal + sale['delivery_cost']
+    customer_id = customer_id_for(c, sale['customer_name'])
+    if sale_id is None:
+        c.execute("""INSERT INTO sales
+                    (customer_name, customer_id, total_amount, delivery_cost,
+                     is_delivered, is_paid, date, delivery_date, created_by)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                 (sale['customer_name'], customer_id, total_amount, sale['delivery_cost'],
+                  sale['is_delivered'], sale['is_paid'],
+                  sale['date'], sale['delivery_date'], created_by))
+        sale_id = c.lastrowid
+    else:
+        c.execute("SELECT 1 FROM sales WHERE id = ?", (sale_id,))
+        if not c.fetchone():
+            raise ValueError('venda não encontrada')
+        # Take the old version out of the rollups before changing it
+        bump_sale_totals(c, sale_id, -1)
+        if items is not None:
+            c.execute("DELETE FROM sales_items WHERE sale_id = ?", (sale_id,))
+        c.execute("""UPDATE sales
+                    SET customer_name = ?, customer_id = ?, total_amount = ?, delivery_cost = ?,
+                        is_delivered = ?, is_paid = ?, date = ?, delivery_date = ?
+                    WHERE id = ?""",
+                 (sale['customer_name'], customer_id, total_amount, sale['delivery_cost'],
+                  sale['is_delivered'], sale['is_paid'],
+                  sale['date'], sale['delivery_date'], sale_id))
+    if items is not None:
+        insert_sale_items(c, sale_id, items)
+    bump_sale_totals(c, sale_id)
+    return sale_id
+
+# Idempotency keys: the offline queue in the service worker replays add_sale and
+# toggle_sale_status until they get through, so a submission can reach us twice.
+# Each one carries a client-generated key (Idempotency-Key header or an
+# idempotency_key form field) that is claimed in the same transaction as the write.
+IDEMPOTENCY_KEY_DAYS = 30
+
+def idempotency_key():
+    key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+    key = (key or '').strip()
+    return key[:200] or None
+
+def claim_idempotency_key(c, key):
+    """Record key on the caller's transaction; False if it was already used."""
+    if key is None:
+        return True
+    c.execute("DELETE FROM idempotency_keys WHERE created_at < datetime('now', ?)",
+              (f'-{IDEMPOTENCY_KEY_DAYS} days',))
+    c.execute("INSERT OR IGNORE INTO idempotency_keys (key, user_id) VALUES (?, ?)",
+              (key, current_user.id))
+    return c.rowcount == 1
+
+def remember_idempotent_record(c, key, record_id):
+    if key is not None:
+        c.execute("UPDATE idempotency_keys SET record_id = ? WHERE key = ?", (record_id, key))
+
+def idempotent_record(c, key):
+    c.execute("SELECT record_id FROM idempotency_keys WHERE key = ?", (key,))
+    row = c.fetchone()
+    return row[0] if row else None
+
+# Sales listing sections and their filters
+SALES_PER_PAGE = 10
+SALES_SECTIONS = {
+    'pending': 's.is_delivered = 0',
+    'unpaid': 's.is_delivered = 1 AND s.is_paid = 0',
+    'completed': 's.is_delivered = 1 AND s.is_paid = 1',
+}
+
+def parse_sales_cursor(value):
+    # Cursors look like "YYYY-MM-DD_id"
+    try:
+        date, sale_id = value.rsplit('_', 1)
+        return date, int(sale_id)
+    except (AttributeError, ValueError):
+        return None
+
+def fetch_sales_page(c, section, after=None, before=None, per_page=SALES_PER_PAGE, table='sales'):
+    """Fetch one page of a sales section using a keyset cursor on (date, id).
+
+    Returns (rows, prev_cursor, next_cursor); cursors are None at the edges.
+    The last column of each row is 1 for archived (read-only) sales.
+    """
+    archived = 's.archived' if table == 'all_sales' else '0'
+    query = f'''SELECT s.id, s.customer_name, s.total_amount,
+                s.is_delivered, s.is_paid, s.date, s.delivery_cost, s.delivery_date,
+                {archived} AS archived
+                FROM {table} s
+                WHERE {SALES_SECTIONS[section]}'''
+    params = []
+
+    if before:
+        # Walk backwards from the cursor, then flip the page back into DESC order
+        query += ' AND (s.date, s.id) > (?, ?) ORDER BY s.date ASC, s.id ASC LIMIT ?'
+        params = [before[0], before[1], per_page + 1]
+    elif after:
+        query += ' AND (s.date, s.id) < (?, ?) ORDER BY s.date DESC, s.id DESC LIMIT ?'
+        params = [after[0], after[1], per_page + 1]
+    else:
+        query += ' ORDER BY s.date DESC, s.id DESC LIMIT ?'
+        params = [per_page + 1]
+
+    c.execute(query, params)
+    rows = c.fetchall()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    if before:
+        if not has_more:
+            # Reached the newest sales, show a full first page instead
+            return fetch_sales_page(c, section, per_page=per_page, table=table)
+        rows.reverse()
+        has_prev, has_next = True, True
+    else:
+        has_prev, has_next = after is not None, has_more
+
+    prev_cursor = f'{rows[0][5]}_{rows[0][0]}' if rows and has_prev else None
+    next_cursor = f'{rows[-1][5]}_{rows[-1][0]}' if rows and has_next else None
+    return rows, prev_cursor, next_cursor
+
+def fetch_sale_items(c, sale_ids, table='sales_items'):
+    """Return {sale_id: [(sale_id, quantity, recipe_name), ...]} for the given sales."""
+    items = {}
+    if not sale_ids:
+        return items
+    placeholders = ','.join('?' * len(sale_ids))
+    c.execute(f'''SELECT si.sale_id, si.quantity, r.name
+                FROM {table} si
+                JOIN recipes r ON si.recipe_id = r.id
+                WHERE si.sale_id IN ({placeholders})
+                ORDER BY si.id''', sale_ids)
+    for row in c.fetchall():
+        items.setdefault(row[0], []).append(row)
+    return items
+
+def sales_page_url(section, direction, cursor):
+    # Keep the other sections' cursors when moving through one section
+    args = request.args.to_dict()
+    args.pop(f'{section}_after', None)
+    args.pop(f'{section}_before', None)
+    args[f'{section}_{direction}'] = cursor
+    return url_for('sales', **args)
+
+@app.route('/sales')
+@login_required
+def sales():
+    conn = get_db()
+    c = conn.cursor()
+
+    # Get one page per section, filtered and paginated in SQL
+    sections = {}
+    archived = archived_through(c)
+    items_table = 'sales_items'
+    for section in SALES_SECTIONS:
+        after = parse_sales_cursor(request.args.get(f'{section}_after'))
+        before = parse_sales_cursor(request.args.get(f'{section}_before'))
+        rows, prev_cursor, next_cursor = fetch_sales_page(c, section, after=after, before=before)
+        # Closed sales dated up to archived may be in the archive: read the
+        # page again through the views when it reaches back that far
+        if (archived and section == 'completed'
+                and (next_cursor is None or rows[-1][5] <= archived or before and before[0] <= archived)):
+            sales_table, items_table = sales_tables(c)
+            rows, prev_cursor, next_cursor = fetch_sales_page(c, section, after=after, before=before,
+                                                              table=sales_table)
+        sections[section] = {
+            'sales': rows,
+            'prev_url': sales_page_url(section, 'before', prev_cursor) if prev_cursor else None,
+            'next_url': sales_page_url(section, 'after', next_cursor) if next_cursor else None,
+        }
+
+    # Get items only for the sales on this page, grouped by sale id
+    sale_ids = [sale[0] for page in sections.values() for sale in page['sales']]
+    sale_items = fetch_sale_items(c, sale_ids, items_table)
+    
+    # The recipe picker is a cached fragment, see recipe_picker.html
+    return render_template('sales.html',
+                     sections=sections,
+                     sale_items=sale_items,
+                     datetime=datetime)
+
+@app.route('/add_sale', methods=['POST'])
+@login_required
+def add_sale():
+    try:
+        customer_name = request.form.get('customer_name', '')
+        recipe_ids = request.form.getlist('recipe_id[]')
+        quantities = request.form.getlist('quantity[]')
+        delivery_cost = float(request.form.get('delivery_cost', '0').replace(',', '.'))
+        date_str = request.form.get('date', datetime.now().strftime('%d/%m/%Y'))
+        date = datetime.strptime(date_str, '%d/%m/%Y').strftime('%Y-%m-%d')
+        delivery_date_str = request.form.get('delivery_date', datetime.now().strftime('%d/%m/%Y'))
+        delivery_date = datetime.strptime(delivery_date_str, '%d/%m/%Y').strftime('%Y-%m-%d')
+
+        if not recipe_ids or not all(recipe_ids):
+            flash('Por favor selecione ao menos 1 receita', 'danger')
+            return redirect(url_for('sales'))
+        
+        conn = get_db()
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        
+        try:
+            key = idempotency_key()
+            if not claim_idempotency_key(c, key):
+                conn.rollback()
+                flash('Venda já registrada', 'info')
+                return redirect(url_for('sales'))
+            
+            # Price every line first so the sale is inserted with its final total
+            items, subtotal = price_sale_items(c, recipe_ids, quantities)
+            sale_id = save_sale(c, {'customer_name': customer_name,
+                          'delivery_cost': delivery_cost,
+                          'is_delivered': 'is_delivered' in request.form,
+                          'is_paid': 'is_paid' in request.form,
+                          'date': date,
+                          'delivery_date': delivery_date},
+                      items, subtotal, created_by=current_user.id)
+            remember_idempotent_record(c, key, sale_id)
+            
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        flash('Venda adicionada com sucesso', 'success')
+    except Exception as e:
+        flash(f'Erro ao adicionar venda: {str(e)}', 'danger')
+    
+    return redirect(url_for('sales'))
+
+@app.route('/edit_sale/<int:sale_id>', methods=['GET', 'POST'])
+@login_required
+def edit_sale(sale_id):
+    conn = get_db()
+    c = conn.cursor()
+    
+    if request.method == 'POST':
         customer_name = request.form.get('customer_name', '')
         recipe_ids = request.form.getlist('recipe_id[]')
         quantities = request.form.getlist('quantity[]')
@@ -473,59 +2146,35 @@ def edit_sale(sale_id):
             flash('Formato inválido de data. Utilize DD/MM/YYYY', 'danger')
             return redirect(url_for('edit_sale', sale_id=sale_id))
         
-        # Delete existing items
-        c.execute("DELETE FROM sales_items WHERE sale_id = ?", (sale_id,))
-        
-        total_amount = 0
-        
-        # Insert new items
-        for recipe_id, quantity in zip(recipe_ids, quantities):
-            if not recipe_id or not quantity:
-                continue
-                
-            recipe_id = int(recipe_id)
-            quantity = int(quantity)
-            
-            # Get prices
-            c.execute("SELECT unit_price, box_price FROM recipes WHERE id = ?", (recipe_id,))
-            unit_price, box_price = c.fetchone()
-            
-            # Calculate subtotal
-            boxes = quantity // 6
-            units = quantity % 6
-            item_subtotal = (boxes * box_price) + (units * unit_price)
-            total_amount += item_subtotal
-            
-            c.execute("""INSERT INTO sales_items
-                        (sale_id, recipe_id, quantity, unit_price, box_price)
-                        VALUES (?, ?, ?, ?, ?)""",
-                     (sale_id, recipe_id, quantity, unit_price, box_price))
-        
-        # Update sale with delivery cost - FIXED: Correct parameter order including date
-        c.execute("""UPDATE sales 
-                    SET customer_name = ?, 
-                        total_amount = ?,
-                        delivery_cost = ?,
-                        is_delivered = ?, 
-                        is_paid = ?,
-                        date = ?,
-                        delivery_date = ?
-                    WHERE id = ?""",
-                 (customer_name, 
-                  total_amount + delivery_cost,
-                  delivery_cost,
-                  'is_delivered' in request.form, 
-                  'is_paid' in request.form,
-                  date,  # Date parameter added here
-                  delivery_date,  # Delivery date parameter
-                  sale_id))  # sale_id parameter added at the end
+        c.execute('BEGIN IMMEDIATE')
+        message = sale_unavailable(c, sale_id)
+        if message:
+            conn.rollback()
+            flash(message, 'danger')
+            return redirect(url_for('sales'))
+        try:
+            items, subtotal = price_sale_items(c, recipe_ids, quantities)
+            save_sale(c, {'customer_name': customer_name,
+                          'delivery_cost': delivery_cost,
+                          'is_delivered': 'is_delivered' in request.form,
+                          'is_paid': 'is_paid' in request.form,
+                          'date': date,
+                          'delivery_date': delivery_date},
+                      items, subtotal, sale_id=sale_id)
+        except ValueError as e:
+            conn.rollback()
+            flash(f'Erro ao atualizar venda: {str(e)}', 'danger')
+            return redirect(url_for('edit_sale', sale_id=sale_id))
         
         conn.commit()
-        conn.close()
         flash('Venda atualizada com sucesso', 'success')
         return redirect(url_for('sales'))
     
     # GET request handling
+    message = sale_unavailable(c, sale_id)
+    if message:
+        flash(message, 'danger')
+        return redirect(url_for('sales'))
     c.execute("SELECT * FROM sales WHERE id = ?", (sale_id,))
     sale = list(c.fetchone())  # Convert to list to ensure we can modify it if needed
     
@@ -554,44 +2203,57 @@ def edit_sale(sale_id):
                 WHERE si.sale_id = ?""", (sale_id,))
     sale_items = c.fetchall()
     
-    c.execute("SELECT id, name, unit_price, box_price FROM recipes")
-    recipes = c.fetchall()
-    conn.close()
-    
-    if not sale:
-        flash('Venda não encontrada', 'danger')
-        return redirect(url_for('sales'))
-    
     return render_template('edit_sale.html', 
                          sale=sale, 
-                         recipes=recipes,
                          sale_items=sale_items)
 
 @app.route('/delete_sale/<int:sale_id>')
 @login_required
 def delete_sale(sale_id):
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    message = sale_unavailable(c, sale_id)
+    if message:
+        conn.rollback()
+        flash(message, 'danger')
+        return redirect(url_for('sales'))
+    bump_sale_totals(c, sale_id, -1)
+    c.execute("DELETE FROM sales_items WHERE sale_id = ?", (sale_id,))
     c.execute("DELETE FROM sales WHERE id = ?", (sale_id,))
     conn.commit()
-    conn.close()
     
     flash('Venda apagada', 'success')
     return redirect(url_for('sales'))
 
-@app.route('/toggle_sale_status/<int:sale_id>/<string:status>')
+@app.route('/toggle_sale_status/<int:sale_id>/<string:status>', methods=['GET', 'POST'])
 @login_required
 def toggle_sale_status(sale_id, status):
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    message = sale_unavailable(c, sale_id)
+    if message:
+        conn.rollback()
+        flash(message, 'danger')
+        return redirect(url_for('sales'))
+    
+    # A replayed toggle would flip the status back
+    key = idempotency_key()
+    if not claim_idempotency_key(c, key):
+        conn.rollback()
+        return redirect(url_for('sales'))
+    remember_idempotent_record(c, key, sale_id)
     
     if status == 'delivered':
         c.execute("UPDATE sales SET is_delivered = NOT is_delivered WHERE id = ?", (sale_id,))
     elif status == 'paid':
+        # Move the sale in or out of its customer's balance
+        bump_sale_receivable(c, sale_id, -1)
         c.execute("UPDATE sales SET is_paid = NOT is_paid WHERE id = ?", (sale_id,))
+        bump_sale_receivable(c, sale_id)
     
     conn.commit()
-    conn.close()
     
     flash('Satus atualizado', 'success')
     return redirect(url_for('sales'))
@@ -599,29 +2261,25 @@ def toggle_sale_status(sale_id, status):
 @app.route('/results')
 @login_required
 def results():
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     c = conn.cursor()
     
-    # Get totals
-    c.execute("SELECT SUM(total_amount), SUM(delivery_cost) FROM sales")
-    total_sales, total_delivery = c.fetchone() or (0, 0)
-    
-    c.execute("SELECT SUM(amount) FROM expenses")
-    total_expenses = c.fetchone()[0] or 0
+    # Get totals from the daily rollup
+    c.execute("SELECT SUM(sales_total), SUM(delivery_total), SUM(expenses_total) FROM daily_totals")
+    total_sales, total_delivery, total_expenses = c.fetchone()
+    total_sales = total_sales or 0
+    total_delivery = total_delivery or 0
+    total_expenses = total_expenses or 0
     
     # Calculate profit
-    profit = (total_sales or 0) - (total_expenses or 0)
+    profit = total_sales - total_expenses
     
     # Get chart data (last 30 days)
-    c.execute("""SELECT date, SUM(total_amount), SUM(amount) 
-                 FROM (
-                     SELECT date, total_amount, 0 as amount FROM sales
-                     UNION ALL
-                     SELECT date, 0 as total_amount, amount FROM expenses
-                 )
-                 WHERE date >= date('now', '-30 days')
-                 GROUP BY date
-                 ORDER BY date""")
+    c.execute("""SELECT day, sales_total, expenses_total
+                 FROM daily_totals
+                 WHERE day >= date('now', '-30 days')
+                 AND (sales_count > 0 OR expenses_count > 0)
+                 ORDER BY day""")
     chart_data = c.fetchall()
     
     # Get recent sales (last 10)
@@ -638,8 +2296,15 @@ def results():
                 ORDER BY date DESC 
                 LIMIT 10""")
     recent_expenses = c.fetchall()
+
+    # Expenses per category, from the monthly rollup
+    c.execute("""SELECT COALESCE(ec.name, 'Sem categoria'), SUM(t.amount)
+                 FROM expense_totals t
+                 LEFT JOIN expense_categories ec ON ec.id = t.category_id
+                 GROUP BY t.category_id
+                 ORDER BY SUM(t.amount) DESC""")
+    category_totals = c.fetchall()
     
-    conn.close()
     
     # Prepare chart labels and datasets with formatted dates
     dates = []
@@ -689,7 +2354,178 @@ def results():
                          sales=sales,
                          expenses=expenses,
                          recent_sales=formatted_recent_sales,
-                         recent_expenses=formatted_recent_expenses)
+                         recent_expenses=formatted_recent_expenses,
+                         category_totals=category_totals)
+
+# Receivables aging: unpaid sales by customer and age of the sale, from the
+# receivables rollup rather than from sales
+AGING_BUCKETS = (
+    ('0–30 dias', "r.day >= date('now', '-30 days')"),
+    ('31–60 dias', "r.day < date('now', '-30 days') AND r.day >= date('now', '-60 days')"),
+    ('60+ dias', "r.day < date('now', '-60 days')"),
+)
+CUSTOMER_SALES_PER_PAGE = 20
+
+@app.route('/receivables')
+@login_required
+def receivables():
+    c = get_db().cursor()
+    buckets = ', '.join(f'COALESCE(SUM(CASE WHEN {condition} THEN r.amount END), 0)'
+                        for _, condition in AGING_BUCKETS)
+    c.execute(f"""SELECT cu.id, cu.name, {buckets}, SUM(r.amount), SUM(r.sales_count)
+                  FROM receivables r
+                  JOIN customers cu ON cu.id = r.customer_id
+                  GROUP BY r.customer_id
+                  HAVING SUM(r.amount) != 0
+                  ORDER BY SUM(r.amount) DESC""")
+    rows = c.fetchall()
+    totals = [sum(row[i] for row in rows) for i in range(2, 2 + len(AGING_BUCKETS) + 1)]
+    return render_template('receivables.html', rows=rows, totals=totals,
+                           buckets=[label for label, _ in AGING_BUCKETS])
+
+@app.route('/customers/<int:customer_id>')
+@login_required
+def customer_ledger(customer_id):
+    c = get_db().cursor()
+    c.execute("SELECT id, name, balance, unpaid_count FROM customers WHERE id = ?", (customer_id,))
+    customer = c.fetchone()
+    if not customer:
+        flash('Cliente não encontrado', 'danger')
+        return redirect(url_for('receivables'))
+
+    # All time, so the archive is read too once there are any
+    sales_table = sales_tables(c)[0]
+    query = f"""SELECT id, date, total_amount, is_delivered, is_paid
+                FROM {sales_table} WHERE customer_id = ?"""
+    params = [customer_id]
+    after = parse_sales_cursor(request.args.get('after'))
+    if after:
+        query += ' AND (date, id) < (?, ?)'
+        params += list(after)
+    c.execute(query + ' ORDER BY date DESC, id DESC LIMIT ?', params + [CUSTOMER_SALES_PER_PAGE + 1])
+    sales = c.fetchall()
+    next_cursor = None
+    if len(sales) > CUSTOMER_SALES_PER_PAGE:
+        sales = sales[:CUSTOMER_SALES_PER_PAGE]
+        next_cursor = f'{sales[-1][1]}_{sales[-1][0]}'
+
+    c.execute(f"""SELECT COUNT(*), COALESCE(SUM(total_amount), 0) FROM {sales_table}
+                  WHERE customer_id = ?""", (customer_id,))
+    sales_count, sales_total = c.fetchone()
+    return render_template('customer.html', customer=customer, sales=sales,
+                           sales_count=sales_count, sales_total=sales_total,
+                           next_cursor=next_cursor, first_page=after is None,
+                           datetime=datetime)
+
+MARGIN_GROUPS = {
+    # group: (dimension, label column, GROUP BY, ORDER BY)
+    'recipe': ('recipe', "COALESCE(r.name, 'Receita ' || m.key)", 'm.key', 'margin DESC'),
+    'customer': ('customer', 'm.key', 'm.key', 'margin DESC'),
+    # Every sale line is counted once under dimension 'recipe', so it also gives month totals
+    'month': ('recipe', 'm.month', 'm.month', 'm.month DESC'),
+}
+
+@app.route('/margins')
+@login_required
+def margins():
+    group = request.args.get('group', 'recipe')
+    if group not in MARGIN_GROUPS:
+        group = 'recipe'
+    start = request.args.get('start', '')
+    end = request.args.get('end', '')
+    dimension, label, group_by, order_by = MARGIN_GROUPS[group]
+
+    c = get_db().cursor()
+    c.execute(f"""SELECT {label}, SUM(m.revenue), SUM(m.cost), SUM(m.quantity),
+                         SUM(m.revenue) - SUM(m.cost) AS margin
+                  FROM margin_totals m
+                  LEFT JOIN recipes r ON m.dimension = 'recipe' AND r.id = CAST(m.key AS INTEGER)
+                  WHERE m.dimension = ? AND m.month >= ? AND m.month <= ?
+                  GROUP BY {group_by}
+                  ORDER BY {order_by}""",
+              (dimension, start or '0000-00', end or '9999-99'))
+    rows = [(name, revenue, cost, quantity, margin,
+             margin / revenue * 100 if revenue else None)
+            for name, revenue, cost, quantity, margin in c.fetchall()]
+
+    totals = [sum(row[i] for row in rows) for i in (1, 2, 3)]
+    return render_template('margins.html', rows=rows, group=group, start=start, end=end,
+                           total_revenue=totals[0], total_cost=totals[1],
+                           total_quantity=totals[2])
+
+# Production plan: what still has to be made for the undelivered sales, per
+# delivery day and recipe, split per sale line into full boxes and loose units
+# like the pricing, and rolled up to ingredients through the recipe links.
+# Pending sales are a small tail of the ledger, reached through
+# idx_sales_delivered_delivery_date and then idx_sales_items_sale_id.
+PRODUCTION_DAYS = 7  # days ahead shown by default
+
+def production_plan(c, end, start=None):
+    """Undelivered sales due up to end (and from start, if given), as
+    {'days': [...], 'recipes': [...], 'ingredients': [...]}."""
+    c.execute(f"""SELECT s.delivery_date, si.recipe_id, r.name, r.yield,
+                         SUM(si.quantity), SUM(si.quantity / {BOX_SIZE}), SUM(si.quantity % {BOX_SIZE}),
+                         COUNT(DISTINCT s.id)
+                  FROM sales s
+                  JOIN sales_items si ON si.sale_id = s.id
+                  JOIN recipes r ON r.id = si.recipe_id
+                  WHERE s.is_delivered = 0 AND s.delivery_date >= ? AND s.delivery_date <= ?
+                  GROUP BY s.delivery_date, si.recipe_id
+                  ORDER BY s.delivery_date, r.name""", (start or '', end))
+    days, recipes = {}, {}
+    for day, recipe_id, name, recipe_yield, quantity, boxes, loose, orders in c.fetchall():
+        line = {'recipe_id': recipe_id, 'name': name, 'quantity': quantity,
+                'boxes': boxes, 'loose': loose, 'orders': orders}
+        days.setdefault(day, []).append(line)
+        total = recipes.setdefault(recipe_id, {'recipe_id': recipe_id, 'name': name, 'yield': recipe_yield,
+                                               'quantity': 0, 'boxes': 0, 'loose': 0, 'orders': 0})
+        for key in ('quantity', 'boxes', 'loose', 'orders'):
+            total[key] += line[key]
+    for total in recipes.values():
+        total['batches'] = total['quantity'] / total['yield'] if total['yield'] and total['yield'] > 0 else None
+
+    ingredients = {}
+    if recipes:
+        placeholders = ','.join('?' * len(recipes))
+        c.execute(f"""SELECT ri.recipe_id, i.id, i.name, i.unit, ri.quantity
+                      FROM recipe_ingredients ri
+                      JOIN ingredients i ON i.id = ri.ingredient_id
+                      WHERE ri.recipe_id IN ({placeholders})""", list(recipes))
+        for recipe_id, ingredient_id, name, unit, quantity in c.fetchall():
+            batches = recipes[recipe_id]['batches']
+            if batches is None:
+                continue
+            total = ingredients.setdefault(ingredient_id, {'ingredient_id': ingredient_id, 'name': name,
+                                                           'unit': unit, 'quantity': 0})
+            total['quantity'] += batches * quantity
+
+    return {'days': [{'date': day, 'recipes': lines} for day, lines in days.items()],
+            'recipes': sorted(recipes.values(), key=lambda total: total['name']),
+            'ingredients': sorted(ingredients.values(), key=lambda total: total['name'])}
+
+def production_range():
+    """(start, end) from ?start=&end= (YYYY-MM-DD); by default everything
+    overdue plus the next PRODUCTION_DAYS days."""
+    today = datetime.now().date()
+    start = request.args.get('start') or None
+    end = request.args.get('end') or (today + timedelta(days=PRODUCTION_DAYS)).isoformat()
+    for value in (start, end):
+        if value is not None:
+            datetime.strptime(value, '%Y-%m-%d')
+    return start, end
+
+@app.route('/production')
+@login_required
+def production():
+    try:
+        start, end = production_range()
+    except ValueError:
+        flash('Data inválida', 'danger')
+        return redirect(url_for('production'))
+    plan = production_plan(get_db().cursor(), end, start)
+    return render_template('production.html', plan=plan, start=start or '', end=end,
+                           today=datetime.now().strftime('%Y-%m-%d'), box_size=BOX_SIZE,
+                           datetime=datetime)
     
 @app.route('/add_recipe', methods=['POST'])
 @login_required
@@ -699,15 +2535,1551 @@ def add_recipe():
     box_price = float(request.form['box_price'].replace(',', '.'))
     description = request.form.get('description', '')
     
-    conn = sqlite3.connect('database.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute("INSERT INTO recipes (name, unit_price, box_price, description, created_by) VALUES (?, ?, ?, ?, ?)",
              (name, unit_price, box_price, description, current_user.id))
     conn.commit()
-    conn.close()
     
     flash('Receita adicionada com sucesso', 'success')
     return redirect(url_for('recipes'))
 
+# Bulk import of historical sales and expenses from CSV or JSON lines.
+# Sales CSV has one row per sale line; consecutive rows sharing a sale_ref form one sale.
+# Sales JSON lines have one sale per line with an "items" list.
+IMPORT_BATCH_SIZE = 1000
+IMPORT_MAX_ERRORS = 20
+TRUE_VALUES = {'1', 'true', 'sim', 'yes', 's', 'y', 'x', 'on'}
+
+def parse_import_date(value):
+    value = (value or '').strip()
+    for fmt in ('%Y-%m-%d', '%d/%m/%Y'):
+        try:
+            return datetime.strptime(value[:10], fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    raise ValueError(f'data inválida: {value!r}')
+
+def parse_import_amount(value, default=None):
+    if value is None or str(value).strip() == '':
+        if default is None:
+            raise ValueError('valor ausente')
+        return default
+    return float(str(value).replace(',', '.'))
+
+def parse_import_flag(value):
+    if isinstance(value, bool):
+        return value
+    return str(value or '').strip().lower() in TRUE_VALUES
+
+def read_import_records(stream, fmt):
+    """Yield (line_number, record) pairs from a CSV or JSON-lines text stream."""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == 'jsonl':
+        for line_number, line in enumerate(stream, start=1):
+            line = line.strip()
+            if line:
+                yield line_number, json.loads(line)
+    else:
+        raise ValueError(f'formato desconhecido: {fmt}')
+
+def group_import_sales(records):
+    """Merge consecutive sale lines with the same sale_ref into one sale."""
+    current, current_ref = None, None
+    for line_number, record in records:
+        if not isinstance(record, dict):
+            # Not a sale at all: pass it on as its only item, to be rejected there
+            record = {'items': [record]}
+        items = record.get('items')
+        if items is None:
+            items = [record]
+        elif not isinstance(items, list):
+            items = [items]
+        ref = record.get('sale_ref') or None
+        if current is not None and ref is not None and ref == current_ref:
+            current['items'].extend(items)
+            continue
+        if current is not None:
+            yield current
+        current = dict(record, items=list(items), line=line_number)
+        current_ref = ref
+    if current is not None:
+        yield current
+
+def new_import_stats():
+    return {'rows': 0, 'sales': 0, 'items': 0, 'expenses': 0,
+            'skipped': 0, 'errors': [], 'seconds': 0, 'rows_per_sec': 0}
+
+def skip_import_record(stats, line_number, error):
+    stats['skipped'] += 1
+    if len(stats['errors']) < IMPORT_MAX_ERRORS:
+        stats['errors'].append(f'linha {line_number}: {error}')
+
+def finish_import_stats(stats, started):
+    stats['seconds'] = time.perf_counter() - started
+    stats['rows_per_sec'] = stats['rows'] / stats['seconds'] if stats['seconds'] else 0
+    return stats
+
+def count_import_rows(records, stats):
+    for record in records:
+        stats['rows'] += 1
+        yield record
+
+def import_sales(conn, records, batch_size=IMPORT_BATCH_SIZE, created_by=None):
+    """Insert sales from (line_number, record) pairs, committing every batch_size sales.
+
+    Lines are priced like add_sale (boxes of BOX_SIZE at box_price, the rest at
+    unit_price), using the line's own prices when given, else the recipe's.
+    """
+    stats = new_import_stats()
+    started = time.perf_counter()
+    c = conn.cursor()
+
+    c.execute("SELECT id, name, unit_price, box_price FROM recipes")
+    prices, recipe_ids = {}, {}
+    for recipe_id, name, unit_price, box_price in c.fetchall():
+        prices[recipe_id] = (unit_price, box_price)
+        recipe_ids[name.strip().lower()] = recipe_id
+    unit_costs = recipe_unit_costs(c)
+    conn.commit()
+
+    def resolve_recipe(item):
+        if item.get('recipe_id') not in (None, ''):
+            recipe_id = int(item['recipe_id'])
+        else:
+            recipe_id = recipe_ids.get(str(item.get('recipe') or '').strip().lower())
+        if recipe_id not in prices:
+            raise ValueError(f'receita não encontrada: {item.get("recipe_id") or item.get("recipe")!r}')
+        return recipe_id
+
+    pending_items, pending_totals, pending_margins, in_batch = [], {}, {}, 0
+    pending_receivables, customer_ids = {}, {}
+
+    def flush():
+        c.executemany("""INSERT INTO sales_items
+                         (sale_id, recipe_id, quantity, unit_price, box_price, unit_cost)
+                         VALUES (?, ?, ?, ?, ?, ?)""", pending_items)
+        for day, (total, delivery, count, items_sold) in pending_totals.items():
+            bump_daily_totals(c, day, sales_total=total, delivery_total=delivery,
+                              sales_count=count, items_sold=items_sold)
+        bump_margin_totals(c, (key + tuple(total) for key, total in pending_margins.items()))
+        for (customer_id, day), (amount, count) in pending_receivables.items():
+            bump_receivables(c, customer_id, day, amount, count)
+        conn.commit()
+        pending_items.clear()
+        pending_totals.clear()
+        pending_margins.clear()
+        pending_receivables.clear()
+
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        for sale in group_import_sales(count_import_rows(records, stats)):
+            try:
+                for item in sale['items']:
+                    if not isinstance(item, dict):
+                        raise ValueError(f'item inválido: {item!r}')
+                date = parse_import_date(sale.get('date'))
+                delivery_date = (parse_import_date(sale['delivery_date'])
+                                 if sale.get('delivery_date') else date)
+                delivery_cost = parse_import_amount(sale.get('delivery_cost'), 0.0)
+                lines, subtotal, items_sold = [], 0, 0
+                for item in sale['items']:
+                    recipe_id = resolve_recipe(item)
+                    quantity = int(item['quantity'])
+                    unit_price = parse_import_amount(item.get('unit_price'), prices[recipe_id][0])
+                    box_price = parse_import_amount(item.get('box_price'), prices[recipe_id][1])
+                    unit_cost = parse_import_amount(item.get('unit_cost'), unit_costs[recipe_id])
+                    subtotal += sale_item_subtotal(quantity, unit_price, box_price)
+                    items_sold += quantity
+                    lines.append((recipe_id, quantity, unit_price, box_price, unit_cost))
+                if not lines:
+                    raise ValueError('venda sem itens')
+            except (KeyError, TypeError, ValueError) as e:
+                skip_import_record(stats, sale['line'], e)
+                continue
+
+            total_amount = subtotal + delivery_cost
+            customer_name = sale.get('customer_name') or ''
+            if customer_name not in customer_ids:
+                customer_ids[customer_name] = customer_id_for(c, customer_name)
+            customer_id = customer_ids[customer_name]
+            is_paid = parse_import_flag(sale.get('is_paid', True))
+            c.execute("""INSERT INTO sales
+                         (customer_name, customer_id, total_amount, delivery_cost,
+                          is_delivered, is_paid, date, delivery_date, created_by)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                      (customer_name, customer_id, total_amount, delivery_cost,
+                       parse_import_flag(sale.get('is_delivered', True)), is_paid,
+                       date, delivery_date, created_by))
+            sale_id = c.lastrowid
+            if not is_paid:
+                receivable = pending_receivables.setdefault((customer_id, date), [0, 0])
+                receivable[0] += total_amount
+                receivable[1] += 1
+            pending_items.extend((sale_id,) + line for line in lines)
+            day = pending_totals.setdefault(date, [0, 0, 0, 0])
+            day[0] += total_amount
+            day[1] += delivery_cost
+            day[2] += 1
+            day[3] += items_sold
+            for dimension, key, month, revenue, cost, quantity in sale_margin_rows(
+                    sale.get('customer_name'), date, lines):
+                margin = pending_margins.setdefault((dimension, key, month), [0, 0, 0])
+                margin[0] += revenue
+                margin[1] += cost
+                margin[2] += quantity
+            stats['sales'] += 1
+            stats['items'] += len(lines)
+
+            in_batch += 1
+            if in_batch >= batch_size:
+                flush()
+                c.execute('BEGIN IMMEDIATE')
+                in_batch = 0
+        flush()
+    except Exception:
+        # Batches already committed stay; only the current one is lost
+        conn.rollback()
+        raise
+    return finish_import_stats(stats, started)
+
+def import_expenses(conn, records, batch_size=IMPORT_BATCH_SIZE, created_by=None):
+    """Insert expenses from (line_number, record) pairs, committing every batch_size rows."""
+    stats = new_import_stats()
+    started = time.perf_counter()
+    c = conn.cursor()
+    pending, pending_totals = [], {}
+    categories = {name.lower(): category_id for category_id, name, _ in expense_categories(c)}
+
+    def flush():
+        c.executemany("""INSERT INTO expenses (amount, description, date, category_id, created_by)
+                         VALUES (?, ?, ?, ?, ?)""", pending)
+        for (day, category_id), (total, count) in pending_totals.items():
+            bump_daily_totals(c, day, expenses_total=total, expenses_count=count)
+            bump_category_totals(c, category_id, day, total, count)
+        conn.commit()
+        pending.clear()
+        pending_totals.clear()
+
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        for line_number, record in count_import_rows(records, stats):
+            try:
+                if not isinstance(record, dict):
+                    raise ValueError(f'registro inválido: {record!r}')
+                amount = parse_import_amount(record.get('amount'))
+                date = parse_import_date(record.get('date'))
+                description = (record.get('description') or '').strip()
+                if not description:
+                    raise ValueError('descrição ausente')
+                category = (record.get('category') or '').strip()
+                category_id = categories.get(category.lower()) if category else None
+                if category and category_id is None:
+                    raise ValueError(f'categoria desconhecida: {category}')
+            except (TypeError, ValueError) as e:
+                skip_import_record(stats, line_number, e)
+                continue
+
+            pending.append((amount, description, date, category_id, created_by))
+            day = pending_totals.setdefault((date, category_id), [0, 0])
+            day[0] += amount
+            day[1] += 1
+            stats['expenses'] += 1
+            if len(pending) >= batch_size:
+                flush()
+                c.execute('BEGIN IMMEDIATE')
+        flush()
+    except Exception:
+        conn.rollback()
+        raise
+    return finish_import_stats(stats, started)
+
+IMPORTERS = {'sales': import_sales, 'expenses': import_expenses}
+
+def import_format_for(filename, fmt=None):
+    if fmt:
+        return fmt
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.json', '.ndjson')) else 'csv'
+
+@app.cli.command('import-data')
+@click.argument('kind', type=click.Choice(sorted(IMPORTERS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Input format (default: from the file extension).')
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True,
+              help='Rows committed per transaction.')
+def import_data_command(kind, path, fmt, batch_size):
+    """Import historical sales or expenses from a CSV or JSON-lines file."""
+    conn = connect_db()
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        records = read_import_records(stream, import_format_for(path, fmt))
+        stats = IMPORTERS[kind](conn, records, batch_size=batch_size)
+    conn.close()
+    for error in stats['errors']:
+        click.echo(f'  ignorada {error}', err=True)
+    click.echo(f"{stats['rows']} linhas lidas, {stats['sales']} vendas, {stats['items']} itens, "
+               f"{stats['expenses']} despesas, {stats['skipped']} ignoradas "
+               f"em {stats['seconds']:.1f}s ({stats['rows_per_sec']:.0f} linhas/s)")
+
+@app.route('/import', methods=['GET', 'POST'])
+@login_required
+def import_data():
+    if not current_user.is_admin:
+        flash('Você não tem permissão para acessar essa página', 'danger')
+        return redirect(url_for('sales'))
+
+    stats = None
+    if request.method == 'POST':
+        kind = request.form.get('kind')
+        upload = request.files.get('file')
+        if kind not in IMPORTERS or not upload or not upload.filename:
+            flash('Selecione o tipo e o arquivo para importar', 'danger')
+            return redirect(url_for('import_data'))
+
+        try:
+            batch_size = max(1, int(request.form.get('batch_size') or IMPORT_BATCH_SIZE))
+        except ValueError:
+            batch_size = IMPORT_BATCH_SIZE
+
+        # Uploads are spooled to disk by werkzeug, so this reads in constant memory
+        stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        try:
+            records = read_import_records(stream, import_format_for(upload.filename, request.form.get('format')))
+            stats = IMPORTERS[kind](get_db(), records, batch_size=batch_size,
+                                    created_by=current_user.id)
+            flash('Importação concluída', 'success')
+        except (ValueError, UnicodeDecodeError, csv.Error) as e:
+            flash(f'Erro ao importar: {str(e)}', 'danger')
+
+    return render_template('import.html', stats=stats, batch_size=IMPORT_BATCH_SIZE)
+
+# Streaming exports for the accountant; every query is bounded by a date range
+# and walks the date indexes, so rows are streamed instead of loaded up front.
+# {sales} and {sales_items} become the all_* views when the range reaches the
+# archived sales.
+EXPORT_FETCH_SIZE = 500
+EXPORTS = {
+    'sales': (
+        ['id', 'data', 'cliente', 'total', 'entrega', 'entregue', 'pago', 'data_entrega'],
+        """SELECT id, date, customer_name, total_amount, delivery_cost,
+                  is_delivered, is_paid, delivery_date
+           FROM {sales}
+           WHERE date >= ? AND date < ?
+           ORDER BY date, id"""),
+    'items': (
+        ['venda', 'data', 'cliente', 'receita', 'quantidade', 'preco_unidade', 'preco_caixa'],
+        """SELECT s.id, s.date, s.customer_name, r.name, si.quantity,
+                  si.unit_price, si.box_price
+           FROM {sales} s
+           JOIN {sales_items} si ON si.sale_id = s.id
+           LEFT JOIN recipes r ON r.id = si.recipe_id
+           WHERE s.date >= ? AND s.date < ?
+           ORDER BY s.date, s.id, si.id"""),
+    'expenses': (
+        ['id', 'data', 'valor', 'descricao', 'categoria'],
+        """SELECT e.id, e.date, e.amount, e.description, ec.name
+           FROM expenses e
+           LEFT JOIN expense_categories ec ON ec.id = e.category_id
+           WHERE e.date >= ? AND e.date < ?
+           ORDER BY e.date, e.id"""),
+    'ledger': (
+        ['data', 'tipo', 'id', 'descricao', 'valor'],
+        """SELECT date, 'venda', id, customer_name, total_amount
+           FROM {sales}
+           WHERE date >= ?1 AND date < ?2
+           UNION ALL
+           SELECT date, 'despesa', id, description, -amount
+           FROM expenses
+           WHERE date >= ?1 AND date < ?2
+           ORDER BY 1, 2, 3"""),
+}
+
+def export_date_range():
+    """Read ?start= and ?end= (YYYY-MM-DD or DD/MM/YYYY, both optional and inclusive).
+
+    Returns (start, end) with end exclusive, as the export queries expect.
+    """
+    start = request.args.get('start')
+    end = request.args.get('end')
+    if end:
+        end = (datetime.strptime(parse_import_date(end), '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+    return (parse_import_date(start) if start else '0000-01-01', end or '9999-12-31')
+
+def iter_export_rows(c, sql, params):
+    c.execute(sql, params)
+    while True:
+        rows = c.fetchmany(EXPORT_FETCH_SIZE)
+        if not rows:
+            break
+        yield rows
+
+def stream_csv_export(name, header, sql, params):
+    def generate():
+        c = get_db().cursor()
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # BOM so spreadsheet apps detect UTF-8
+        buffer.write('\ufeff')
+        writer.writerow(header)
+        for rows in iter_export_rows(c, sql, params):
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    response = Response(stream_with_context(generate()), mimetype='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename={name}.csv'
+    return response
+
+def send_xlsx_export(name, header, sql, params):
+    # write_only keeps rows out of memory; the finished file is spooled to disk
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(name)
+    sheet.append(header)
+    for rows in iter_export_rows(get_db().cursor(), sql, params):
+        for row in rows:
+            sheet.append(row)
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+    return send_file(output, as_attachment=True, download_name=f'{name}.xlsx',
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+@app.route('/export/<string:name>.csv', defaults={'fmt': 'csv'})
+@app.route('/export/<string:name>.xlsx', defaults={'fmt': 'xlsx'})
+@login_required
+def export_data(name, fmt):
+    if name not in EXPORTS:
+        flash('Exportação desconhecida', 'danger')
+        return redirect(url_for('results'))
+    try:
+        params = export_date_range()
+    except ValueError as e:
+        flash(f'Erro ao exportar: {str(e)}', 'danger')
+        return redirect(url_for('results'))
+
+    header, sql = EXPORTS[name]
+    sales, sales_items = sales_tables(get_db().cursor(), params[0])
+    sql = sql.format(sales=sales, sales_items=sales_items)
+    if fmt == 'xlsx':
+        if Workbook is None:
+            flash('Exportação XLSX indisponível (openpyxl não instalado)', 'danger')
+            return redirect(url_for('results'))
+        return send_xlsx_export(name, header, sql, params)
+    return stream_csv_export(name, header, sql, params)
+
+# Search over sales (customer and recipes sold) and expenses, ranked by bm25.
+# bm25 has to score every match before sorting, which is slow for a word found
+# in most of a large ledger, so only the most recent SEARCH_RANK_WINDOW matches
+# of each kind (by rowid) are ranked. The window stays the same on every page so
+# all pages come from one ranking; paging stops at its end.
+SEARCH_PER_PAGE = 20
+SEARCH_RANK_WINDOW = 2000
+SEARCH_WINDOW = """{fts}.rowid >= (SELECT COALESCE(MIN(rowid), 0) FROM
+                       (SELECT rowid FROM {fts} WHERE {fts} MATCH :query
+                        ORDER BY rowid DESC LIMIT :window))"""
+SEARCH_KINDS = {
+    # {sales} and {archived} come from sales_tables(), archived sales are found too
+    'sales': f"""SELECT 'sale', s.id, s.date, s.total_amount,
+                        highlight(sales_search, 0, char(2), char(3)),
+                        highlight(sales_search, 1, char(2), char(3)),
+                        {{archived}}, bm25(sales_search, 2.0, 1.0) AS score
+                 FROM sales_search JOIN {{sales}} s ON s.id = sales_search.rowid
+                 WHERE sales_search MATCH :query
+                 AND {SEARCH_WINDOW.format(fts='sales_search')}""",
+    'expenses': f"""SELECT 'expense', e.id, e.date, e.amount,
+                           highlight(expenses_search, 0, char(2), char(3)), '',
+                           0, bm25(expenses_search) AS score
+                    FROM expenses_search JOIN expenses e ON e.id = expenses_search.rowid
+                    WHERE expenses_search MATCH :query
+                    AND {SEARCH_WINDOW.format(fts='expenses_search')}""",
+}
+
+def search_match_query(text):
+    """Turn free text into an FTS5 query: every word must match, the last one
+    as a prefix so partly typed words still find something."""
+    terms = [f'"{word}"' for word in re.findall(r'\w+', text or '')]
+    if terms:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+def highlight_match(text):
+    # highlight() marks matches with \x02/\x03; escape the rest before adding <mark>
+    return Markup(str(escape(text or '')).replace('\x02', '<mark>').replace('\x03', '</mark>'))
+
+def search_ledger(c, text, kinds=None, page=1, per_page=SEARCH_PER_PAGE):
+    """Return (results, has_next) for one page of ranked matches."""
+    query = search_match_query(text)
+    if not query:
+        return [], False
+    sales = sales_tables(c)[0]
+    archived = 's.archived' if sales == 'all_sales' else '0'
+    parts = [SEARCH_KINDS[kind].format(sales=sales, archived=archived) for kind in (kinds or SEARCH_KINDS)]
+    offset = (page - 1) * per_page
+    # Kind and id last, so equal scores and dates still page in one order
+    c.execute(' UNION ALL '.join(parts) + ' ORDER BY score, 3 DESC, 2 DESC, 1 LIMIT :limit OFFSET :offset',
+              {'query': query, 'limit': per_page + 1, 'offset': offset, 'window': SEARCH_RANK_WINDOW})
+    rows = c.fetchall()
+    results = [{'kind': kind, 'id': record_id, 'date': date, 'amount': amount,
+                'title': highlight_match(title), 'detail': highlight_match(detail), 'archived': archived}
+               for kind, record_id, date, amount, title, detail, archived, _ in rows[:per_page]]
+    return results, len(rows) > per_page
+
+@app.route('/search')
+@login_required
+def search():
+    text = request.args.get('q', '').strip()
+    kind = request.args.get('kind', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    started = time.perf_counter()
+    results, has_next = search_ledger(get_db().cursor(), text,
+                                      [kind] if kind in SEARCH_KINDS else None, page)
+    for result in results:
+        try:
+            result['date'] = datetime.strptime(result['date'], '%Y-%m-%d').strftime('%d/%m/%Y')
+        except (TypeError, ValueError):
+            pass  # keep original format if parsing fails
+    # Paging stops at the end of the ranked window, say so when that's why
+    capped = not has_next and (page - 1) * SEARCH_PER_PAGE + len(results) >= SEARCH_RANK_WINDOW
+    return render_template('search.html', q=text, kind=kind, page=page,
+                           results=results, has_next=has_next,
+                           capped=capped, rank_window=SEARCH_RANK_WINDOW,
+                           elapsed_ms=(time.perf_counter() - started) * 1000)
+
+# JSON API under /api/v1/ for sales (with their items), expenses and recipes.
+# Lists use keyset cursors; reads carry an ETag built from table_versions, so a
+# client polling with If-None-Match gets a 304 without any query being run.
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+
+API_RESOURCES = {
+    'sales': {
+        'table': 'sales',
+        'fields': ('id', 'customer_name', 'total_amount', 'delivery_cost',
+                   'is_delivered', 'is_paid', 'date', 'delivery_date', 'items'),
+        'order': ('date', 'id'),
+        # items carry the recipe name, so they depend on recipes too
+        'tables': ('sales', 'sales_items', 'recipes'),
+    },
+    'expenses': {
+        'table': 'expenses',
+        'fields': ('id', 'amount', 'description', 'date', 'category_id'),
+        'order': ('date', 'id'),
+        'tables': ('expenses',),
+    },
+    'recipes': {
+        'table': 'recipes',
+        'fields': ('id', 'name', 'unit_price', 'box_price', 'description', 'yield'),
+        'order': ('id',),
+        'tables': ('recipes',),
+    },
+}
+API_ITEM_FIELDS = ('recipe_id', 'recipe_name', 'quantity', 'unit_price', 'box_price')
+
+class APIError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+@app.errorhandler(APIError)
+def api_error(e):
+    return {'error': str(e)}, e.status
+
+def api_login_required(view):
+    # JSON 401 instead of the login page redirect
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            raise APIError('não autenticado', 401)
+        return view(*args, **kwargs)
+    return wrapper
+
+def api_resource(name):
+    if name not in API_RESOURCES:
+        raise APIError('recurso desconhecido', 404)
+    return API_RESOURCES[name]
+
+def api_fields(resource):
+    fields = request.args.get('fields')
+    if not fields:
+        return resource['fields']
+    fields = tuple(field.strip() for field in fields.split(',') if field.strip())
+    unknown = [field for field in fields if field not in resource['fields']]
+    if unknown:
+        raise APIError(f'campos desconhecidos: {", ".join(unknown)}')
+    return fields
+
+def api_etag(c, resource, fields):
+    tables = resource['tables'] if 'items' in fields else resource['tables'][:1]
+    return f'{resource["table"]}-' + '.'.join(str(v) for v in table_versions(c, list(tables)))
+
+def api_not_modified(etag):
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+def api_response(payload, etag, status=200):
+    response = app.json.response(payload)
+    response.status_code = status
+    response.set_etag(etag)
+    return response
+
+def encode_api_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def decode_api_cursor(value, size):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+    except (ValueError, TypeError):
+        raise APIError('cursor inválido')
+    if not isinstance(values, list) or len(values) != size:
+        raise APIError('cursor inválido')
+    return values
+
+def fetch_api_items(c, sale_ids, table='sales_items'):
+    """Return {sale_id: [item dict, ...]} for the given sales."""
+    items = {}
+    if not sale_ids:
+        return items
+    placeholders = ','.join('?' * len(sale_ids))
+    c.execute(f"""SELECT si.sale_id, si.recipe_id, r.name, si.quantity, si.unit_price, si.box_price
+                  FROM {table} si
+                  LEFT JOIN recipes r ON r.id = si.recipe_id
+                  WHERE si.sale_id IN ({placeholders})
+                  ORDER BY si.id""", sale_ids)
+    for row in c.fetchall():
+        items.setdefault(row[0], []).append(dict(zip(API_ITEM_FIELDS, row[1:])))
+    return items
+
+def fetch_api_rows(c, resource, fields, where='', params=(), limit=None, archived=True):
+    # Sales are read with the archived ones unless archived=False, which writes
+    # need: attaching the archive can't happen inside their transaction
+    table, items_table = resource['table'], 'sales_items'
+    if archived and table == 'sales':
+        table, items_table = sales_tables(c)
+    columns = [field for field in fields if field != 'items']
+    # id and the sort key are always read so items and cursors can be built
+    select = list(dict.fromkeys(list(resource['order']) + columns))
+    sql = f'SELECT {", ".join(select)} FROM {table}'
+    if where:
+        sql += f' WHERE {where}'
+    sql += ' ORDER BY ' + ', '.join(f'{column} DESC' for column in resource['order'])
+    if limit is not None:
+        sql += f' LIMIT {int(limit)}'
+    c.execute(sql, params)
+    rows = [dict(zip(select, row)) for row in c.fetchall()]
+
+    if 'items' in fields:
+        items = fetch_api_items(c, [row['id'] for row in rows], items_table)
+        for row in rows:
+            row['items'] = items.get(row['id'], [])
+    return rows
+
+def api_record(resource, row, fields):
+    return {field: row[field] for field in fields}
+
+@app.route('/api/v1/<string:name>')
+@api_login_required
+def api_list(name):
+    resource = api_resource(name)
+    fields = api_fields(resource)
+    try:
+        limit = min(max(int(request.args.get('limit', API_PAGE_SIZE)), 1), API_MAX_PAGE_SIZE)
+    except ValueError:
+        raise APIError('limit inválido')
+
+    c = get_db().cursor()
+    etag = api_etag(c, resource, fields)
+    not_modified = api_not_modified(etag)
+    if not_modified:
+        return not_modified
+
+    order = resource['order']
+    conditions, params = [], []
+    if name == 'sales' and request.args.get('status'):
+        status = request.args['status']
+        if status not in SALES_SECTIONS:
+            raise APIError('status inválido')
+        conditions.append(SALES_SECTIONS[status].replace('s.', ''))
+    if request.args.get('cursor'):
+        cursor = decode_api_cursor(request.args['cursor'], len(order))
+        conditions.append(f'({", ".join(order)}) < ({", ".join("?" * len(order))})')
+        params.extend(cursor)
+
+    # Only closed sales are archived
+    archived = request.args.get('status') not in ('pending', 'unpaid')
+    rows = fetch_api_rows(c, resource, fields, ' AND '.join(conditions), params, limit + 1, archived)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_api_cursor([rows[-1][column] for column in order])
+    return api_response({'data': [api_record(resource, row, fields) for row in rows],
+                         'next_cursor': next_cursor}, etag)
+
+def fetch_api_record(c, resource, record_id, fields):
+    rows = fetch_api_rows(c, resource, fields, 'id = ?', (record_id,))
+    if not rows:
+        raise APIError('não encontrado', 404)
+    return api_record(resource, rows[0], fields)
+
+@app.route('/api/v1/<string:name>/<int:record_id>')
+@api_login_required
+def api_detail(name, record_id):
+    resource = api_resource(name)
+    fields = api_fields(resource)
+    c = get_db().cursor()
+    etag = f'{api_etag(c, resource, fields)}-{record_id}'
+    not_modified = api_not_modified(etag)
+    if not_modified:
+        return not_modified
+    return api_response(fetch_api_record(c, resource, record_id, fields), etag)
+
+@app.route('/api/v1/sales/<int:sale_id>/items')
+@api_login_required
+def api_sale_items(sale_id):
+    c = get_db().cursor()
+    etag = 'sales_items-' + '.'.join(str(v) for v in table_versions(c, ['sales_items', 'recipes']))
+    etag += f'-{sale_id}'
+    not_modified = api_not_modified(etag)
+    if not_modified:
+        return not_modified
+    sales, sales_items = sales_tables(c)
+    c.execute(f"SELECT 1 FROM {sales} WHERE id = ?", (sale_id,))
+    if not c.fetchone():
+        raise APIError('não encontrado', 404)
+    return api_response({'data': fetch_api_items(c, [sale_id], sales_items).get(sale_id, [])}, etag)
+
+PRODUCTION_TABLES = ['sales', 'sales_items', 'recipes', 'ingredients', 'recipe_ingredients']
+
+@app.route('/api/v1/production')
+@api_login_required
+def api_production():
+    try:
+        start, end = production_range()
+    except ValueError:
+        raise APIError('data inválida, use AAAA-MM-DD')
+    c = get_db().cursor()
+    etag = 'production-' + '.'.join(str(v) for v in table_versions(c, PRODUCTION_TABLES))
+    etag += f'-{start or ""}-{end}'
+    not_modified = api_not_modified(etag)
+    if not_modified:
+        return not_modified
+    plan = production_plan(c, end, start)
+    return api_response({'start': start, 'end': end, 'box_size': BOX_SIZE, **plan}, etag)
+
+def api_payload():
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        raise APIError('corpo JSON inválido')
+    return payload
+
+def api_value(payload, key, parse, current=None, required=False):
+    if key not in payload:
+        if required and current is None:
+            raise APIError(f'campo obrigatório: {key}')
+        return current
+    try:
+        return parse(payload[key])
+    except (TypeError, ValueError) as e:
+        raise APIError(f'{key}: {e}')
+
+def api_sale_items_payload(c, payload):
+    lines = payload['items']
+    if not isinstance(lines, list) or not lines:
+        raise APIError('items deve ser uma lista não vazia')
+    try:
+        items, subtotal = price_sale_items(c, [line.get('recipe_id') for line in lines],
+                                           [line.get('quantity') for line in lines])
+    except (AttributeError, TypeError, ValueError) as e:
+        raise APIError(str(e))
+    if not items:
+        raise APIError('items deve ser uma lista não vazia')
+    return items, subtotal
+
+def api_write(name, record_id=None):
+    """Apply a POST/PATCH payload for a resource on the current transaction."""
+    payload = api_payload()
+    c = get_db().cursor()
+    current = {}
+    if record_id is not None:
+        resource = API_RESOURCES[name]
+        fields = [field for field in resource['fields'] if field != 'items']
+        current = fetch_api_rows(c, resource, fields, 'id = ?', (record_id,), archived=False)
+        if not current:
+            if name == 'sales' and sale_archived(c, record_id):
+                raise APIError('venda arquivada', 409)
+            raise APIError('não encontrado', 404)
+        current = current[0]
+
+    if name == 'sales':
+        sale = {
+            'customer_name': api_value(payload, 'customer_name', str, current.get('customer_name', '')),
+            'delivery_cost': api_value(payload, 'delivery_cost', lambda v: parse_import_amount(v, 0.0),
+                                       current.get('delivery_cost', 0.0)),
+            'is_delivered': api_value(payload, 'is_delivered', parse_import_flag, current.get('is_delivered', False)),
+            'is_paid': api_value(payload, 'is_paid', parse_import_flag, current.get('is_paid', False)),
+            'date': api_value(payload, 'date', parse_import_date, current.get('date'), required=True),
+        }
+        sale['delivery_date'] = api_value(payload, 'delivery_date', parse_import_date,
+                                          current.get('delivery_date') or sale['date'])
+        if 'items' in payload:
+            items, subtotal = api_sale_items_payload(c, payload)
+        elif record_id is None:
+            raise APIError('campo obrigatório: items')
+        else:
+            items, subtotal = None, current['total_amount'] - (current['delivery_cost'] or 0)
+        return save_sale(c, sale, items, subtotal, sale_id=record_id, created_by=current_user.id)
+
+    if name == 'expenses':
+        amount = api_value(payload, 'amount', parse_import_amount, current.get('amount'), required=True)
+        description = api_value(payload, 'description', str, current.get('description', ''))
+        date = api_value(payload, 'date', parse_import_date,
+                         current.get('date') or datetime.now().strftime('%Y-%m-%d'))
+        category_id = api_value(payload, 'category_id', lambda v: parse_category_id(c, v),
+                                current.get('category_id'))
+        if record_id is None:
+            c.execute("""INSERT INTO expenses (amount, description, date, category_id, created_by)
+                         VALUES (?, ?, ?, ?, ?)""",
+                      (amount, description, date, category_id, current_user.id))
+            record_id = c.lastrowid
+        else:
+            bump_expense_totals(c, record_id, -1)
+            c.execute("UPDATE expenses SET amount = ?, description = ?, date = ?, category_id = ? WHERE id = ?",
+                      (amount, description, date, category_id, record_id))
+        bump_expense_totals(c, record_id)
+        return record_id
+
+    recipe_name = api_value(payload, 'name', str, current.get('name'), required=True)
+    unit_price = api_value(payload, 'unit_price', parse_import_amount, current.get('unit_price'), required=True)
+    box_price = api_value(payload, 'box_price', parse_import_amount, current.get('box_price'), required=True)
+    description = api_value(payload, 'description', str, current.get('description', ''))
+    recipe_yield = api_value(payload, 'yield', lambda v: max(1, int(v)), current.get('yield', 1))
+    if record_id is None:
+        c.execute("""INSERT INTO recipes (name, unit_price, box_price, description, yield, created_by)
+                     VALUES (?, ?, ?, ?, ?, ?)""",
+                  (recipe_name, unit_price, box_price, description, recipe_yield, current_user.id))
+        return c.lastrowid
+    c.execute("UPDATE recipes SET name = ?, unit_price = ?, box_price = ?, description = ?, yield = ? WHERE id = ?",
+              (recipe_name, unit_price, box_price, description, recipe_yield, record_id))
+    invalidate_recipe_costs(c, recipe_id=record_id)
+    return record_id
+
+def api_delete(name, record_id):
+    c = get_db().cursor()
+    c.execute(f"SELECT 1 FROM {API_RESOURCES[name]['table']} WHERE id = ?", (record_id,))
+    if not c.fetchone():
+        if name == 'sales' and sale_archived(c, record_id):
+            raise APIError('venda arquivada', 409)
+        raise APIError('não encontrado', 404)
+    if name == 'sales':
+        bump_sale_totals(c, record_id, -1)
+        c.execute("DELETE FROM sales_items WHERE sale_id = ?", (record_id,))
+    elif name == 'expenses':
+        bump_expense_totals(c, record_id, -1)
+    else:
+        c.execute("DELETE FROM recipe_ingredients WHERE recipe_id = ?", (record_id,))
+    c.execute(f"DELETE FROM {API_RESOURCES[name]['table']} WHERE id = ?", (record_id,))
+
+@app.route('/api/v1/<string:name>', methods=['POST'])
+@app.route('/api/v1/<string:name>/<int:record_id>', methods=['PATCH', 'DELETE'])
+@api_login_required
+def api_change(name, record_id=None):
+    resource = api_resource(name)
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    key = idempotency_key() if request.method == 'POST' else None
+    try:
+        if not claim_idempotency_key(c, key):
+            # Retried POST: answer with what the first one created
+            conn.rollback()
+            record_id = idempotent_record(c, key)
+            if record_id is None:
+                raise APIError('requisição em andamento', 409)
+            etag = f'{api_etag(c, resource, resource["fields"])}-{record_id}'
+            return api_response(fetch_api_record(c, resource, record_id, resource['fields']), etag)
+        if request.method == 'DELETE':
+            api_delete(name, record_id)
+        else:
+            record_id = api_write(name, record_id)
+            remember_idempotent_record(c, key, record_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    if request.method == 'DELETE':
+        return Response(status=204)
+    fields = resource['fields']
+    etag = f'{api_etag(c, resource, fields)}-{record_id}'
+    return api_response(fetch_api_record(c, resource, record_id, fields), etag,
+                        201 if request.method == 'POST' else 200)
+
+# Background jobs. Work that doesn't have to finish inside a request is queued in
+# the jobs table and run by a small pool of threads in each worker process (see
+# start_job_workers) or by 'flask --app app run-jobs'. A job is claimed with one
+# UPDATE under BEGIN IMMEDIATE, so every process can poll the same table; a job
+# that raises is retried with exponential backoff up to max_attempts. Scheduled
+# jobs are queued by whichever process gets there first, under a unique key per run.
+app.config['JOB_WORKERS'] = 2  # threads per process, 0 to leave jobs to run-jobs
+app.config['JOB_POLL_SECONDS'] = 5
+app.config['JOB_TIMEOUT_SECONDS'] = 600  # a running job older than this is claimed again
+app.config['JOB_RETENTION_DAYS'] = 30
+app.config['DIGEST_HOUR'] = 7  # local time of the daily deliveries digest
+app.config['DIGEST_EMAIL_TO'] = None  # also mail the digest when this and SMTP_HOST are set
+app.config['SMTP_HOST'] = None
+app.config['SMTP_FROM'] = 'nina@localhost'
+
+JOB_STATUSES = ('queued', 'running', 'done', 'failed')
+JOB_RETRY_SECONDS = 30  # doubled after every failed attempt
+
+JOBS = {}
+
+def job(name, transaction=True):
+    """Register a function(c, payload) as the job called name.
+
+    It runs inside a transaction that is committed when it returns; whatever it
+    returns is stored as the job's result (JSON). With transaction=False it gets
+    the cursor outside any transaction and commits its own work, for jobs that
+    work in batches or need to ATTACH.
+    """
+    def register(func):
+        func.transaction = transaction
+        JOBS[name] = func
+        return func
+    return register
+
+def job_time(moment=None):
+    # Local time like the sales dates; the digest is scheduled by the local clock
+    return (moment or datetime.now()).strftime('%Y-%m-%d %H:%M:%S')
+
+_jobs_wakeup = threading.Event()
+
+def enqueue_job(c, name, payload=None, run_at=None, unique_key=None, max_attempts=3, created_by=None):
+    """Queue a job on the caller's transaction; return its id, or None when a job
+    with the same unique_key already exists."""
+    if name not in JOBS:
+        raise ValueError(f'Unknown job: {name}')
+    c.execute("""INSERT INTO jobs (name, payload, unique_key, max_attempts, run_at, created_by)
+                 VALUES (?, ?, ?, ?, ?, ?)
+                 ON CONFLICT(unique_key) DO NOTHING""",
+              (name, json.dumps(payload or {}), unique_key, max_attempts, job_time(run_at), created_by))
+    if c.rowcount != 1:
+        return None
+    _jobs_wakeup.set()
+    return c.lastrowid
+
+def schedule_jobs(c, now=None):
+    """Queue today's runs of the scheduled jobs if no process has yet."""
+    now = now or datetime.now()
+    day = now.strftime('%Y-%m-%d')
+    digest_at = now.replace(hour=app.config['DIGEST_HOUR'], minute=0, second=0, microsecond=0)
+    enqueue_job(c, 'deliveries_digest', {'day': day}, run_at=digest_at,
+                unique_key=f'deliveries_digest:{day}')
+    enqueue_job(c, 'recurring_expenses', {'day': day},
+                run_at=now.replace(hour=0, minute=0, second=0, microsecond=0),
+                unique_key=f'recurring_expenses:{day}')
+    enqueue_job(c, 'purge_jobs', run_at=now.replace(hour=3, minute=0, second=0, microsecond=0),
+                unique_key=f'purge_jobs:{day}')
+    enqueue_job(c, 'backup_database', run_at=now.replace(hour=app.config['BACKUP_HOUR'], minute=0, second=0,
+                                                         microsecond=0),
+                unique_key=f'backup_database:{day}')
+    if app.config['ARCHIVE_AFTER_DAYS']:
+        enqueue_job(c, 'archive_sales', run_at=now.replace(hour=3, minute=30, second=0, microsecond=0),
+                    unique_key=f'archive_sales:{day}')
+
+def claim_job(conn):
+    """Mark the next due job as running and return (id, name, payload, attempts, max_attempts)."""
+    now = datetime.now()
+    stale = job_time(now - timedelta(seconds=app.config['JOB_TIMEOUT_SECONDS']))
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        c.execute("""UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ?
+                     WHERE id = (SELECT id FROM jobs
+                                 WHERE (status = 'queued' AND run_at <= ?)
+                                    OR (status = 'running' AND started_at < ?)
+                                 ORDER BY run_at, id LIMIT 1)
+                     RETURNING id, name, payload, attempts, max_attempts""",
+                  (job_time(now), job_time(now), stale))
+        claimed = c.fetchone()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return claimed
+
+def run_job(conn, claimed):
+    job_id, name, payload, attempts, max_attempts = claimed
+    c = conn.cursor()
+    try:
+        func = JOBS.get(name)
+        if func is None:
+            raise ValueError(f'Unknown job: {name}')
+        if func.transaction:
+            c.execute('BEGIN IMMEDIATE')
+        result = func(c, json.loads(payload))
+        c.execute("UPDATE jobs SET status = 'done', result = ?, error = NULL, finished_at = ? WHERE id = ?",
+                  (json.dumps(result), job_time(), job_id))
+        conn.commit()
+    except Exception as e:
+        if conn.in_transaction:
+            conn.rollback()
+        app.logger.exception('Job %s (%s) failed on attempt %s', job_id, name, attempts)
+        if attempts < max_attempts:
+            retry_at = datetime.now() + timedelta(seconds=JOB_RETRY_SECONDS * 2 ** (attempts - 1))
+            c.execute("UPDATE jobs SET status = 'queued', run_at = ?, error = ? WHERE id = ?",
+                      (job_time(retry_at), f'{type(e).__name__}: {e}', job_id))
+        else:
+            c.execute("UPDATE jobs SET status = 'failed', finished_at = ?, error = ? WHERE id = ?",
+                      (job_time(), f'{type(e).__name__}: {e}', job_id))
+        conn.commit()
+
+def run_pending_jobs(conn, limit=None):
+    """Run due jobs until none is left (or limit is reached); return how many ran."""
+    ran = 0
+    while limit is None or ran < limit:
+        claimed = claim_job(conn)
+        if claimed is None:
+            break
+        with app.app_context():
+            run_job(conn, claimed)
+        ran += 1
+    return ran
+
+def job_worker(stop):
+    conn = connect_db()
+    scheduled_on = None
+    while not stop.is_set():
+        try:
+            today = datetime.now().date()
+            if scheduled_on != today:
+                c = conn.cursor()
+                c.execute('BEGIN IMMEDIATE')
+                schedule_jobs(c)
+                conn.commit()
+                scheduled_on = today
+            run_pending_jobs(conn)
+        except sqlite3.Error:
+            # e.g. the database stayed locked past busy_timeout; try again next round
+            if conn.in_transaction:
+                conn.rollback()
+            app.logger.exception('Job worker error')
+        _jobs_wakeup.wait(app.config['JOB_POLL_SECONDS'])
+        _jobs_wakeup.clear()
+    conn.close()
+
+_job_workers = []
+_job_workers_stop = threading.Event()
+
+def start_job_workers(count=None):
+    """Start the job threads of this process (once; call it after forking)."""
+    if _job_workers:
+        return
+    count = app.config['JOB_WORKERS'] if count is None else count
+    for number in range(count):
+        thread = threading.Thread(target=job_worker, args=(_job_workers_stop,),
+                                  name=f'job-worker-{number}', daemon=True)
+        thread.start()
+        _job_workers.append(thread)
+
+@app.cli.command('run-jobs')
+@click.option('--once', is_flag=True, help='Run the jobs that are due and exit.')
+def run_jobs_command(once):
+    """Run background jobs in this process (schedules the daily ones too)."""
+    if once:
+        conn = connect_db()
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        schedule_jobs(c)
+        conn.commit()
+        click.echo(f'Ran {run_pending_jobs(conn)} job(s)')
+        conn.close()
+        return
+    job_worker(_job_workers_stop)
+
+@job('rebuild_totals', transaction=False)
+def rebuild_totals_job(c, payload):
+    return {'days': rebuild_totals(c.connection)}
+
+@job('purge_jobs')
+def purge_jobs_job(c, payload):
+    cutoff = job_time(datetime.now() - timedelta(days=app.config['JOB_RETENTION_DAYS']))
+    c.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (cutoff,))
+    return {'deleted': c.rowcount}
+
+@job('recurring_expenses')
+def recurring_expenses_job(c, payload):
+    return {'created': materialize_recurring_expenses(c, payload.get('day'))}
+
+def deliveries_due(c, day):
+    """Undelivered sales due on day, and how many are overdue from before it."""
+    c.execute("""SELECT id, customer_name, total_amount, is_paid, delivery_date
+                 FROM sales WHERE is_delivered = 0 AND delivery_date = ?
+                 ORDER BY id""", (day,))
+    sales = c.fetchall()
+    sale_items = fetch_sale_items(c, [sale[0] for sale in sales])
+    c.execute("SELECT COUNT(*) FROM sales WHERE is_delivered = 0 AND delivery_date < ?", (day,))
+    overdue = c.fetchone()[0]
+    return [{'id': sale[0], 'customer_name': sale[1], 'total_amount': sale[2], 'is_paid': bool(sale[3]),
+             'items': [[item[1], item[2]] for item in sale_items.get(sale[0], [])]}
+            for sale in sales], overdue
+
+def format_digest(digest):
+    day = datetime.strptime(digest['day'], '%Y-%m-%d').strftime('%d/%m/%Y')
+    lines = [f'Entregas para {day}: {len(digest["sales"])}']
+    for sale in digest['sales']:
+        items = ', '.join(f'{quantity}x {name}' for quantity, name in sale['items'])
+        paid = 'pago' if sale['is_paid'] else 'a receber'
+        lines.append(f'- #{sale["id"]} {sale["customer_name"]}: {items} '
+                     f'(R$ {sale["total_amount"]:.2f}, {paid})')
+    if digest['overdue']:
+        lines.append(f'Atrasadas de dias anteriores: {digest["overdue"]}')
+    return '\n'.join(lines)
+
+@job('deliveries_digest')
+def deliveries_digest_job(c, payload):
+    day = payload.get('day') or datetime.now().strftime('%Y-%m-%d')
+    sales, overdue = deliveries_due(c, day)
+    digest = {'day': day, 'sales': sales, 'overdue': overdue}
+    if app.config['DIGEST_EMAIL_TO'] and app.config['SMTP_HOST']:
+        # A failure here fails the job, so the mail is retried with it
+        message = EmailMessage()
+        message['Subject'] = f'Entregas de {datetime.strptime(day, "%Y-%m-%d").strftime("%d/%m/%Y")}'
+        message['From'] = app.config['SMTP_FROM']
+        message['To'] = app.config['DIGEST_EMAIL_TO']
+        message.set_content(format_digest(digest))
+        with smtplib.SMTP(app.config['SMTP_HOST'], timeout=30) as smtp:
+            smtp.send_message(message)
+        digest['emailed'] = True
+    return digest
+
+# Hot/cold archival. Closed sales (delivered and paid) older than
+# ARCHIVE_AFTER_DAYS are moved with their items into sales-archive.db, so
+# database.db only holds the sales still in play; sale_archives keeps the count
+# and date range archived per year. The rollups keep counting them. Reports
+# whose date range reaches an archived date ATTACH the archive read-only and
+# read the all_sales and all_sales_items temp views, UNION ALL of the hot tables
+# and the archive; the rest never open it. The archive is one file rather than
+# one per year because SQLite attaches at most 10 databases to a connection and
+# all-time reads (rebuild-totals, exports, customer ledgers) need every year.
+# The JSON API and search read archived sales too, but can't change them.
+app.config['ARCHIVE_AFTER_DAYS'] = 365  # None to keep every sale in database.db
+app.config['ARCHIVE_DIR'] = None  # defaults to the directory of DATABASE
+
+ARCHIVE_FILE = 'sales-archive.db'
+ARCHIVE_BATCH_SIZE = 500  # sales moved per transaction
+ARCHIVE_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_sales_date ON sales (date)',
+    'CREATE INDEX IF NOT EXISTS idx_sales_status_date ON sales (is_delivered, is_paid, date)',
+    'CREATE INDEX IF NOT EXISTS idx_sales_customer_date ON sales (customer_id, date)',
+    'CREATE INDEX IF NOT EXISTS idx_sales_items_sale_id ON sales_items (sale_id)',
+]
+
+def archive_path():
+    directory = app.config['ARCHIVE_DIR'] or os.path.dirname(os.path.abspath(app.config['DATABASE']))
+    return os.path.join(directory, ARCHIVE_FILE)
+
+def table_columns(c, table, schema='main'):
+    """[(name, type), ...] of a table's columns."""
+    return [(row[1], row[2]) for row in c.execute(f'PRAGMA {schema}.table_info({table})').fetchall()]
+
+def archive_uri():
+    """URI opening the archive read-only."""
+    return 'file:' + pathname2url(archive_path()) + '?mode=ro'
+
+def archived_through(c):
+    """Date of the newest archived sale, or None if nothing was archived."""
+    c.execute("SELECT MAX(last_date) FROM sale_archives")
+    return c.fetchone()[0]
+
+def attach_archives(conn):
+    """ATTACH the archive read-only and (re)create the all_sales and
+    all_sales_items views over it; return whether anything was archived.
+
+    ATTACH can't run inside a transaction. The archive stays attached to the
+    (pooled) connection, and the views are only recreated when a migration or
+    an archive run has changed the columns.
+    """
+    c = conn.cursor()
+    if archived_through(c) is None:
+        return False
+    if 'archive' not in {row[1] for row in c.execute('PRAGMA database_list').fetchall()}:
+        c.execute('ATTACH DATABASE ? AS archive', (archive_uri(),))
+    for table in ('sales', 'sales_items'):
+        columns = [name for name, _ in table_columns(c, table)]
+        # The archive lacks the columns of migrations applied after it was written
+        present = {name for name, _ in table_columns(c, table, 'archive')}
+        hot = ', '.join(columns)
+        cold = ', '.join(name if name in present else f'NULL AS {name}' for name in columns)
+        if table == 'sales':
+            # Archived sales are read-only, the listings drop their edit links
+            hot, cold = hot + ', 0 AS archived', cold + ', 1 AS archived'
+        sql = (f"CREATE TEMP VIEW all_{table} AS "
+               f"SELECT {hot} FROM main.{table} UNION ALL SELECT {cold} FROM archive.{table}")
+        c.execute("SELECT sql FROM sqlite_temp_master WHERE name = ?", (f'all_{table}',))
+        row = c.fetchone()
+        if not row or row[0] != sql:
+            c.execute(f'DROP VIEW IF EXISTS temp.all_{table}')
+            c.execute(sql)
+    return True
+
+def sales_tables(c, since=None):
+    """Return the (sales, sales_items) tables to read sales dated from since
+    (YYYY-MM-DD, None for all time): the hot tables, or the all_* views when
+    archived sales reach back that far."""
+    archived = archived_through(c)
+    if archived is None or (since is not None and since > archived):
+        return 'sales', 'sales_items'
+    attach_archives(c.connection)
+    return 'all_sales', 'all_sales_items'
+
+def sale_archived(c, sale_id):
+    """Whether sale_id was moved to the archive, where it can't be changed.
+
+    Reads the archive on a connection of its own, so it works inside the
+    caller's transaction.
+    """
+    if archived_through(c) is None:
+        return False
+    archive = connect_db(archive_uri())
+    try:
+        return archive.execute("SELECT 1 FROM sales WHERE id = ?", (sale_id,)).fetchone() is not None
+    finally:
+        archive.close()
+
+def sale_unavailable(c, sale_id):
+    """None if sale_id can be changed, else the message to flash."""
+    c.execute("SELECT 1 FROM sales WHERE id = ?", (sale_id,))
+    if c.fetchone():
+        return None
+    if sale_archived(c, sale_id):
+        return 'Venda arquivada: vendas antigas já fechadas não podem ser alteradas'
+    return 'Venda não encontrada'
+
+def write_archive(year, sales, sale_columns, items, item_columns):
+    """Copy sales of one year and their items into the archive, creating it or
+    adding columns as needed; return the year's (sales_count, first_date, last_date)
+    in the archive."""
+    conn = connect_db(archive_path())
+    try:
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        for table, columns in (('sales', sale_columns), ('sales_items', item_columns)):
+            c.execute(f'CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY)')
+            present = {name for name, _ in table_columns(c, table)}
+            for name, definition in columns:
+                if name not in present:
+                    c.execute(f'ALTER TABLE {table} ADD COLUMN {name} {definition}')
+        for statement in ARCHIVE_INDEXES:
+            c.execute(statement)
+        # OR REPLACE: a run interrupted after this commit copies the same rows again
+        for table, columns, rows in (('sales', sale_columns, sales), ('sales_items', item_columns, items)):
+            c.executemany(f"""INSERT OR REPLACE INTO {table} ({', '.join(name for name, _ in columns)})
+                              VALUES ({', '.join('?' * len(columns))})""", rows)
+        c.execute("SELECT COUNT(*), MIN(date), MAX(date) FROM sales WHERE date >= ? AND date < ?",
+                  (year, str(int(year) + 1)))
+        stats = c.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+    return stats
+
+def archive_sales_batch(c, cutoff, limit=ARCHIVE_BATCH_SIZE):
+    """Move up to limit closed sales dated before cutoff to the archive, on the
+    caller's transaction; return how many were moved.
+
+    The archive is committed before the sales are deleted here, so a crash in
+    between leaves them in both places (the views show them twice) until the
+    next run copies them again and deletes them.
+    """
+    c.execute("""SELECT id, substr(date, 1, 4) FROM sales
+                 WHERE is_delivered = 1 AND is_paid = 1 AND date < ?
+                   AND date GLOB '[0-9][0-9][0-9][0-9]-*'
+                 ORDER BY date, id
+                 LIMIT ?""", (cutoff, limit))
+    years = {}
+    for sale_id, year in c.fetchall():
+        years.setdefault(year, []).append(sale_id)
+
+    sale_columns = table_columns(c, 'sales')
+    item_columns = table_columns(c, 'sales_items')
+    moved = 0
+    for year, sale_ids in years.items():
+        placeholders = ','.join('?' * len(sale_ids))
+        c.execute(f"SELECT {', '.join(name for name, _ in sale_columns)} FROM sales WHERE id IN ({placeholders})",
+                  sale_ids)
+        sales = c.fetchall()
+        c.execute(f"""SELECT {', '.join(name for name, _ in item_columns)} FROM sales_items
+                      WHERE sale_id IN ({placeholders})""", sale_ids)
+        items = c.fetchall()
+        sales_count, first_date, last_date = write_archive(year, sales, sale_columns, items, item_columns)
+
+        # The delete triggers drop the search rows: put them back so /search still
+        # finds archived sales. Sales first, so the item triggers find none to update.
+        c.execute(f"SELECT rowid, customer_name, recipes FROM sales_search WHERE rowid IN ({placeholders})",
+                  sale_ids)
+        search_rows = c.fetchall()
+        c.execute(f"DELETE FROM sales WHERE id IN ({placeholders})", sale_ids)
+        c.execute(f"DELETE FROM sales_items WHERE sale_id IN ({placeholders})", sale_ids)
+        c.executemany("INSERT INTO sales_search (rowid, customer_name, recipes) VALUES (?, ?, ?)", search_rows)
+        c.execute("""INSERT INTO sale_archives (year, sales_count, first_date, last_date, archived_at)
+                     VALUES (?, ?, ?, ?, ?)
+                     ON CONFLICT(year) DO UPDATE SET
+                         sales_count = excluded.sales_count,
+                         first_date = excluded.first_date,
+                         last_date = excluded.last_date,
+                         archived_at = excluded.archived_at""",
+                  (year, sales_count, first_date, last_date, job_time()))
+        moved += len(sale_ids)
+    return moved
+
+def archive_sales(days=None):
+    """Move every closed sale older than days (ARCHIVE_AFTER_DAYS by default)
+    to the archive, ARCHIVE_BATCH_SIZE per transaction; return how many moved.
+
+    Uses its own connection: one with the archive attached would hold it
+    read-locked for the whole transaction.
+    """
+    days = app.config['ARCHIVE_AFTER_DAYS'] if days is None else days
+    if days is None:
+        return 0
+    cutoff = (datetime.now().date() - timedelta(days=days)).isoformat()
+    conn = connect_db()
+    moved = 0
+    try:
+        while True:
+            c = conn.cursor()
+            c.execute('BEGIN IMMEDIATE')
+            try:
+                count = archive_sales_batch(c, cutoff)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            moved += count
+            if count < ARCHIVE_BATCH_SIZE:
+                break
+    finally:
+        conn.close()
+    return moved
+
+@app.cli.command('archive-sales')
+@click.option('--days', type=int, help='Archive closed sales older than this (default ARCHIVE_AFTER_DAYS).')
+def archive_sales_command(days):
+    """Move old closed sales from the database into the archive."""
+    moved = archive_sales(days)
+    click.echo(f'Archived {moved} sales')
+
+@job('archive_sales', transaction=False)
+def archive_sales_job(c, payload):
+    return {'archived': archive_sales(payload.get('days'))}
+
+# Online backups. connection.backup() copies BACKUP_STEP_PAGES pages per step
+# and the progress callback sleeps between steps, so writers get their turn on
+# the database while it runs. Each run writes a directory named after its time
+# with the database and the sales archive, each checked with PRAGMA
+# integrity_check and gzipped, then rotate_backups() keeps the newest backup of
+# each of the last BACKUP_KEEP_DAILY days, BACKUP_KEEP_WEEKLY weeks and
+# BACKUP_KEEP_MONTHLY months. To restore, stop the app and gunzip the files
+# back in place.
+app.config['BACKUP_DIR'] = None  # defaults to backups/ next to DATABASE
+app.config['BACKUP_HOUR'] = 2  # local time of the nightly backup
+app.config['BACKUP_KEEP_DAILY'] = 7
+app.config['BACKUP_KEEP_WEEKLY'] = 4
+app.config['BACKUP_KEEP_MONTHLY'] = 12
+
+BACKUP_STEP_PAGES = 256
+BACKUP_STEP_PAUSE = 0.005  # seconds between steps
+BACKUP_MAX_RESTARTS = 3
+BACKUP_STAMP = '%Y-%m-%d_%H%M%S'
+
+class BackupRestarted(Exception):
+    pass
+
+def backup_dir():
+    return app.config['BACKUP_DIR'] or os.path.join(
+        os.path.dirname(os.path.abspath(app.config['DATABASE'])), 'backups')
+
+def copy_database(source_path, target_path):
+    """Copy a live database into target_path with the backup API and check the
+    copy, which is switched to a rollback journal so it stays a single file."""
+    if not os.path.exists(source_path):
+        raise FileNotFoundError(source_path)
+    source = connect_db(source_path)
+    target = sqlite3.connect(target_path)
+    try:
+        previous = None
+        restarts = 0
+
+        def pause(status, remaining, total):
+            nonlocal previous, restarts
+            if previous is not None and remaining > previous:
+                # Another connection wrote to the source and the copy started over
+                restarts += 1
+                if restarts > BACKUP_MAX_RESTARTS:
+                    raise BackupRestarted()
+            previous = remaining
+            time.sleep(BACKUP_STEP_PAUSE)
+
+        try:
+            source.backup(target, pages=BACKUP_STEP_PAGES, progress=pause)
+        except BackupRestarted:
+            # Written to faster than it copies: finish in one step, a single read
+            # transaction, which doesn't hold writers back under WAL either
+            source.backup(target)
+        target.execute('PRAGMA journal_mode = DELETE')
+        problems = [row[0] for row in target.execute('PRAGMA integrity_check').fetchall()]
+        if problems != ['ok']:
+            raise RuntimeError(f'integrity_check failed on the copy of {source_path}: {"; ".join(problems[:5])}')
+    finally:
+        target.close()
+        source.close()
+
+def backup_database(now=None):
+    """Write a checked, compressed backup of the database and the sales archive;
+    return its directory."""
+    now = now or datetime.now()
+    target = os.path.join(backup_dir(), now.strftime(BACKUP_STAMP))
+    if os.path.exists(target):
+        raise FileExistsError(target)  # another run in the same second
+    partial = target + '.partial'
+    os.makedirs(partial)
+    try:
+        conn = connect_db()
+        try:
+            archived = archived_through(conn.cursor()) is not None
+        finally:
+            conn.close()
+        for path in [app.config['DATABASE']] + ([archive_path()] if archived else []):
+            copy = os.path.join(partial, os.path.basename(path))
+            copy_database(path, copy)
+            with open(copy, 'rb') as f, gzip.open(copy + '.gz', 'wb', compresslevel=6) as out:
+                shutil.copyfileobj(f, out, 1024 * 1024)
+            os.remove(copy)
+        # Only complete backups get a name rotate_backups() and a restore would pick
+        os.replace(partial, target)
+    except Exception:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    return target
+
+def rotate_backups(directory=None):
+    """Delete the backups outside the daily, weekly and monthly retention;
+    return how many were deleted."""
+    directory = directory or backup_dir()
+    stamps = {}
+    for name in os.listdir(directory):
+        try:
+            stamps[name] = datetime.strptime(name, BACKUP_STAMP)
+        except ValueError:
+            continue  # runs in progress and anything else
+    keep = set()
+    for period, count in ((lambda t: t.date(), app.config['BACKUP_KEEP_DAILY']),
+                          (lambda t: t.isocalendar()[:2], app.config['BACKUP_KEEP_WEEKLY']),
+                          (lambda t: (t.year, t.month), app.config['BACKUP_KEEP_MONTHLY'])):
+        periods = set()
+        for name in sorted(stamps, key=stamps.get, reverse=True):
+            if period(stamps[name]) in periods:
+                continue
+            if len(periods) >= count:
+                break
+            periods.add(period(stamps[name]))
+            keep.add(name)
+    removed = [name for name in stamps if name not in keep]
+    for name in removed:
+        shutil.rmtree(os.path.join(directory, name))
+    return len(removed)
+
+def backup_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+@app.cli.command('backup-db')
+@click.option('--no-rotate', is_flag=True, help='Keep every earlier backup.')
+def backup_db_command(no_rotate):
+    """Back up the database and the sales archive while the app keeps running."""
+    started = time.perf_counter()
+    path = backup_database()
+    click.echo(f'Wrote {path} ({backup_size(path) / 1024:.0f} KB) in {time.perf_counter() - started:.1f}s')
+    if not no_rotate:
+        click.echo(f'Removed {rotate_backups()} old backup(s)')
+
+@job('backup_database', transaction=False)
+def backup_database_job(c, payload):
+    started = time.perf_counter()
+    path = backup_database()
+    return {'path': path, 'bytes': backup_size(path), 'seconds': round(time.perf_counter() - started, 1),
+            'removed': rotate_backups()}
+
+@app.route('/jobs')
+@login_required
+def jobs():
+    if not current_user.is_admin:
+        flash('Você não tem permissão para acessar essa página', 'danger')
+        return redirect(url_for('recipes'))
+
+    c = get_db().cursor()
+    counts = dict.fromkeys(JOB_STATUSES, 0)
+    c.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+    counts.update(c.fetchall())
+    c.execute("""SELECT id, name, status, attempts, max_attempts, run_at, started_at,
+                        finished_at, error
+                 FROM jobs ORDER BY id DESC LIMIT 50""")
+    recent = c.fetchall()
+    c.execute("""SELECT result FROM jobs WHERE name = 'deliveries_digest' AND status = 'done'
+                 ORDER BY id DESC LIMIT 1""")
+    row = c.fetchone()
+    digest = format_digest(json.loads(row[0])) if row else None
+    c.execute("SELECT year, sales_count, first_date, last_date, archived_at FROM sale_archives ORDER BY year")
+    archives = c.fetchall()
+    return render_template('jobs.html', counts=counts, jobs=recent, digest=digest, archives=archives,
+                           workers=len(_job_workers), job_names=sorted(JOBS))
+
+@app.route('/jobs/enqueue', methods=['POST'])
+@login_required
+def enqueue_job_now():
+    if not current_user.is_admin:
+        flash('Permission denied', 'danger')
+        return redirect(url_for('jobs'))
+    name = request.form.get('name', '')
+    if name not in JOBS:
+        flash('Unknown job', 'danger')
+        return redirect(url_for('jobs'))
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    job_id = enqueue_job(c, name, created_by=current_user.id)
+    conn.commit()
+    flash(f'Job #{job_id} ({name}) queued', 'success')
+    return redirect(url_for('jobs'))
+
+@app.route('/jobs/<int:job_id>/retry', methods=['POST'])
+@login_required
+def retry_job(job_id):
+    if not current_user.is_admin:
+        flash('Permission denied', 'danger')
+        return redirect(url_for('jobs'))
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    c.execute("""UPDATE jobs SET status = 'queued', attempts = 0, run_at = ?, finished_at = NULL
+                 WHERE id = ? AND status = 'failed'""", (job_time(), job_id))
+    retried = c.rowcount
+    conn.commit()
+    if retried:
+        _jobs_wakeup.set()
+        flash(f'Job #{job_id} queued again', 'success')
+    else:
+        flash('Only failed jobs can be retried', 'danger')
+    return redirect(url_for('jobs'))
+
 if __name__ == '__main__':
+    init_db()
+    start_job_workers()
     app.run(debug=True)
@@ -0,0 +1,321 @@
+"""Static asset build: 'flask --app app build-assets'.
+
+Downloads the pinned third-party files once (into .asset-cache/), then writes
+to static/dist/:
+
+- app.css: the Tailwind and Font Awesome stylesheets purged down to the
+  classes our templates, scripts and app.py use, plus the Pacifico and
+  Montserrat @font-face rules (latin subset)
+- the Font Awesome solid font, subset to the icons left in app.css
+- chart.js, app.js and the logo
+
+Every file gets a content hash in its name and, for text files, .gz and .br
+siblings. manifest.json maps the logical names to the hashed ones; asset_url()
+in app.py reads it, and built_asset() serves the files with
+'Cache-Control: immutable' and the precompressed variant the browser accepts.
+
+fonttools (with brotli) is needed to subset the icon font and brotli to write
+.br files; without them the full font is shipped and only .gz is written.
+"""
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import urllib.request
+
+try:
+    from fontTools import subset as font_subset
+except ImportError:  # optional, the icon font is shipped whole without it
+    font_subset = None
+
+try:
+    import brotli
+except ImportError:  # optional, only .gz variants are written without it
+    brotli = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(ROOT, '.asset-cache')
+DIST_DIR = os.path.join(ROOT, 'static', 'dist')
+MANIFEST = 'manifest.json'
+
+# Pinned third-party sources
+VENDOR = {
+    'tailwind.min.css': 'https://cdn.jsdelivr.net/npm/tailwindcss@2.2.19/dist/tailwind.min.css',
+    'fontawesome.min.css': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css',
+    'fa-solid-900.woff2': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/webfonts/fa-solid-900.woff2',
+    'pacifico.woff2': 'https://cdn.jsdelivr.net/npm/@fontsource/pacifico@5.0.8/files/pacifico-latin-400-normal.woff2',
+    'montserrat.woff2': 'https://cdn.jsdelivr.net/npm/@fontsource/montserrat@5.0.8/files/montserrat-latin-400-normal.woff2',
+    'chart.umd.js': 'https://cdn.jsdelivr.net/npm/chart.js@4.4.0/dist/chart.umd.js',
+}
+
+# Our own files that go through the pipeline as they are
+LOCAL = {'app.js': 'app.js', 'logo.png': 'logo.png'}
+
+# Text fonts used by base.html; the latin subset covers Portuguese
+TEXT_FONTS = (('Pacifico', 'pacifico.woff2'), ('Montserrat', 'montserrat.woff2'))
+
+# Files whose class names count as used
+CLASS_SOURCES = ('templates', 'static/app.js', 'app.py')
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json')
+
+
+def fetch(name):
+    path = os.path.join(CACHE_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with urllib.request.urlopen(VENDOR[name], timeout=60) as response:
+            data = response.read()
+        with open(path + '.part', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.part', path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def used_tokens():
+    """Every class-like word in the templates, our script and app.py."""
+    tokens = set()
+    for source in CLASS_SOURCES:
+        path = os.path.join(ROOT, source)
+        paths = ([os.path.join(path, name) for name in sorted(os.listdir(path))]
+                 if os.path.isdir(path) else [path])
+        for path in paths:
+            with open(path, encoding='utf-8') as f:
+                tokens.update(re.findall(r'[A-Za-z0-9_:/.%-]+', f.read()))
+    return tokens
+
+
+# Minimal CSS handling, enough for the minified Tailwind and Font Awesome builds
+def skip_string(css, i):
+    quote = css[i]
+    i += 1
+    while css[i] != quote:
+        i += 2 if css[i] == '\\' else 1
+    return i + 1
+
+
+def find_block_end(css, i):
+    """Index just past the '}' closing the block whose '{' is at css[i]."""
+    depth = 0
+    while True:
+        char = css[i]
+        if char in '"\'':
+            i = skip_string(css, i)
+            continue
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+
+
+def parse_css(css):
+    """Split a stylesheet into (prelude, body) pairs; body is a list of pairs for
+    @media/@supports and the raw declarations for everything else."""
+    nodes = []
+    i = 0
+    while i < len(css):
+        start = i
+        while i < len(css) and css[i] not in '{;':
+            i = skip_string(css, i) if css[i] in '"\'' else i + 1
+        if i >= len(css):
+            break
+        prelude = css[start:i].strip()
+        if css[i] == ';':
+            # @charset, @import and the like
+            nodes.append((prelude, None))
+            i += 1
+            continue
+        end = find_block_end(css, i)
+        body = css[i + 1:end - 1]
+        if prelude.startswith(('@media', '@supports')):
+            nodes.append((prelude, parse_css(body)))
+        else:
+            nodes.append((prelude, body))
+        i = end
+    return nodes
+
+
+def split_selectors(prelude):
+    selectors, depth, start = [], 0, 0
+    for i, char in enumerate(prelude):
+        if char in '([':
+            depth += 1
+        elif char in ')]':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            selectors.append(prelude[start:i])
+            start = i + 1
+    selectors.append(prelude[start:])
+    return selectors
+
+
+CLASS_RE = re.compile(r'\.((?:\\[0-9a-fA-F]{1,6} ?|\\.|[A-Za-z0-9_-])+)')
+ESCAPE_RE = re.compile(r'\\([0-9a-fA-F]{1,6}) ?|\\(.)')
+
+
+def selector_classes(selector):
+    return [ESCAPE_RE.sub(lambda m: chr(int(m.group(1), 16)) if m.group(1) else m.group(2), name)
+            for name in CLASS_RE.findall(selector)]
+
+
+def purge(nodes, used):
+    """Drop the selectors naming a class that isn't used, and rules left empty."""
+    kept = []
+    for prelude, body in nodes:
+        if isinstance(body, list):
+            body = purge(body, used)
+            if body:
+                kept.append((prelude, body))
+        elif body is None or prelude.startswith('@'):
+            kept.append((prelude, body))
+        else:
+            selectors = [s for s in split_selectors(prelude)
+                         if all(name in used for name in selector_classes(s))]
+            if selectors:
+                kept.append((','.join(selectors), body))
+    return kept
+
+
+def drop_unused_keyframes(nodes):
+    """Drop @keyframes that no remaining rule animates with."""
+    def declarations(nodes):
+        for prelude, body in nodes:
+            if isinstance(body, list):
+                yield from declarations(body)
+            elif body and 'keyframes' not in prelude:
+                yield body
+    used = ' '.join(declarations(nodes))
+
+    def keep(nodes):
+        kept = []
+        for prelude, body in nodes:
+            if isinstance(body, list):
+                kept.append((prelude, keep(body)))
+            elif 'keyframes' not in prelude.split(None, 1)[0] or re.search(
+                    rf'animation(?:-name)?:[^;}}]*\b{re.escape(prelude.split()[-1])}\b', used):
+                kept.append((prelude, body))
+        return kept
+    return keep(nodes)
+
+
+def render_css(nodes):
+    return ''.join(f'{prelude};' if body is None
+                   else f'{prelude}{{{render_css(body) if isinstance(body, list) else body}}}'
+                   for prelude, body in nodes)
+
+
+def license_banners(css):
+    return ''.join(re.findall(r'/\*!.*?\*/', css, re.S))
+
+
+def strip_comments(css):
+    return re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+
+
+def icon_codepoints(nodes):
+    points = set()
+    for prelude, body in nodes:
+        if isinstance(body, list):
+            points |= icon_codepoints(body)
+        elif body:
+            points.update(int(point, 16) for point in re.findall(r'(?:content|--fa):\s*"\\([0-9a-fA-F]+)"', body))
+    return points
+
+
+def subset_font(data, codepoints):
+    if font_subset is None or brotli is None or not codepoints:
+        return data
+    options = font_subset.Options()
+    options.flavor = 'woff2'
+    options.layout_features = ['*']
+    font = font_subset.load_font(io.BytesIO(data), options)
+    subsetter = font_subset.Subsetter(options)
+    subsetter.populate(unicodes=sorted(codepoints))
+    subsetter.subset(font)
+    out = io.BytesIO()
+    font_subset.save_font(font, out, options)
+    return out.getvalue()
+
+
+class Build:
+    def __init__(self):
+        self.manifest = {}
+
+    def write(self, name, data):
+        """Write data under its hashed name and return that name."""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        stem, ext = os.path.splitext(name)
+        hashed = f'{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}'
+        path = os.path.join(DIST_DIR, hashed)
+        with open(path, 'wb') as f:
+            f.write(data)
+        if ext in COMPRESSIBLE:
+            with open(path + '.gz', 'wb') as f:
+                # mtime=0 keeps the output identical between builds
+                f.write(gzip.compress(data, 9, mtime=0))
+            if brotli is not None:
+                with open(path + '.br', 'wb') as f:
+                    f.write(brotli.compress(data, quality=11))
+        self.manifest[name] = hashed
+        return hashed
+
+
+def build_css(build, used):
+    tailwind = fetch('tailwind.min.css').decode('utf-8')
+    fontawesome = fetch('fontawesome.min.css').decode('utf-8')
+
+    icons = purge(parse_css(strip_comments(fontawesome)), used)
+    icon_font = build.write('fa-solid-900.woff2', subset_font(fetch('fa-solid-900.woff2'), icon_codepoints(icons)))
+    faces = []
+    for prelude, body in icons:
+        if prelude != '@font-face':
+            faces.append((prelude, body))
+        elif 'fa-solid-900' in body:
+            # Only the solid style is used; point it at our copy, woff2 only
+            body = re.sub(r'src:[^;}]*', f'src:url({icon_font}) format("woff2")', body)
+            faces.append((prelude, body))
+    icons = faces
+
+    text_fonts = ''.join(
+        f'@font-face{{font-family:"{family}";font-style:normal;font-weight:400;font-display:swap;'
+        f'src:url({build.write(filename, fetch(filename))}) format("woff2")}}'
+        for family, filename in TEXT_FONTS)
+
+    rules = drop_unused_keyframes(purge(parse_css(strip_comments(tailwind)), used) + icons)
+    css = license_banners(tailwind) + license_banners(fontawesome) + text_fonts + render_css(rules)
+    build.write('app.css', css)
+
+
+def build_assets():
+    """Build static/dist and return the manifest."""
+    os.makedirs(DIST_DIR, exist_ok=True)
+    try:
+        with open(os.path.join(DIST_DIR, MANIFEST)) as f:
+            previous = set(json.load(f).values())
+    except (OSError, ValueError):
+        previous = set()
+    build = Build()
+    build_css(build, used_tokens())
+    build.write('chart.js', fetch('chart.umd.js'))
+    for name, filename in LOCAL.items():
+        with open(os.path.join(ROOT, 'static', filename), 'rb') as f:
+            build.write(name, f.read())
+
+    with open(os.path.join(DIST_DIR, MANIFEST), 'w') as f:
+        json.dump(build.manifest, f, indent=2, sort_keys=True)
+
+    # Drop files from earlier builds, except the previous one's: pages and
+    # service worker caches still open on it keep working until they reload
+    current = set(build.manifest.values()) | previous
+    for name in os.listdir(DIST_DIR):
+        base = name[:-3] if name.endswith(('.gz', '.br')) else name
+        if name != MANIFEST and base not in current:
+            os.remove(os.path.join(DIST_DIR, name))
+    return build.manifest
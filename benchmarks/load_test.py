@@ -0,0 +1,178 @@
+"""Load test for the WSGI entry point at several worker counts.
+
+Builds a synthetic database, then for each worker count starts
+`gunicorn wsgi:app`, logs in and hammers /sales and /results from concurrent
+keep-alive clients, printing requests/sec and latency percentiles.
+
+    pip install gunicorn
+    python benchmarks/load_test.py [--workers 1 4 8] [--threads 4]
+                                   [--concurrency 16] [--duration 10] [--json out.json]
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import generate  # noqa: E402
+
+PATHS = ['/sales', '/results']
+
+
+def build_database(path, n_sales, n_expenses):
+    import app
+    from werkzeug.security import generate_password_hash
+
+    app.app.config['DATABASE'] = path
+    app.init_db()
+    conn = sqlite3.connect(path)
+    generate(conn, sales=n_sales, expenses=n_expenses)
+    conn.execute("INSERT INTO users (username, password, is_admin) VALUES (?, ?, 1)",
+                 ('bench', generate_password_hash('bench')))
+    conn.commit()
+    conn.close()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(db_path, workers, threads, port):
+    env = dict(os.environ, FLASK_DATABASE=db_path, FLASK_SECRET_KEY='bench',
+               FLASK_SESSION_COOKIE_SECURE='false', FLASK_SESSION_COOKIE_DOMAIN='null')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--threads', str(threads),
+         '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', 'wsgi:app'],
+        cwd=ROOT, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                sys.exit('gunicorn exited during startup')
+            time.sleep(0.2)
+    server.terminate()
+    sys.exit('gunicorn did not start listening in time')
+
+
+def login(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('POST', '/login', urllib.parse.urlencode({'username': 'bench', 'password': 'bench'}),
+                 {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = conn.getresponse()
+    response.read()
+    cookie = response.getheader('Set-Cookie', '').split(';', 1)[0]
+    if response.status != 302 or not cookie:
+        sys.exit(f'login failed: {response.status}')
+    return cookie
+
+
+def hammer(port, path, cookie, concurrency, duration):
+    latencies, errors = [], []
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        mine, failed = [], 0
+        while time.monotonic() < stop_at:
+            started = time.perf_counter()
+            try:
+                conn.request('GET', path, headers={'Cookie': cookie})
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    failed += 1
+                    continue
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port)
+                continue
+            mine.append(time.perf_counter() - started)
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            errors.append(failed)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+
+    return {'requests': len(latencies), 'errors': sum(errors),
+            'rps': len(latencies) / duration, 'p50_ms': percentile(0.50), 'p95_ms': percentile(0.95)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--threads', type=int, default=4, help='threads per worker')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per route')
+    parser.add_argument('--sales', type=int, default=50000)
+    parser.add_argument('--expenses', type=int, default=5000)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        sys.exit('gunicorn is required: pip install gunicorn')
+
+    workdir = tempfile.mkdtemp(prefix='nina-bench-')
+    db_path = os.path.join(workdir, 'bench.db')
+    print(f'Populating {args.sales} sales in {db_path} ...')
+    build_database(db_path, args.sales, args.expenses)
+
+    results = []
+    print(f'\n{"workers":>7} {"route":<10} {"req/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"errors":>7}')
+    for workers in args.workers:
+        port = free_port()
+        server = start_server(db_path, workers, args.threads, port)
+        try:
+            cookie = login(port)
+            for path in PATHS:
+                hammer(port, path, cookie, args.concurrency, 1)  # warm up every worker
+                result = hammer(port, path, cookie, args.concurrency, args.duration)
+                result.update(workers=workers, threads=args.threads, route=path)
+                results.append(result)
+                print(f'{workers:>7} {path:<10} {result["rps"]:>9.1f} {result["p50_ms"]:>8.1f} '
+                      f'{result["p95_ms"]:>8.1f} {result["errors"]:>7}')
+        finally:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'cpus': os.cpu_count(), 'concurrency': args.concurrency,
+                       'sales': args.sales, 'results': results}, f, indent=2)
+
+    for name in os.listdir(workdir):
+        os.remove(os.path.join(workdir, name))
+    os.rmdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
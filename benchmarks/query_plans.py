@@ -0,0 +1,158 @@
+"""Query plan benchmark for the schema migrations.
+
+Builds a synthetic database (500k sales by default), strips it back to the
+pre-migration schema, and prints the query plan and timing of the hot queries
+before and after running app.migrate_db().
+
+    python benchmarks/query_plans.py [--sales 500000] [--keep]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Hot queries, as issued by /sales, edit_sale, /results and /expenses
+QUERIES = [
+    ('sales: completed, first page',
+     '''SELECT s.id FROM sales s WHERE s.is_delivered = 1 AND s.is_paid = 1
+        ORDER BY s.date DESC, s.id DESC LIMIT 11''', ()),
+    ('sales: completed, keyset page',
+     '''SELECT s.id FROM sales s WHERE s.is_delivered = 1 AND s.is_paid = 1
+        AND (s.date, s.id) < (?, ?) ORDER BY s.date DESC, s.id DESC LIMIT 11''',
+     ('2022-06-01', 10 ** 9)),
+    ('sales: pending, first page',
+     '''SELECT s.id FROM sales s WHERE s.is_delivered = 0
+        ORDER BY s.date DESC, s.id DESC LIMIT 11''', ()),
+    ('sales: unpaid, first page',
+     '''SELECT s.id FROM sales s WHERE s.is_delivered = 1 AND s.is_paid = 0
+        ORDER BY s.date DESC, s.id DESC LIMIT 11''', ()),
+    ('sales: items for page',
+     '''SELECT si.sale_id, si.quantity, r.name FROM sales_items si
+        JOIN recipes r ON si.recipe_id = r.id
+        WHERE si.sale_id IN (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ORDER BY si.id''',
+     tuple(range(1000, 1010))),
+    ('edit_sale: items',
+     '''SELECT si.recipe_id, si.quantity, r.name FROM sales_items si
+        JOIN recipes r ON si.recipe_id = r.id WHERE si.sale_id = ?''', (4242,)),
+    ('recipes: items per recipe',
+     'SELECT COUNT(*) FROM sales_items WHERE recipe_id = ?', (3,)),
+    ('results: recent sales',
+     'SELECT id FROM sales ORDER BY date DESC LIMIT 10', ()),
+    ('results: last 30 days',
+     "SELECT date, SUM(total_amount) FROM sales WHERE date >= ? GROUP BY date",
+     ('2024-12-01',)),
+    ('expenses: recent',
+     'SELECT id FROM expenses ORDER BY date DESC LIMIT 10', ()),
+]
+
+
+def populate(conn, n_sales, n_expenses, n_recipes=20, seed=42):
+    rng = random.Random(seed)
+    start = date(2020, 1, 1)
+    span = (date(2024, 12, 31) - start).days
+    c = conn.cursor()
+
+    c.executemany("INSERT INTO recipes (name, unit_price, box_price) VALUES (?, ?, ?)",
+                  [(f'Receita {i}', 5.0 + i, 27.0 + i * 5) for i in range(n_recipes)])
+
+    batch = 50000
+    for offset in range(0, n_sales, batch):
+        sales, items = [], []
+        for sale_id in range(offset + 1, min(offset + batch, n_sales) + 1):
+            day = start + timedelta(days=rng.randrange(span))
+            # Older sales are closed; a small tail is still pending or unpaid
+            is_delivered = 1 if rng.random() > 0.01 else 0
+            is_paid = 1 if is_delivered and rng.random() > 0.02 else 0
+            sales.append((sale_id, f'Cliente {rng.randrange(5000)}', 0, 5.0,
+                          is_delivered, is_paid, day.isoformat(), day.isoformat()))
+            for _ in range(rng.randint(1, 4)):
+                items.append((sale_id, rng.randint(1, n_recipes), rng.randint(1, 18), 6.0, 30.0))
+        c.executemany('''INSERT INTO sales (id, customer_name, total_amount, delivery_cost,
+                         is_delivered, is_paid, date, delivery_date)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', sales)
+        c.executemany('''INSERT INTO sales_items (sale_id, recipe_id, quantity, unit_price, box_price)
+                         VALUES (?, ?, ?, ?, ?)''', items)
+        conn.commit()
+
+    c.executemany("INSERT INTO expenses (amount, description, date) VALUES (?, ?, ?)",
+                  [(rng.uniform(5, 300), 'Despesa',
+                    (start + timedelta(days=rng.randrange(span))).isoformat())
+                   for _ in range(n_expenses)])
+    conn.commit()
+
+
+def strip_migrations(conn):
+    # Back to the schema a database had before any migration ran
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                                "AND name LIKE 'idx_%'").fetchall():
+        conn.execute(f'DROP INDEX {name}')
+    conn.execute('PRAGMA user_version = 0')
+    conn.commit()
+
+
+def measure(conn, sql, params, repeat=5):
+    plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return plan, best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sales', type=int, default=500000)
+    parser.add_argument('--expenses', type=int, default=50000)
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic database')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='nina-bench-')
+    # Keep the database files (database.db by default) in a scratch directory
+    os.chdir(workdir)
+    import app
+
+    path = os.path.join(workdir, 'bench.db')
+    app.app.config['DATABASE'] = path
+    app.init_db()
+    conn = app.connect_db(path)
+
+    print(f'Populating {args.sales} sales in {path} ...')
+    started = time.perf_counter()
+    populate(conn, args.sales, args.expenses)
+    print(f'  done in {time.perf_counter() - started:.1f}s')
+
+    strip_migrations(conn)
+    conn.execute('ANALYZE')
+    before = {name: measure(conn, sql, params) for name, sql, params in QUERIES}
+
+    started = time.perf_counter()
+    version = app.migrate_db(conn)
+    conn.execute('ANALYZE')
+    print(f'Migrated to schema version {version} in {time.perf_counter() - started:.1f}s\n')
+    after = {name: measure(conn, sql, params) for name, sql, params in QUERIES}
+
+    for name, _, _ in QUERIES:
+        plan_before, ms_before = before[name]
+        plan_after, ms_after = after[name]
+        print(f'{name}: {ms_before:.2f}ms -> {ms_after:.2f}ms')
+        print(f'  before: {" | ".join(plan_before)}')
+        print(f'  after:  {" | ".join(plan_after)}')
+
+    conn.close()
+    if not args.keep:
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Micro-benchmark for add_sale / edit_sale with many lines.
+
+Posts sales with a growing number of lines through the Flask test client and
+counts the SQL statements each request sends to SQLite. With batched pricing
+and executemany the count must not grow with the number of lines.
+
+    python benchmarks/sale_writes.py [--lines 10 50 100] [--repeat 20]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+calls = {'statements': 0}
+
+
+class CountingCursor(sqlite3.Cursor):
+    def execute(self, *args, **kwargs):
+        calls['statements'] += 1
+        return super().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        calls['statements'] += 1
+        return super().executemany(*args, **kwargs)
+
+
+class CountingConnection(sqlite3.Connection):
+    def cursor(self, factory=CountingCursor):
+        return super().cursor(factory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, nargs='+', default=[1, 10, 50, 100])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='nina-bench-')
+    # Keep the database files (database.db by default) in a scratch directory
+    os.chdir(workdir)
+    import app
+    from werkzeug.security import generate_password_hash
+    app.init_db()
+
+    def counting_connect(path=None):
+        conn = sqlite3.connect(path or app.app.config['DATABASE'], factory=CountingConnection)
+        for pragma in app.DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    app.connect_db = counting_connect
+    flask_app = app.app
+    flask_app.config.update(SECRET_KEY='bench', SESSION_COOKIE_DOMAIN=None,
+                            SESSION_COOKIE_SECURE=False)
+
+    conn = sqlite3.connect('database.db')
+    conn.execute("INSERT INTO users (username, password, is_admin) VALUES (?, ?, 1)",
+                  ('bench', generate_password_hash('bench')))
+    conn.executemany("INSERT INTO recipes (name, unit_price, box_price) VALUES (?, ?, ?)",
+                     [(f'Receita {i}', 5.0, 27.0) for i in range(max(args.lines))])
+    conn.commit()
+    conn.close()
+
+    client = flask_app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+    client.get('/recipes')  # warm the user cache and the connection pool
+
+    def form(lines):
+        return {'customer_name': 'Bench', 'delivery_cost': '5,00',
+                'date': '01/06/2024', 'delivery_date': '02/06/2024',
+                'recipe_id[]': [str(i + 1) for i in range(lines)],
+                'quantity[]': [str(i % 13 + 1) for i in range(lines)]}
+
+    def run(url, data):
+        calls['statements'] = 0
+        started = time.perf_counter()
+        response = client.post(url, data=data)
+        elapsed = time.perf_counter() - started
+        assert response.status_code == 302, response.status_code
+        return calls['statements'], elapsed * 1000
+
+    print(f'{"route":<10} {"lines":>6} {"statements":>11} {"best ms":>9}')
+    counts = {}
+    for route in ('add_sale', 'edit_sale'):
+        for lines in args.lines:
+            results = []
+            for _ in range(args.repeat):
+                url = '/add_sale' if route == 'add_sale' else '/edit_sale/1'
+                results.append(run(url, form(lines)))
+            statements = results[0][0]
+            counts.setdefault(route, set()).add(statements)
+            print(f'{route:<10} {lines:>6} {statements:>11} {min(ms for _, ms in results):>9.2f}')
+
+    for route, seen in counts.items():
+        if len(seen) != 1:
+            sys.exit(f'{route}: statement count depends on the number of lines: {sorted(seen)}')
+    print('\nStatement count is constant in the number of lines.')
+
+
+if __name__ == '__main__':
+    main()
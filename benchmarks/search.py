@@ -0,0 +1,71 @@
+"""Search benchmark for the FTS5 index.
+
+Builds a synthetic ledger (1M sales by default) through the same triggers the
+app uses, then times /search queries: whole words, short prefixes and
+the second page of a common term.
+
+    python benchmarks/search.py [--sales 1000000] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from query_plans import populate  # noqa: E402
+
+QUERIES = [
+    ('customer, full name', 'Cliente 4242', None, 1),
+    ('customer, prefix', 'cliente 42', None, 1),
+    ('recipe, prefix', 'rec', 'sales', 1),
+    ('common term, page 3', 'cliente', None, 3),
+    ('expense description', 'despesa', 'expenses', 1),
+    ('no match', 'inexistente', None, 1),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sales', type=int, default=1000000)
+    parser.add_argument('--expenses', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='nina-bench-')
+    # Keep the database files (database.db by default) in a scratch directory
+    os.chdir(workdir)
+    import app
+    app.init_db()
+
+    conn = app.connect_db()
+    print(f'Populating {args.sales} sales ...')
+    started = time.perf_counter()
+    populate(conn, args.sales, args.expenses)
+    conn.execute("INSERT INTO sales_search (sales_search) VALUES ('optimize')")
+    conn.execute("INSERT INTO expenses_search (expenses_search) VALUES ('optimize')")
+    conn.commit()
+    print(f'  done in {time.perf_counter() - started:.1f}s\n')
+
+    c = conn.cursor()
+    print(f'{"query":<22} {"results":>8} {"best ms":>9}')
+    for name, text, kind, page in QUERIES:
+        best = None
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            results, _ = app.search_ledger(c, text, [kind] if kind else None, page)
+            elapsed = (time.perf_counter() - started) * 1000
+            best = elapsed if best is None else min(best, elapsed)
+        print(f'{name:<22} {len(results):>8} {best:>9.2f}')
+
+    conn.close()
+    for name in os.listdir(workdir):
+        os.remove(os.path.join(workdir, name))
+    os.rmdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""Route benchmark suite on a synthetic database.
+
+Generates a database with benchmarks/synthetic.py, then drives /sales,
+/results, /expenses, /budgets, add_sale and edit_sale through the Flask test client and
+reports p50/p95 latency, SQL statements per request and peak Python memory per
+route. Results can be saved as JSON and compared with a previous run:
+
+    python benchmarks/suite.py --json before.json
+    git checkout other-branch
+    python benchmarks/suite.py --json after.json --compare before.json
+
+    [--recipes 30] [--sales 20000] [--expenses 3000] [--years 3] [--repeat 50]
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import generate  # noqa: E402
+
+# A route whose p50 got this much slower than in --compare, and by at least
+# MIN_DELTA_MS, is reported as a regression (small routes are noisy)
+REGRESSION = 0.20
+MIN_DELTA_MS = 1.0
+
+
+def sale_form(rng, recipe_ids):
+    lines = rng.choice((1, 1, 2, 2, 3, 5))
+    return {'customer_name': f'Bench {rng.randrange(100)}', 'delivery_cost': '5,00',
+            'date': '01/06/2024', 'delivery_date': '03/06/2024',
+            'recipe_id[]': [str(recipe_id) for recipe_id in rng.sample(recipe_ids, lines)],
+            'quantity[]': [str(rng.randint(1, 24)) for _ in range(lines)]}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--recipes', type=int, default=30)
+    parser.add_argument('--sales', type=int, default=20000)
+    parser.add_argument('--expenses', type=int, default=3000)
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=50, help='timed requests per route')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='nina-bench-')
+    # Keep the database files (database.db by default) in a scratch directory
+    os.chdir(workdir)
+    import app
+    from werkzeug.security import generate_password_hash
+
+    path = os.path.join(workdir, 'bench.db')
+    flask_app = app.app
+    flask_app.config.update(DATABASE=path, SECRET_KEY='bench', SESSION_COOKIE_DOMAIN=None,
+                            SESSION_COOKIE_SECURE=False)
+    app.init_db()
+    conn = sqlite3.connect(path)
+    print(f'Generating {args.recipes} recipes, {args.sales} sales, {args.expenses} expenses ...')
+    started = time.perf_counter()
+    generate(conn, args.recipes, args.sales, args.expenses, args.years, args.seed)
+    conn.execute("INSERT INTO users (username, password, is_admin) VALUES (?, ?, 1)",
+                 ('bench', generate_password_hash('bench')))
+    conn.commit()
+    recipe_ids = [row[0] for row in conn.execute("SELECT id FROM recipes")]
+    edit_id = conn.execute("SELECT MAX(id) FROM sales").fetchone()[0]
+    conn.close()
+    print(f'  done in {time.perf_counter() - started:.1f}s')
+
+    client = flask_app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+    rng = random.Random(args.seed)
+
+    routes = [
+        ('GET /sales', lambda: client.get('/sales'), 200),
+        ('GET /results', lambda: client.get('/results'), 200),
+        ('GET /expenses', lambda: client.get('/expenses'), 200),
+        ('GET /expenses?cat', lambda: client.get('/expenses?category=1'), 200),
+        ('GET /budgets', lambda: client.get('/budgets'), 200),
+        ('POST /add_sale', lambda: client.post('/add_sale', data=sale_form(rng, recipe_ids)), 302),
+        ('GET /edit_sale', lambda: client.get(f'/edit_sale/{edit_id}'), 200),
+        ('POST /edit_sale', lambda: client.post(f'/edit_sale/{edit_id}', data=sale_form(rng, recipe_ids)), 302),
+    ]
+
+    def call(route, request, status):
+        response = request()
+        if response.status_code != status:
+            sys.exit(f'{route}: expected {status}, got {response.status_code}')
+        response.close()
+
+    results = {}
+    for route, request, status in routes:
+        call(route, request, status)  # warm the pool, the caches and the templates
+        latencies, statements = [], []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            call(route, request, status)
+            latencies.append((time.perf_counter() - started) * 1000)
+            statements.append(app._request_sql.queries)
+
+        # Memory in a separate pass, since tracing slows every allocation down
+        tracemalloc.start()
+        peak = 0
+        for _ in range(min(5, args.repeat)):
+            tracemalloc.reset_peak()
+            call(route, request, status)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+        results[route] = {'p50_ms': percentile(latencies, 0.50), 'p95_ms': percentile(latencies, 0.95),
+                          'statements': max(statements), 'peak_kb': peak / 1024}
+
+    report = {'commit': git_commit(), 'python': sys.version.split()[0],
+              'scale': {'recipes': args.recipes, 'sales': args.sales, 'expenses': args.expenses,
+                        'years': args.years, 'seed': args.seed, 'repeat': args.repeat},
+              'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              'routes': results}
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['routes']
+
+    print(f'\n{"route":<17} {"p50 ms":>8} {"p95 ms":>8} {"stmts":>6} {"peak KB":>9}')
+    regressions = []
+    for route, result in results.items():
+        line = (f'{route:<17} {result["p50_ms"]:>8.2f} {result["p95_ms"]:>8.2f} '
+                f'{result["statements"]:>6} {result["peak_kb"]:>9.0f}')
+        before = baseline.get(route)
+        if before:
+            change = result['p50_ms'] / before['p50_ms'] - 1 if before['p50_ms'] else 0
+            line += f'   p50 {change:+.0%} vs {before["p50_ms"]:.2f}'
+            if change > REGRESSION and result['p50_ms'] - before['p50_ms'] >= MIN_DELTA_MS:
+                regressions.append(route)
+        print(line)
+    print(f'\nmax RSS {report["max_rss_kb"] / 1024:.0f} MB')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    for name in os.listdir(workdir):
+        os.remove(os.path.join(workdir, name))
+    os.rmdir(workdir)
+
+    if regressions:
+        sys.exit(f'Slower than {args.compare} by more than {REGRESSION:.0%}: {", ".join(regressions)}')
+
+
+if __name__ == '__main__':
+    main()
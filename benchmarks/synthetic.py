@@ -0,0 +1,129 @@
+"""Synthetic databases for the benchmarks.
+
+generate() fills an initialized (app.init_db) database with N recipes, M sales
+and K expenses spread over the last few years, with the mix of line counts,
+box/loose quantities and delivery/payment states the real ledger has, then
+rebuilds the rollups the app keeps (daily, margin, receivable and expense
+totals). Expenses get a category (with a monthly budget) from their description. The
+same seed always produces the same database.
+
+    python benchmarks/synthetic.py out.db [--recipes 30] [--sales 20000] [--expenses 3000] [--years 3]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Lines per sale and how often each count shows up
+LINE_COUNTS = (1, 2, 3, 4, 5, 6, 8, 10)
+LINE_WEIGHTS = (40, 25, 14, 8, 5, 4, 3, 1)
+EXPENSES = ('Farinha', 'Ovos', 'Manteiga', 'Açúcar', 'Embalagens', 'Gás', 'Entrega', 'Fermento')
+# Category and monthly budget of each expense description; Gás has none
+CATEGORIES = {'Ingredientes': 1500.0, 'Embalagens': 400.0, 'Entrega': 300.0}
+EXPENSE_CATEGORIES = {'Farinha': 'Ingredientes', 'Ovos': 'Ingredientes', 'Manteiga': 'Ingredientes',
+                      'Açúcar': 'Ingredientes', 'Fermento': 'Ingredientes',
+                      'Embalagens': 'Embalagens', 'Entrega': 'Entrega'}
+FIRST_NAMES = ('Ana', 'Bruno', 'Carla', 'Diego', 'Elisa', 'Fábio', 'Gabi', 'Hugo', 'Iara', 'João')
+LAST_NAMES = ('Silva', 'Souza', 'Costa', 'Lima', 'Rocha', 'Alves', 'Melo', 'Ramos')
+
+
+def quantity(rng):
+    # Mostly whole boxes, sometimes with loose units, sometimes just a few units
+    roll = rng.random()
+    if roll < 0.5:
+        return 6 * rng.randint(1, 4)
+    if roll < 0.8:
+        return 6 * rng.randint(1, 3) + rng.randint(1, 5)
+    return rng.randint(1, 5)
+
+
+def generate(conn, recipes=30, sales=20000, expenses=3000, years=3, seed=42, today=None):
+    """Fill conn's database; it must be initialized and hold no sales yet."""
+    import app
+
+    rng = random.Random(seed)
+    today = today or date.today()
+    start = today - timedelta(days=365 * years)
+    span = (today - start).days + 1
+    customers = [f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {i}'
+                 for i in range(max(1, sales // 8))]
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+
+    c.executemany("INSERT INTO recipes (name, unit_price, box_price, unit_cost) VALUES (?, ?, ?, ?)",
+                  [(f'Receita {i}', 4.0 + i % 7, 22.0 + (i % 7) * 5, 1.5 + i % 5 * 0.5)
+                   for i in range(recipes)])
+    c.execute("SELECT id, unit_price, box_price, unit_cost FROM recipes")
+    prices = c.fetchall()
+
+    batch = 20000
+    for offset in range(0, sales, batch):
+        sale_rows, item_rows = [], []
+        for sale_id in range(offset + 1, min(offset + batch, sales) + 1):
+            day = start + timedelta(days=rng.randrange(span))
+            delivery_day = day + timedelta(days=rng.randint(0, 7))
+            age = (today - day).days
+            # Everything older than a month is closed except a few unpaid ones
+            is_delivered = 1 if age > 30 or rng.random() < 0.5 else 0
+            is_paid = 1 if is_delivered and (age > 30 and rng.random() > 0.03 or rng.random() < 0.4) else 0
+            delivery_cost = rng.choice((0.0, 0.0, 5.0, 8.0, 12.0))
+            subtotal = 0
+            for recipe_id, unit_price, box_price, unit_cost in rng.sample(
+                    prices, min(len(prices), rng.choices(LINE_COUNTS, LINE_WEIGHTS)[0])):
+                amount = quantity(rng)
+                subtotal += app.sale_item_subtotal(amount, unit_price, box_price)
+                item_rows.append((sale_id, recipe_id, amount, unit_price, box_price, unit_cost))
+            sale_rows.append((sale_id, rng.choice(customers), subtotal + delivery_cost, delivery_cost,
+                              is_delivered, is_paid, day.isoformat(), delivery_day.isoformat()))
+        c.executemany('''INSERT INTO sales (id, customer_name, total_amount, delivery_cost,
+                         is_delivered, is_paid, date, delivery_date)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', sale_rows)
+        c.executemany('''INSERT INTO sales_items (sale_id, recipe_id, quantity, unit_price, box_price, unit_cost)
+                         VALUES (?, ?, ?, ?, ?, ?)''', item_rows)
+
+    c.executemany("INSERT INTO expense_categories (name, monthly_budget) VALUES (?, ?)",
+                  list(CATEGORIES.items()))
+    c.execute("SELECT name, id FROM expense_categories")
+    category_ids = dict(c.fetchall())
+    c.executemany("INSERT INTO expenses (amount, description, date) VALUES (?, ?, ?)",
+                  [(round(rng.uniform(5, 300), 2), rng.choice(EXPENSES),
+                    (start + timedelta(days=rng.randrange(span))).isoformat())
+                   for _ in range(expenses)])
+    for description, category in EXPENSE_CATEGORIES.items():
+        c.execute("UPDATE expenses SET category_id = ? WHERE description = ?",
+                  (category_ids[category], description))
+
+    # Rows were written directly, so rebuild what the routes would have maintained
+    app.rebuild_daily_totals(c)
+    app.rebuild_margin_totals(c)
+    app.backfill_customers(c)
+    app.rebuild_expense_totals(c)
+    conn.commit()
+    c.execute('ANALYZE')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database')
+    parser.add_argument('--recipes', type=int, default=30)
+    parser.add_argument('--sales', type=int, default=20000)
+    parser.add_argument('--expenses', type=int, default=3000)
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    import app
+    app.app.config['DATABASE'] = args.database
+    app.init_db()
+    conn = sqlite3.connect(args.database)
+    generate(conn, args.recipes, args.sales, args.expenses, args.years, args.seed)
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
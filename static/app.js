@@ -0,0 +1,75 @@
+// Page-side helpers for the service worker and the offline queue
+(function () {
+    function newKey() {
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID();
+        }
+        return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+    }
+
+    if ('serviceWorker' in navigator) {
+        navigator.serviceWorker.register('/service-worker.js');
+
+        navigator.serviceWorker.addEventListener('message', function (event) {
+            if (event.data && event.data.type === 'synced') {
+                showNotice(event.data.sent + ' operação(ões) pendente(s) enviada(s).', 'success');
+            }
+        });
+
+        // Browsers without background sync: ask the worker to replay when back online
+        window.addEventListener('online', function () {
+            navigator.serviceWorker.ready.then(function (registration) {
+                if (registration.active) {
+                    registration.active.postMessage('replay');
+                }
+            });
+        });
+    }
+
+    function showNotice(message, category) {
+        const main = document.querySelector('main');
+        if (!main) {
+            return;
+        }
+        const notice = document.createElement('div');
+        notice.className = 'mb-6 p-4 rounded ' +
+            (category === 'success' ? 'bg-green-100 text-green-800' : 'bg-blue-100 text-blue-800');
+        notice.textContent = message;
+        main.insertBefore(notice, main.firstChild);
+    }
+
+    document.addEventListener('DOMContentLoaded', function () {
+        if (new URLSearchParams(location.search).get('queued')) {
+            showNotice('Sem conexão: a operação foi salva e será enviada quando a conexão voltar.', 'info');
+        }
+
+        // Forms that create something get a key per page load, so a resubmission
+        // or a replay from the offline queue is only applied once
+        document.querySelectorAll('form[data-idempotent]').forEach(function (form) {
+            const input = document.createElement('input');
+            input.type = 'hidden';
+            input.name = 'idempotency_key';
+            input.value = newKey();
+            form.appendChild(input);
+        });
+
+        // Status toggles are links; send them as POSTs so they can be queued offline
+        document.addEventListener('click', function (event) {
+            const link = event.target.closest('a[data-sync-post]');
+            if (!link) {
+                return;
+            }
+            event.preventDefault();
+            const form = document.createElement('form');
+            form.method = 'POST';
+            form.action = link.href;
+            const input = document.createElement('input');
+            input.type = 'hidden';
+            input.name = 'idempotency_key';
+            input.value = newKey();
+            form.appendChild(input);
+            document.body.appendChild(form);
+            form.submit();
+        });
+    });
+})();
@@ -0,0 +1,226 @@
+// Nina Caseira service worker
+//
+// - precaches the built assets (static/dist), the icons and the offline shell
+//   (base.html via /offline)
+// - recipe lists are served stale-while-revalidate
+// - other pages are network-first, falling back to the last copy seen
+// - add_sale / toggle_sale_status POSTs that fail for lack of network are
+//   queued in IndexedDB and replayed by background sync (or when the page
+//   reports it is back online). Each carries an idempotency key, so a replay
+//   that already reached the server is not applied twice.
+
+const CACHE_VERSION = 'v2';
+// Filled in by the /service-worker.js route from static/dist/manifest.json
+const ASSETS = [];
+const ASSETS_VERSION = 'dev';
+const STATIC_CACHE = `static-${CACHE_VERSION}-${ASSETS_VERSION}`;
+const PAGES_CACHE = `pages-${CACHE_VERSION}`;
+const OFFLINE_URL = '/offline';
+const SYNC_TAG = 'nina-outbox';
+
+const PRECACHE = [
+    OFFLINE_URL,
+    ...ASSETS,
+    '/static/site.webmanifest',
+    '/static/favicon.svg',
+    '/static/favicon-96x96.png',
+    '/static/favicon.ico',
+    '/static/apple-touch-icon.png',
+    '/static/web-app-manifest-192x192.png',
+    '/static/web-app-manifest-512x512.png',
+];
+
+const STALE_WHILE_REVALIDATE = [/^\/recipes$/, /^\/api\/v1\/recipes$/];
+const QUEUED_POSTS = [/^\/add_sale$/, /^\/toggle_sale_status\/\d+\/\w+$/];
+
+self.addEventListener('install', (event) => {
+    event.waitUntil((async () => {
+        const cache = await caches.open(STATIC_CACHE);
+        await cache.addAll(PRECACHE);
+        await self.skipWaiting();
+    })());
+});
+
+self.addEventListener('activate', (event) => {
+    event.waitUntil((async () => {
+        const keep = [STATIC_CACHE, PAGES_CACHE];
+        for (const name of await caches.keys()) {
+            if (!keep.includes(name)) {
+                await caches.delete(name);
+            }
+        }
+        await self.clients.claim();
+        await replayQueue().catch(() => {});
+    })());
+});
+
+self.addEventListener('fetch', (event) => {
+    const request = event.request;
+    const url = new URL(request.url);
+
+    if (request.method === 'POST') {
+        if (url.origin === location.origin && QUEUED_POSTS.some((re) => re.test(url.pathname))) {
+            event.respondWith(postOrQueue(request));
+        }
+        return;
+    }
+    if (request.method !== 'GET') {
+        return;
+    }
+
+    if (url.origin !== location.origin) {
+        event.respondWith(cacheFirst(request));
+    } else if (url.pathname === '/logout') {
+        // Don't leave someone else's pages around after signing out
+        event.respondWith(caches.delete(PAGES_CACHE).then(() => fetch(request)));
+    } else if (url.pathname.startsWith('/static/')) {
+        event.respondWith(cacheFirst(request));
+    } else if (STALE_WHILE_REVALIDATE.some((re) => re.test(url.pathname))) {
+        event.respondWith(staleWhileRevalidate(event, request));
+    } else if (request.mode === 'navigate') {
+        event.respondWith(networkFirst(request));
+    }
+});
+
+self.addEventListener('sync', (event) => {
+    if (event.tag === SYNC_TAG) {
+        event.waitUntil(replayQueue());
+    }
+});
+
+self.addEventListener('message', (event) => {
+    if (event.data === 'replay') {
+        event.waitUntil(replayQueue().catch(() => {}));
+    }
+});
+
+async function cacheFirst(request) {
+    const cached = await caches.match(request);
+    if (cached) {
+        return cached;
+    }
+    const response = await fetch(request);
+    if (response.ok || response.type === 'opaque') {
+        const cache = await caches.open(STATIC_CACHE);
+        cache.put(request, response.clone());
+    }
+    return response;
+}
+
+function isLoginPage(response) {
+    return new URL(response.url || location.origin).pathname === '/login';
+}
+
+async function savePage(request, response) {
+    // Redirects to the login page must not replace a cached page
+    if (response.ok && !response.redirected) {
+        const cache = await caches.open(PAGES_CACHE);
+        await cache.put(request, response.clone());
+    }
+    return response;
+}
+
+async function staleWhileRevalidate(event, request) {
+    const cached = await caches.match(request);
+    const refresh = fetch(request).then((response) => savePage(request, response));
+    if (cached) {
+        event.waitUntil(refresh.catch(() => {}));
+        return cached;
+    }
+    try {
+        return await refresh;
+    } catch (err) {
+        return offlineFallback(request);
+    }
+}
+
+async function networkFirst(request) {
+    try {
+        return await savePage(request, await fetch(request));
+    } catch (err) {
+        return offlineFallback(request);
+    }
+}
+
+async function offlineFallback(request) {
+    const cached = await caches.match(request, { ignoreSearch: true });
+    return cached || caches.match(OFFLINE_URL);
+}
+
+// Outbox in IndexedDB: { id, url, body, contentType, key, queuedAt }
+function openOutbox() {
+    return new Promise((resolve, reject) => {
+        const open = indexedDB.open('nina-outbox', 1);
+        open.onupgradeneeded = () => open.result.createObjectStore('requests', { keyPath: 'id', autoIncrement: true });
+        open.onsuccess = () => resolve(open.result);
+        open.onerror = () => reject(open.error);
+    });
+}
+
+function outboxTransaction(mode, work) {
+    return openOutbox().then((db) => new Promise((resolve, reject) => {
+        const tx = db.transaction('requests', mode);
+        const result = work(tx.objectStore('requests'));
+        tx.oncomplete = () => resolve(result.result);
+        tx.onerror = () => reject(tx.error);
+    }));
+}
+
+async function postOrQueue(request) {
+    const body = await request.clone().text();
+    try {
+        return await fetch(request);
+    } catch (err) {
+        const contentType = request.headers.get('Content-Type') || 'application/x-www-form-urlencoded';
+        const key = request.headers.get('Idempotency-Key')
+            || new URLSearchParams(body).get('idempotency_key')
+            || `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+        await outboxTransaction('readwrite', (store) => store.add({
+            url: request.url, body, contentType, key, queuedAt: Date.now(),
+        }));
+        if (self.registration.sync) {
+            try {
+                await self.registration.sync.register(SYNC_TAG);
+            } catch (syncErr) {
+                // No background sync here: the page asks for a replay when online
+            }
+        }
+        return Response.redirect('/sales?queued=1', 303);
+    }
+}
+
+let replaying = null;
+
+function replayQueue() {
+    // One replay at a time; sync, activate and the page can all ask at once
+    if (!replaying) {
+        replaying = drainQueue().finally(() => { replaying = null; });
+    }
+    return replaying;
+}
+
+async function drainQueue() {
+    const queued = await outboxTransaction('readonly', (store) => store.getAll());
+    let sent = 0;
+    for (const entry of queued) {
+        // A network error rejects here, and background sync retries later
+        const response = await fetch(entry.url, {
+            method: 'POST',
+            body: entry.body,
+            headers: { 'Content-Type': entry.contentType, 'Idempotency-Key': entry.key },
+            credentials: 'same-origin',
+        });
+        if (!response.ok || isLoginPage(response)) {
+            // Signed out or rejected: leave it queued for the next attempt
+            continue;
+        }
+        await outboxTransaction('readwrite', (store) => store.delete(entry.id));
+        sent += 1;
+    }
+    if (sent) {
+        // Cached pages no longer show the current sales
+        await caches.delete(PAGES_CACHE);
+        const clients = await self.clients.matchAll();
+        clients.forEach((client) => client.postMessage({ type: 'synced', sent }));
+    }
+}
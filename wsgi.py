@@ -0,0 +1,26 @@
+"""WSGI entry point for production.
+
+Initialize or migrate the database once per deployment, then start the workers:
+
+    flask --app app init-db
+    FLASK_SECRET_KEY=... gunicorn --workers 4 --threads 4 wsgi:app
+
+Each worker also runs JOB_WORKERS background job threads. They are started
+here, after gunicorn has forked, so don't use --preload; or set
+FLASK_JOB_WORKERS=0 and run 'flask --app app run-jobs' as a separate process.
+
+Settings come from FLASK_* environment variables (FLASK_SECRET_KEY,
+FLASK_DATABASE, FLASK_SESSION_COOKIE_DOMAIN, ...). Every worker opens its own
+connections to the same WAL-mode SQLite file; writes take the lock with
+BEGIN IMMEDIATE and wait up to busy_timeout for each other.
+"""
+from app import app, check_db, start_job_workers
+
+app.config.from_prefixed_env()
+
+if not app.config.get('SECRET_KEY'):
+    # Workers must share a key or sessions signed by one are rejected by the others
+    raise RuntimeError('FLASK_SECRET_KEY is not set')
+
+check_db()
+start_job_workers()